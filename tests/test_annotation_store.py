@@ -0,0 +1,41 @@
+import unittest
+
+from tool_loader import load_tool
+
+tool = load_tool()
+
+
+class AnnotationStoreTest(unittest.TestCase):
+    """Чтение и запись строк файла разметки"""
+
+    def test_whole_float_class_kept(self):
+        store = tool.AnnotationStore.from_yolo_lines(
+            ["1.0 0.5 0.5 0.2 0.2\n"]
+        )
+        self.assertEqual(store.to_yolo_lines(),
+                         ["1 0.500000 0.500000 0.200000 0.200000"])
+
+    def test_fractional_and_negative_classes_rejected(self):
+        store = tool.AnnotationStore.from_yolo_lines([
+            "1.5 0.5 0.5 0.2 0.2",
+            "-1 0.5 0.5 0.2 0.2",
+            "x 0.5 0.5 0.2 0.2",
+            "2 0.1 0.2 0.3 0.4",
+        ])
+        self.assertEqual(store.classes.tolist(), [2])
+        for text in ("1.5", "-1", "nan", "inf", "x"):
+            with self.assertRaises(ValueError):
+                tool.parse_class_id(text)
+
+    def test_text_roundtrip(self):
+        lines = ["0 0.500000 0.500000 0.200000 0.200000",
+                 "3 0.100000 0.200000 0.300000 0.400000"]
+        store = tool.AnnotationStore.from_yolo_lines(lines)
+        again = tool.AnnotationStore.from_yolo_lines(
+            store.to_text().splitlines()
+        )
+        self.assertEqual(again.to_yolo_lines(), lines)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+from tool_loader import load_tool
+
+tool = load_tool()
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class DatasetArchiveTest(unittest.TestCase):
+    """Экспорт набора в шарды tar и импорт обратно"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.src = self.dirs("src")
+        rng = np.random.default_rng(0)
+        for name, ext in (("a", ".png"), ("b", ".jpg")):
+            cv2.imwrite(os.path.join(self.src[0], name + ext),
+                        (rng.random((60, 80, 3)) * 255).astype(np.uint8))
+            with open(os.path.join(self.src[1], name + ".txt"), "w") as f:
+                f.write(f"0 0.5 0.5 0.2 0.2\n1 0.{len(name)} 0.5 0.1 0.1\n")
+        # Неразмеченное изображение в набор не попадает
+        cv2.imwrite(os.path.join(self.src[0], "c.png"),
+                    np.zeros((10, 10, 3), np.uint8))
+        self.archive = os.path.join(self.tmp.name, "archive")
+        count, problems = tool.export_dataset(self.archive, *self.src)
+        self.assertEqual((count, problems), (2, []))
+
+    def dirs(self, name):
+        root = os.path.join(self.tmp.name, name)
+        dirs = (os.path.join(root, "images"), os.path.join(root, "labels"),
+                os.path.join(root, "state"))
+        for path in dirs[:2]:
+            os.makedirs(path)
+        return dirs
+
+    def test_roundtrip(self):
+        self.assertEqual(tool.verify_dataset(self.archive, *self.src), [])
+        dst = self.dirs("dst")
+        self.assertEqual(tool.import_dataset(self.archive, *dst), (2, 0, []))
+        for name in ("a.png", "b.jpg"):
+            self.assertEqual(read(os.path.join(dst[0], name)),
+                             read(os.path.join(self.src[0], name)))
+        for name in ("a.txt", "b.txt"):
+            self.assertEqual(read(os.path.join(dst[1], name)),
+                             read(os.path.join(self.src[1], name)))
+        # Повторный импорт ничего не меняет
+        self.assertEqual(tool.import_dataset(self.archive, *dst), (0, 2, []))
+        self.assertEqual(sorted(os.listdir(dst[0])), ["a.png", "b.jpg"])
+
+    def test_import_keeps_existing_label_with_same_stem(self):
+        dst = self.dirs("dst")
+        cv2.imwrite(os.path.join(dst[0], "a.jpg"),
+                    np.full((20, 20, 3), 255, np.uint8))
+        with open(os.path.join(dst[1], "a.txt"), "w") as f:
+            f.write("2 0.5 0.5 0.9 0.9\n")
+        self.assertEqual(tool.import_dataset(self.archive, *dst), (2, 0, []))
+        self.assertEqual(read(os.path.join(dst[1], "a.txt")),
+                         b"2 0.5 0.5 0.9 0.9\n")
+        self.assertEqual(read(os.path.join(dst[0], "a_1.png")),
+                         read(os.path.join(self.src[0], "a.png")))
+        self.assertEqual(read(os.path.join(dst[1], "a_1.txt")),
+                         read(os.path.join(self.src[1], "a.txt")))
+
+    def test_corrupted_shard_reported(self):
+        shard = next(name for name in os.listdir(self.archive)
+                     if name.endswith(".tar"))
+        path = os.path.join(self.archive, shard)
+        data = bytearray(read(path))
+        data[1024] ^= 0xFF  # Внутри первого файла образца
+        with open(path, "wb") as f:
+            f.write(data)
+        self.assertTrue(tool.verify_dataset(self.archive))
+
+
+if __name__ == "__main__":
+    unittest.main()
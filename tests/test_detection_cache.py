@@ -0,0 +1,71 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import numpy as np
+
+from tool_loader import load_tool
+
+tool = load_tool()
+
+
+class Frame:
+    """Кадр с известным хэшем содержимого без пикселей"""
+
+    def __init__(self, content_hash):
+        self.content_hash = content_hash
+        self.width, self.height = 640, 480
+
+
+class DetectionCacheTest(unittest.TestCase):
+    """Кэш детекций, общий для нескольких процессов"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "detections.sqlite")
+
+    def cache(self, max_mb=1):
+        cache = tool.DetectionCache(self.path, "model.pt", max_mb=max_mb)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_roundtrip(self):
+        cache = self.cache()
+        detections = np.array([[1, 2, 3, 4, 0.9, 0]], dtype=np.float64)
+        cache.put(Frame("a"), detections)
+        np.testing.assert_allclose(cache.get(Frame("a")), detections,
+                                   rtol=1e-6)
+        self.assertIsNone(cache.get(Frame("b")))
+
+    def test_cap_is_shared_between_connections(self):
+        # Два соединения, как у двух процессов: каждое по отдельности
+        # укладывается в предел
+        first, second = self.cache(), self.cache()
+        detections = np.zeros((1000, 6))  # около 24 КБ
+        for index in range(80):
+            cache = first if index % 2 else second
+            cache.put(Frame(str(index)), detections)
+        size = sqlite3.connect(self.path).execute(
+            "SELECT SUM(size) FROM detections"
+        ).fetchone()[0]
+        self.assertLessEqual(size, 1024 * 1024 * 1.05)
+
+    def test_usage_time_written_in_batches(self):
+        cache = self.cache()
+        cache.put(Frame("a"), np.zeros((1, 6)))
+        before = sqlite3.connect(self.path).execute(
+            "SELECT last_used FROM detections"
+        ).fetchone()[0]
+        cache.get(Frame("a"))
+        self.assertIn(cache.key(Frame("a")), cache.touched)
+        cache.flush()
+        after = sqlite3.connect(self.path).execute(
+            "SELECT last_used FROM detections"
+        ).fetchone()[0]
+        self.assertGreater(after, before)
+
+
+if __name__ == "__main__":
+    unittest.main()
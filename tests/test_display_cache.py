@@ -0,0 +1,67 @@
+import os
+import tempfile
+import threading
+import unittest
+
+import cv2
+import numpy as np
+
+from tool_loader import load_tool
+
+tool = load_tool()
+
+
+class DisplayCacheTest(unittest.TestCase):
+    """Уменьшенные копии для показа изображений"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.paths = []
+        for index in range(4):
+            path = os.path.join(self.tmp.name, f"{index}.png")
+            cv2.imwrite(path, np.full((1000, 1500, 3), index, np.uint8))
+            self.paths.append(path)
+        self.cache = tool.DisplayCache(os.path.join(self.tmp.name, "cache"),
+                                       pending_saves=2)
+        self.addCleanup(self.cache.executor.shutdown)
+
+    def render(self, path):
+        frame = tool.DecodedFrame.try_load(path)
+        return self.cache.render(frame, 300, 200)
+
+    def test_pending_saves_are_capped(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        started = []
+
+        def slow_save(frame):
+            started.append(frame.path)
+            release.wait(10)
+
+        self.cache.save_thumbnails = slow_save
+        for path in self.paths:
+            self.assertEqual(self.render(path).size, (300, 200))
+        self.assertEqual(len(self.cache.saving), 2)
+        release.set()
+        self.cache.executor.shutdown(wait=True)
+        self.assertEqual(started, self.paths[:2])
+        self.assertFalse(self.cache.saving)
+
+    def test_thumbnail_used_and_discarded(self):
+        self.render(self.paths[0])
+        self.cache.executor.shutdown(wait=True)
+        thumbnail = self.cache.thumbnail_path(self.paths[0], 640)
+        self.assertTrue(os.path.exists(thumbnail))
+
+        lazy = tool.DecodedFrame.lazy(self.paths[0])
+        self.assertEqual(self.cache.render(lazy, 300, 200).size, (300, 200))
+        self.assertFalse(lazy.is_decoded)
+
+        self.cache.discard(self.paths[0])
+        self.assertFalse(os.path.exists(thumbnail))
+        self.assertEqual(self.cache.total_bytes, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "two-wheeled-humans_annotation_tool.py")
+
+# Запуск скрипта так, будто Tkinter не установлен
+RUN_WITHOUT_TK = (
+    "import runpy, sys\n"
+    "sys.modules['tkinter'] = None\n"
+    "sys.argv = [sys.argv[1]] + sys.argv[2:]\n"
+    "runpy.run_path(sys.argv[0], run_name='__main__')\n"
+)
+
+
+class HeadlessWithoutTkTest(unittest.TestCase):
+    """Консольная разметка не должна требовать Tkinter"""
+
+    def test_headless_runs_without_tkinter(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, "images"))
+            result = subprocess.run(
+                [sys.executable, "-c", RUN_WITHOUT_TK, SCRIPT, "--headless",
+                 "--images", os.path.join(tmp, "images"),
+                 "--labels", os.path.join(tmp, "labels"),
+                 "--state-dir", os.path.join(tmp, "state")],
+                capture_output=True, text=True, timeout=120,
+            )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertNotIn("tkinter", result.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+
+from tool_loader import load_tool
+
+tool = load_tool()
+
+
+class JobManifestTest(unittest.TestCase):
+    """Какие изображения массовая разметка обрабатывает повторно"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.image_dir = os.path.join(self.tmp.name, "images")
+        self.label_dir = os.path.join(self.tmp.name, "labels")
+        os.makedirs(self.image_dir)
+        os.makedirs(self.label_dir)
+        with open(os.path.join(self.image_dir, "a.jpg"), "wb") as f:
+            f.write(b"image")
+        self.path = os.path.join(self.tmp.name, "manifest.jsonl")
+
+    def manifest(self, **kwargs):
+        manifest = tool.JobManifest(self.path, "model.pt", **kwargs)
+        self.addCleanup(manifest.close)
+        return manifest
+
+    def needs_processing(self, manifest):
+        return manifest.needs_processing(self.image_dir, self.label_dir,
+                                         "a.jpg")
+
+    def test_manual_review_survives_new_settings(self):
+        manifest = self.manifest()
+        manifest.record(self.image_dir, "a.jpg", "done")
+        manifest.close()
+        for kwargs in ({"conf_threshold": 0.4},
+                       {"detector": tool.DetectorConfig(tile_size=640)}):
+            self.assertFalse(self.needs_processing(self.manifest(**kwargs)))
+
+    def test_manual_review_redone_after_image_change(self):
+        manifest = self.manifest()
+        manifest.record(self.image_dir, "a.jpg", "done")
+        with open(os.path.join(self.image_dir, "a.jpg"), "ab") as f:
+            f.write(b"changed")
+        self.assertTrue(self.needs_processing(manifest))
+
+    def test_negative_redone_with_new_settings(self):
+        manifest = self.manifest()
+        manifest.record(self.image_dir, "a.jpg", "negative")
+        self.assertFalse(self.needs_processing(manifest))
+        manifest.close()
+        self.assertTrue(
+            self.needs_processing(self.manifest(conf_threshold=0.4))
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
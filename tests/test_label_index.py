@@ -0,0 +1,84 @@
+import os
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+from tool_loader import load_tool
+
+tool = load_tool()
+
+
+class LabelIndexTest(unittest.TestCase):
+    """Таблица рамок следует за файлами разметки"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.image_dir = os.path.join(self.tmp.name, "images")
+        self.label_dir = os.path.join(self.tmp.name, "labels")
+        os.makedirs(self.image_dir)
+        os.makedirs(self.label_dir)
+        for name in ("a", "b", "c"):
+            cv2.imwrite(os.path.join(self.image_dir, name + ".png"),
+                        np.zeros((100, 200, 3), np.uint8))
+        self.write_label("a", ["0 0.5 0.5 0.2 0.2"])
+        self.write_label("b", ["0 0.5 0.5 0.05 0.05"] * 4
+                         + ["1 0.5 0.5 0.4 0.4"])
+
+    def write_label(self, name, lines):
+        path = os.path.join(self.label_dir, name + ".txt")
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        # Время изменения должно отличаться от прошлой записи
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 6))
+
+    def open_index(self):
+        catalog = tool.ImageCatalog(
+            os.path.join(self.tmp.name, "catalog.sqlite"),
+            self.image_dir, self.label_dir,
+        )
+        self.addCleanup(catalog.close)
+        catalog.refresh()
+        index = tool.LabelIndex(
+            os.path.join(self.tmp.name, "label_index.npy"), catalog
+        )
+        self.addCleanup(index.close)
+        index.sync()
+        return catalog, index
+
+    def test_queries_and_statistics(self):
+        _, index = self.open_index()
+        self.assertEqual(index.query(), ["a.png", "b.png"])
+        self.assertEqual(index.query(min_boxes=4), ["b.png"])
+        self.assertEqual(index.query(max_area=0.01), ["b.png"])
+        self.assertEqual(index.query(cls=1), ["b.png"])
+        stats = index.statistics()
+        self.assertEqual((stats["images"], stats["boxes"]), (2, 6))
+        self.assertEqual(stats["classes"], {0: 5, 1: 1})
+        # Рамка 0.2 x 0.2 на изображении 200 x 100: 40 x 20 пикселей
+        rows = index.live()
+        self.assertAlmostEqual(float(rows["aspect"][0]), 2.0, places=5)
+
+    def test_changes_and_reopen(self):
+        catalog, index = self.open_index()
+        self.write_label("a", ["0 0.1 0.1 0.1 0.1"] * 3)
+        os.remove(os.path.join(self.label_dir, "b.txt"))
+        self.write_label("c", ["1 0.5 0.5 0.5 0.5"] * 5000)  # рост таблицы
+        catalog.refresh()
+        index.sync()
+        expected = (index.query(), index.statistics())
+        self.assertEqual(expected[0], ["a.png", "c.png"])
+        self.assertEqual(expected[1]["boxes"], 5003)
+        index.close()
+        catalog.close()
+
+        _, reopened = self.open_index()
+        self.assertEqual((reopened.query(), reopened.statistics()),
+                         expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import tempfile
+import time
+import unittest
+
+from tool_loader import load_tool
+
+tool = load_tool()
+
+
+class PackedLabelsTest(unittest.TestCase):
+    """Упакованная разметка и журнал заданий"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.image_dir = os.path.join(self.tmp.name, "images")
+        self.label_dir = os.path.join(self.tmp.name, "labels")
+        os.makedirs(self.image_dir)
+        os.makedirs(self.label_dir)
+        for name in ("a.jpg", "b.jpg"):
+            with open(os.path.join(self.image_dir, name), "wb") as f:
+                f.write(b"image")
+
+    def test_record_written_only_after_flush(self):
+        manifest = tool.JobManifest(
+            os.path.join(self.tmp.name, "manifest.jsonl"), "model.pt"
+        )
+        self.addCleanup(manifest.close)
+        manifest.packed = True
+        writer = tool.LabelWriterThread(pack=True, flush_seconds=60)
+        writer.start()
+        self.addCleanup(writer.close)
+        writer.put_text(os.path.join(self.label_dir, "a.txt"),
+                        "0 0.5 0.5 0.2 0.2\n",
+                        lambda: manifest.record(self.image_dir, "a.jpg",
+                                                "positive", 1))
+        time.sleep(0.1)
+        self.assertNotIn("a.jpg", manifest.records)
+        writer.flush()
+        self.assertTrue(manifest.records["a.jpg"]["packed"])
+        self.assertEqual(tool.read_packed_labels(self.label_dir),
+                         {"a.txt": "0 0.5 0.5 0.2 0.2\n"})
+
+    def test_unpack_keeps_newer_manual_edit(self):
+        writer = tool.LabelWriterThread(pack=True)
+        writer.start()
+        writer.put_text(os.path.join(self.label_dir, "a.txt"), "packed a\n")
+        writer.put_text(os.path.join(self.label_dir, "b.txt"), "packed b\n")
+        writer.close()
+        manual = os.path.join(self.label_dir, "b.txt")
+        with open(manual, "w") as f:
+            f.write("manual b\n")
+        future = time.time_ns() + 10 ** 9
+        os.utime(manual, ns=(future, future))
+
+        self.assertEqual(tool.unpack_labels(self.label_dir, "never"), 1)
+        with open(os.path.join(self.label_dir, "a.txt")) as f:
+            self.assertEqual(f.read(), "packed a\n")
+        with open(manual) as f:
+            self.assertEqual(f.read(), "manual b\n")
+        self.assertFalse(os.path.exists(
+            os.path.join(self.label_dir, tool.LABEL_PACK_FILE)
+        ))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import unittest
+
+import numpy as np
+
+from tool_loader import load_tool
+
+tool = load_tool()
+
+
+def boxes_intersect(box1, box2):
+    x1_min, y1_min, x1_max, y1_max = box1
+    x2_min, y2_min, x2_max, y2_max = box2
+    return (x1_min <= x2_max and x1_max >= x2_min
+            and y1_min <= y2_max and y1_max >= y2_min)
+
+
+def reference_pairs(detections, conf_threshold):
+    """Поиск пар циклами, как в исходной версии инструмента"""
+    boxes = {0: [], 1: [], 3: []}
+    for x1, y1, x2, y2, conf, cls in detections.tolist():
+        if conf >= conf_threshold and int(cls) in boxes:
+            boxes[int(cls)].append([x1, y1, x2, y2])
+
+    pairs = []
+    for vehicle_class in (1, 3):
+        for p_box in boxes[0]:
+            for v_box in boxes[vehicle_class]:
+                if boxes_intersect(p_box, v_box):
+                    combined = (min(p_box[0], v_box[0]),
+                                min(p_box[1], v_box[1]),
+                                max(p_box[2], v_box[2]),
+                                max(p_box[3], v_box[3]))
+                    pairs.append({
+                        "person_box": p_box,
+                        "vehicle_box": v_box,
+                        "combined_box": combined,
+                        "area": ((combined[2] - combined[0])
+                                 * (combined[3] - combined[1])),
+                    })
+
+    filtered = []
+    used = set()
+    for i, current in enumerate(pairs):
+        if i in used:
+            continue
+        best = current
+        for j in range(i + 1, len(pairs)):
+            if j in used:
+                continue
+            if boxes_intersect(current["combined_box"],
+                               pairs[j]["combined_box"]):
+                if pairs[j]["area"] > best["area"]:
+                    best = pairs[j]
+                used.add(j)
+        filtered.append(best)
+        used.add(i)
+    return filtered
+
+
+def random_detections(rng):
+    count = rng.integers(0, 16)
+    xy = rng.integers(0, 80, size=(count, 2))
+    size = rng.integers(5, 40, size=(count, 2))
+    conf = rng.choice([0.3, 0.5, 0.7, 0.9], size=(count, 1))
+    cls = rng.choice([0, 0, 1, 2, 3], size=(count, 1))
+    return np.hstack([xy, xy + size, conf, cls]).astype(np.float64)
+
+
+class FindPairsTest(unittest.TestCase):
+    """Матричный поиск пар дает тот же результат, что и циклы"""
+
+    def test_matches_reference_loops(self):
+        rng = np.random.default_rng(0)
+        for case in range(3000):
+            detections = random_detections(rng)
+            expected = reference_pairs(detections, 0.5)
+            found = tool.find_twowheeledhuman_pairs(detections, 0.5)
+            with self.subTest(case=case):
+                self.assertEqual(
+                    [(p["person_box"], p["vehicle_box"],
+                      tuple(p["combined_box"]), p["area"]) for p in found],
+                    [(p["person_box"], p["vehicle_box"],
+                      tuple(p["combined_box"]), p["area"])
+                     for p in expected],
+                )
+
+    def test_no_pairs_without_vehicles(self):
+        detections = np.array([[0, 0, 10, 10, 0.9, 0]], dtype=np.float64)
+        self.assertEqual(tool.find_twowheeledhuman_pairs(detections), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
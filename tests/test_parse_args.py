@@ -0,0 +1,25 @@
+import contextlib
+import io
+import unittest
+
+from tool_loader import load_tool
+
+tool = load_tool()
+
+
+class ParseArgsTest(unittest.TestCase):
+    """Проверка аргументов командной строки"""
+
+    def test_det_conf_above_conf_rejected(self):
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            with self.assertRaises(SystemExit):
+                tool.parse_args(["--conf", "0.3", "--det-conf", "0.5"])
+        self.assertIn("--det-conf", stderr.getvalue())
+
+    def test_det_conf_up_to_conf_accepted(self):
+        args = tool.parse_args(["--conf", "0.5", "--det-conf", "0.5"])
+        self.assertEqual(args.det_conf, 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
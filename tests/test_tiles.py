@@ -0,0 +1,64 @@
+import unittest
+
+import numpy as np
+
+from tool_loader import load_tool
+
+tool = load_tool()
+
+
+def tile_views(objects, tiles):
+    """Рамки объектов так, как их видят тайлы: обрезанные по тайлу"""
+    views = []
+    for x1, y1, x2, y2, conf, cls in objects:
+        for tx1, ty1, tx2, ty2 in tiles:
+            box = [max(x1, tx1), max(y1, ty1), min(x2, tx2), min(y2, ty2)]
+            if box[0] < box[2] and box[1] < box[3]:
+                views.append(box + [conf, cls])
+    return np.array(views, dtype=np.float64)
+
+
+def sort_rows(rows):
+    return sorted(map(tuple, np.asarray(rows).tolist()))
+
+
+class MergeTileDetectionsTest(unittest.TestCase):
+    """Рамки объекта из соседних тайлов сливаются в исходную рамку"""
+
+    def setUp(self):
+        # Тайлы 400x400 с шагом 320: [0, 400], [320, 720], [600, 1000]
+        self.tiles = tool.tile_grid(1000, 400, 400)
+
+    def test_tile_grid_covers_image(self):
+        self.assertEqual(self.tiles[:, [0, 2]].tolist(),
+                         [[0, 400], [320, 720], [600, 1000]])
+        self.assertTrue((self.tiles[:, [1, 3]] == [0, 400]).all())
+
+    def test_cut_objects_restored(self):
+        objects = np.array([
+            [300, 100, 420, 200, 0.9, 0],  # на стыке первых тайлов
+            [310, 120, 400, 190, 0.8, 1],  # там же, другой класс
+            [650, 250, 710, 380, 0.7, 0],  # на стыке вторых тайлов
+            [800, 50, 850, 150, 0.6, 3],  # в одном тайле
+        ])
+        merged = tool.merge_tile_detections(
+            tile_views(objects, self.tiles)
+        )
+        self.assertEqual(sort_rows(merged), sort_rows(objects))
+
+    def test_weak_duplicate_not_in_union(self):
+        detections = np.array([
+            [300, 100, 400, 200, 0.9, 0],
+            [320, 100, 420, 200, 0.8, 0],
+            [280, 100, 400, 200, 0.3, 0],  # слабее половины лучшей
+        ])
+        merged = tool.merge_tile_detections(detections)
+        self.assertEqual(merged.tolist(), [[300, 100, 420, 200, 0.9, 0]])
+
+    def test_empty(self):
+        self.assertEqual(len(tool.merge_tile_detections(np.zeros((0, 6)))),
+                         0)
+
+
+if __name__ == "__main__":
+    unittest.main()
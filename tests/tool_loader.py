@@ -0,0 +1,18 @@
+import importlib.util
+import os
+import sys
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "two-wheeled-humans_annotation_tool.py")
+
+
+def load_tool():
+    """Скрипт разметки как модуль (в имени файла есть дефисы)"""
+    module = sys.modules.get("annotation_tool")
+    if module is None:
+        spec = importlib.util.spec_from_file_location("annotation_tool",
+                                                      SCRIPT)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["annotation_tool"] = module
+        spec.loader.exec_module(module)
+    return module
@@ -1,9 +1,43 @@
 import os
+import sys
+import io
+import json
+import mmap
+import time
+import queue
+import shutil
+import sqlite3
+import tarfile
+import hashlib
+import argparse
+import threading
+import functools
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, as_completed, wait)
+from concurrent.futures.process import BrokenProcessPool
 import cv2
-import tkinter as tk
-from tkinter import filedialog, messagebox
-from PIL import Image, ImageTk
-from ultralytics import YOLO
+import numpy as np
+from PIL import Image
+
+# Tkinter и PIL.ImageTk импортируются только для графического интерфейса
+# (import_gui), поэтому консольные режимы и процессы-исполнители
+# работают и на машинах без Tk
+tk = tkfont = filedialog = messagebox = ttk = ImageTk = None
+
+
+def import_gui():
+    """Импорт Tkinter и PIL.ImageTk перед созданием окна"""
+    global tk, tkfont, filedialog, messagebox, ttk, ImageTk
+    import tkinter as tk
+    import tkinter.font as tkfont
+    from tkinter import filedialog, messagebox, ttk
+    from PIL import ImageTk
+
+
+# Момент запуска программы для замера времени старта интерфейса
+STARTUP_BEGIN = time.perf_counter()
 
 # Константы
 IMAGE_DIR = "dataset/images"
@@ -11,6 +45,3850 @@ LABEL_DIR = "dataset/labels"
 
 YOLO_MODEL = "yolov8s.pt"
 SUPPORTED_FORMATS = (".jpg", ".jpeg", ".png")
+# Движок инференса: torch (веса .pt как есть) или модель, один раз
+# экспортированная в ONNX Runtime / OpenVINO (с INT8 квантованием
+# для вариантов -int8) и сохраненная в STATE_DIR/EXPORT_DIR
+INFERENCE_BACKENDS = ("torch", "onnx", "onnx-int8", "openvino",
+                      "openvino-int8")
+INFERENCE_BACKEND = "torch"
+EXPORT_DIR = "exported"
+EXPORT_IMGSZ = 640
+# Сверка ускоренного движка с torch: рамки совпадают, если у них один
+# класс и IoU не меньше PARITY_MIN_IOU; проверка пройдена, если
+# совпадает не меньше PARITY_MIN_AGREEMENT рамок
+PARITY_MIN_IOU = 0.9
+PARITY_MIN_AGREEMENT = 0.95
+PARITY_SAMPLES = 50
+
+# Служебные файлы инструмента (журнал заданий, кэши)
+STATE_DIR = "dataset/.annotation_tool"
+MANIFEST_FILE = "manifest.jsonl"
+# Каталог изображений: размер, время изменения, наличие разметки
+CATALOG_FILE = "catalog.sqlite"
+# Кэш сырых детекций (до порога уверенности и поиска пар): предельный
+# размер, после какой доли предела новых записей процесс сверяет размер
+# с базой (ее пополняют все процессы разметки) и сколько обращений
+# копить перед записью времени использования
+DETECTION_CACHE_FILE = "detections.sqlite"
+DETECTION_CACHE_MB = 256
+DETECTION_CACHE_CHECK = 0.05
+DETECTION_CACHE_TOUCH_BATCH = 256
+# Уменьшенные копии для отображения: уровни по длинной стороне,
+# предельный размер копий на диске (давно не показанные удаляются),
+# сколько кадров может ждать записи копий (каждый держит в памяти
+# декодированное изображение, лишние пропускаются), число готовых
+# изображений в памяти и соседей для предзагрузки
+THUMBNAIL_DIR = "thumbnails"
+DISPLAY_LEVELS = (640, 1280, 1920)
+THUMBNAIL_CACHE_MB = 512
+THUMBNAIL_PENDING_SAVES = 2
+DISPLAY_MEMORY_ITEMS = 16
+DISPLAY_PREFETCH = 2
+# Пауза после последнего изменения размера окна перед качественной
+# перерисовкой изображения (мс)
+RESIZE_DEBOUNCE_MS = 150
+
+# Классы COCO, которые участвуют в поиске пар
+PERSON_CLASS = 0
+BICYCLE_CLASS = 1
+MOTORCYCLE_CLASS = 3
+CONF_THRESHOLD = 0.5  # Минимальная уверенность предсказания
+RELEVANT_CLASSES = (PERSON_CLASS, BICYCLE_CLASS, MOTORCYCLE_CLASS)
+# Параметры вызова детектора (см. DetectorConfig): порог уверенности
+# и IoU для NMS внутри модели и размер входа модели. Порог детектора
+# ниже CONF_THRESHOLD, чтобы кэш детекций годился и для более низкого
+# порога поиска пар
+DETECTOR_CONF = 0.25
+DETECTOR_IOU = 0.7
+DETECTOR_IMGSZ = 640
+
+# Инференс по тайлам для больших снимков (4K, дроны): размер тайла,
+# доля перекрытия соседних тайлов и во сколько раз длинная сторона
+# изображения должна превышать тайл, чтобы тайлы включились
+TILE_SIZE = 640
+TILE_OVERLAP = 0.2
+TILE_MIN_SCALE = 2
+# Порог уверенности грубого прохода по целому (уменьшенному моделью)
+# изображению: тайлы без единой такой рамки пропускаются
+TILE_PROBE_CONF = 0.05
+# Слияние рамок одного класса на стыках тайлов: пересечение, деленное
+# на меньшую площадь, и минимальная доля уверенности от лучшей рамки
+# группы для участия в объединенной рамке
+TILE_MERGE_IOMIN = 0.5
+TILE_MERGE_CONF_RATIO = 0.5
+
+# Тег EXIF с ориентацией снимка
+EXIF_ORIENTATION = 0x0112
+
+# Как часто печатать прогресс в консольном режиме (в изображениях)
+HEADLESS_REPORT_EVERY = 50
+# Сколько изображений подавать в модель за один вызов
+BATCH_SIZE = 8
+# Сколько изображений декодировать заранее, пока работает модель,
+# и предел памяти под них (МБ). Декодированное изображение занимает
+# ширина * высота * 3 байт: 24 Мп - около 72 МБ, 1920x1080 - около 6 МБ
+PREFETCH_IMAGES = 2 * BATCH_SIZE
+PREFETCH_MB = 1024
+DECODE_WORKERS = 4
+# Максимальная очередь файлов разметки на запись
+WRITE_QUEUE_SIZE = 256
+# Фоновая запись разметки: сколько файлов накапливать и сколько секунд
+# ждать перед сбросом на диск, и когда вызывать fsync: never - не
+# вызывать, batch - для данных каждого файла и один раз для папки
+# на сброс, always - для файла и папки после каждого файла
+LABEL_FLUSH_BATCH = 64
+LABEL_FLUSH_SECONDS = 0.5
+LABEL_FSYNC_POLICIES = ("never", "batch", "always")
+LABEL_FSYNC = "batch"
+# Упакованная разметка для очень больших прогонов: вместо отдельных
+# .txt строки JSON Lines в одном файле в папке разметки
+LABEL_PACK_FILE = "labels.pack.jsonl"
+# Многопроцессная разметка: число процессов (1 - без пула процессов)
+# и размер задания для одного процесса
+WORKERS = 1
+SHARD_SIZE = 32
+# Кадры из видео: форматы файлов, шаг по кадрам и минимальное отличие
+# от предыдущего обработанного кадра (средняя разница яркости уменьшенных
+# копий, 0..1); почти одинаковые кадры в модель не подаются
+VIDEO_FORMATS = (".mp4", ".avi", ".mov", ".mkv")
+VIDEO_FRAME_STRIDE = 5
+VIDEO_MIN_CHANGE = 0.02
+VIDEO_SIGNATURE_SIZE = 32
+VIDEO_JPEG_QUALITY = 95
+# Последовательности кадров: детектор запускается на каждом N-м
+# обработанном кадре (1 - на каждом), между ними рамки переносятся
+# оптическим потоком. Детектор запускается раньше, если доля надежно
+# отслеженных точек какой-либо рамки меньше порога
+VIDEO_KEYFRAME_INTERVAL = 10
+TRACK_POINTS = 24  # Точек на рамку
+TRACK_FB_ERROR = 1.0  # Допустимая ошибка прямого-обратного потока (пикс.)
+TRACK_MIN_CONFIDENCE = 0.5
+# Упакованный набор данных для передачи на обучение: шарды tar в стиле
+# WebDataset (<ключ>.<расширение изображения> + <ключ>.txt) размером
+# не больше DATASET_SHARD_MB и индекс со смещениями и хэшами файлов
+DATASET_SHARD_MB = 1024
+DATASET_SHARD_PATTERN = "shard-{:06d}.tar"
+DATASET_INDEX_FILE = "index.json"
+# Добавление изображений: способ переноса файлов (copy - копирование;
+# reflink - копия с общими блоками там, где файловая система это умеет,
+# иначе копирование; hardlink - жесткая ссылка на той же файловой системе,
+# файл общий с источником) и число потоков
+IMPORT_MODES = ("copy", "reflink", "hardlink")
+IMPORT_MODE = "reflink"
+IMPORT_WORKERS = 4
+FICLONE = 0x40049409  # ioctl Linux для копии с общими блоками
+# Похожие изображения (почти дубликаты): перцептивный хэш dHash из
+# PHASH_SIZE x PHASH_SIZE бит и наибольшее расстояние Хэмминга между
+# хэшами похожих. По запросу (--near-duplicates, переключатель в
+# интерфейсе) массовая разметка запускает модель на одном изображении
+# из группы похожих, остальным переносит его разметку - только если
+# соотношение сторон совпадает с точностью NEAR_DUPLICATE_ASPECT
+# (нормированные рамки YOLO верны для копии другого размера, но не для
+# обрезанной)
+PHASH_SIZE = 8
+NEAR_DUPLICATE_DISTANCE = 4
+NEAR_DUPLICATE_ASPECT = 0.01
+# Индекс всех рамок разметки для статистики и фильтров списка: таблица
+# NumPy на диске (открывается через memmap), минимальный размер в строках
+# и границы гистограмм площади (доля изображения) и ширины / высоты
+LABEL_INDEX_FILE = "label_index.npy"
+LABEL_INDEX_MIN_ROWS = 4096
+LABEL_AREA_BINS = (0, 0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1)
+LABEL_ASPECT_BINS = (0, 0.25, 0.5, 1, 2, 4, np.inf)
+# Фильтры списка изображений: название и условия LabelIndex.query
+# (near_duplicates - группы похожих изображений подряд)
+LIST_FILTERS = (
+    ("Все изображения", None),
+    ("Одна пара", {"min_boxes": 1, "max_boxes": 1}),
+    ("Больше трех пар", {"min_boxes": 4}),
+    ("Рамки меньше 1% площади", {"max_area": 0.01}),
+    ("Вытянутые рамки (шире в 2 раза)", {"min_aspect": 2.0}),
+    ("Похожие изображения (группами)", "near_duplicates"),
+)
+
+
+def boxes_intersect(box1, box2):
+    """Проверяет, пересекаются ли два прямоугольника"""
+    x1_min, y1_min, x1_max, y1_max = box1
+    x2_min, y2_min, x2_max, y2_max = box2
+
+    # Проверяем пересечение по оси X
+    x_intersect = (x1_min <= x2_max) and (x1_max >= x2_min)
+
+    # Проверяем пересечение по оси Y
+    y_intersect = (y1_min <= y2_max) and (y1_max >= y2_min)
+
+    return x_intersect and y_intersect
+
+
+def combine_boxes(box1, box2):
+    """Объединяет два прямоугольника в один, который их покрывает"""
+    x1_min, y1_min, x1_max, y1_max = box1
+    x2_min, y2_min, x2_max, y2_max = box2
+
+    new_x_min = min(x1_min, x2_min)
+    new_y_min = min(y1_min, y2_min)
+    new_x_max = max(x1_max, x2_max)
+    new_y_max = max(y1_max, y2_max)
+
+    return (new_x_min, new_y_min, new_x_max, new_y_max)
+
+
+def calculate_area(box):
+    """Вычисляет площадь прямоугольника"""
+    x1, y1, x2, y2 = box
+    return (x2 - x1) * (y2 - y1)
+
+
+def extract_detections(results):
+    """Предсказания YOLO одним массивом NumPy
+
+    Каждая строка: x1, y1, x2, y2, уверенность, класс. Тензоры
+    переносятся на CPU один раз для всего результата, а не по боксу.
+    """
+    arrays = [result.boxes.data.cpu().numpy() for result in results]
+    arrays = [a for a in arrays if len(a)]
+    if not arrays:
+        return np.zeros((0, 6), dtype=np.float64)
+    return np.concatenate(arrays).astype(np.float64)
+
+
+def relevant_detections(results, classes=RELEVANT_CLASSES):
+    """Детекции только тех классов, которые участвуют в поиске пар
+
+    Модель уже получает список классов, фильтр страхует от движков,
+    которые его не учитывают.
+    """
+    found = extract_detections(results)
+    return found[np.isin(found[:, 5], classes)]
+
+
+class DetectorConfig:
+    """Параметры вызова детектора
+
+    classes передаются в модель, поэтому NMS и постобработка ultralytics
+    разбирают только людей, велосипеды и мотоциклы, а не все 80 классов
+    COCO. conf и iou - пороги NMS модели, imgsz - размер входа модели,
+    tile_size - размер тайла для больших изображений (0 - без тайлов).
+    """
+
+    def __init__(self, classes=RELEVANT_CLASSES, conf=DETECTOR_CONF,
+                 iou=DETECTOR_IOU, imgsz=DETECTOR_IMGSZ, tile_size=0):
+        self.classes = tuple(sorted(int(c) for c in classes))
+        self.conf = conf
+        self.iou = iou
+        self.imgsz = imgsz
+        self.tile_size = tile_size
+
+    def model_kwargs(self, **overrides):
+        """Аргументы вызова модели ultralytics"""
+        kwargs = {
+            "classes": list(self.classes),
+            "conf": self.conf,
+            "iou": self.iou,
+            "imgsz": self.imgsz,
+            "verbose": False,
+        }
+        kwargs.update(overrides)
+        return kwargs
+
+    def uses_tiles(self, frame):
+        """Размечать ли изображение по тайлам
+
+        Тайлы нужны, только если длинная сторона изображения хотя бы
+        в TILE_MIN_SCALE раз больше тайла.
+        """
+        return (self.tile_size > 0
+                and max(frame.size) >= self.tile_size * TILE_MIN_SCALE)
+
+    def base_signature(self):
+        classes = ",".join(str(c) for c in self.classes)
+        return (f"classes={classes}:conf={self.conf}:iou={self.iou}:"
+                f"imgsz={self.imgsz}")
+
+    def signature(self):
+        """Параметры детектора одной строкой для журнала заданий"""
+        return f"{self.base_signature()}:tiles={self.tile_size}"
+
+    def cache_variant(self, frame):
+        """Параметры детектора для ключа кэша конкретного изображения
+
+        Небольшие изображения размечаются целиком и в режиме тайлов,
+        поэтому их детекции в кэше общие для обоих режимов.
+        """
+        if self.uses_tiles(frame):
+            return self.signature()
+        return self.base_signature()
+
+
+def intersection_matrix(boxes1, boxes2):
+    """Матрица пересечений двух наборов прямоугольников (N1 x N2)
+
+    Те же условия, что и в boxes_intersect, но для всех пар сразу.
+    """
+    boxes1 = boxes1[:, None, :]
+    boxes2 = boxes2[None, :, :]
+    x_intersect = ((boxes1[..., 0] <= boxes2[..., 2])
+                   & (boxes1[..., 2] >= boxes2[..., 0]))
+    y_intersect = ((boxes1[..., 1] <= boxes2[..., 3])
+                   & (boxes1[..., 3] >= boxes2[..., 1]))
+    return x_intersect & y_intersect
+
+
+def iou_matrix(boxes1, boxes2):
+    """Матрица IoU двух наборов прямоугольников (N1 x N2)"""
+    width = (np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+             - np.maximum(boxes1[:, None, 0], boxes2[None, :, 0]))
+    height = (np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+              - np.maximum(boxes1[:, None, 1], boxes2[None, :, 1]))
+    inter = np.clip(width, 0, None) * np.clip(height, 0, None)
+    areas1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    areas2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    union = areas1[:, None] + areas2[None, :] - inter
+    return inter / np.maximum(union, 1e-9)
+
+
+def suppress_duplicate_boxes(boxes, areas):
+    """Индексы прямоугольников, оставшихся после фильтра дубликатов
+
+    Для каждого еще не поглощенного прямоугольника (в исходном порядке)
+    из него и всех последующих пересекающихся с ним остается один
+    с наибольшей площадью, остальные считаются дубликатами.
+    """
+    count = len(boxes)
+    intersects = intersection_matrix(boxes, boxes)
+    later = np.triu(np.ones((count, count), dtype=bool))
+    candidates = intersects & later
+    used = np.zeros(count, dtype=bool)
+    keep = []
+
+    for i in range(count):
+        if used[i]:
+            continue
+        group = candidates[i] & ~used
+        group[i] = True
+        members = np.flatnonzero(group)
+        # argmax берет первый максимум, как и строгое сравнение площадей
+        keep.append(members[np.argmax(areas[members])])
+        used |= group
+
+    return keep
+
+
+def find_twowheeledhuman_pairs(detections, conf_threshold=CONF_THRESHOLD):
+    """Ищет пары человек-велосипед и человек-мотоцикл без дубликатов
+
+    detections - массив из extract_detections. Пересечения, объединенные
+    прямоугольники и площади считаются матрично для всех пар сразу.
+    """
+    # Фильтр по уверенности (только уверенные предсказания)
+    detections = detections[detections[:, 4] >= conf_threshold]
+    classes = detections[:, 5].astype(int)
+    person_boxes = detections[classes == PERSON_CLASS, :4]
+
+    person_parts = []
+    vehicle_parts = []
+    # Сначала пары человек-велосипед, затем человек-мотоцикл
+    for vehicle_class in (BICYCLE_CLASS, MOTORCYCLE_CLASS):
+        vehicle_boxes = detections[classes == vehicle_class, :4]
+        person_idx, vehicle_idx = np.nonzero(
+            intersection_matrix(person_boxes, vehicle_boxes)
+        )
+        person_parts.append(person_boxes[person_idx])
+        vehicle_parts.append(vehicle_boxes[vehicle_idx])
+
+    pair_person = np.concatenate(person_parts)
+    pair_vehicle = np.concatenate(vehicle_parts)
+    if not len(pair_person):
+        return []
+
+    combined = np.concatenate(
+        [np.minimum(pair_person[:, :2], pair_vehicle[:, :2]),
+         np.maximum(pair_person[:, 2:], pair_vehicle[:, 2:])],
+        axis=1,
+    )
+    areas = ((combined[:, 2] - combined[:, 0])
+             * (combined[:, 3] - combined[:, 1]))
+
+    return [
+        {
+            "type": "twowheeledhuman",
+            "person_box": pair_person[i].tolist(),
+            "vehicle_box": pair_vehicle[i].tolist(),
+            "combined_box": tuple(combined[i].tolist()),
+            "area": float(areas[i]),
+        }
+        for i in suppress_duplicate_boxes(combined, areas)
+    ]
+
+
+def fsync_dir(path):
+    """fsync папки, чтобы переименование файла пережило сбой питания
+
+    На Windows папку так открыть нельзя, там шаг пропускается.
+    """
+    try:
+        fd = os.open(path or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def write_text_atomic(path, text, fsync=False):
+    """Запись файла через временный файл и os.replace
+
+    При падении посередине записи на месте остается старый файл
+    целиком, а не обрезанный. fsync - сбросить данные на диск до
+    переименования. text может быть и bytes (пишется как есть).
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb" if isinstance(text, bytes) else "w") as f:
+            f.write(text)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def parse_class_id(text):
+    """Номер класса из строки ("1" или "1.0")
+
+    Дробные и отрицательные номера не округляются, а отклоняются
+    (ValueError), чтобы при сохранении не записался другой класс.
+    """
+    value = float(text)
+    if not value.is_integer() or value < 0:
+        raise ValueError(f"Класс должен быть целым неотрицательным "
+                         f"числом: {text}")
+    return int(value)
+
+
+class AnnotationStore:
+    """Аннотации одного изображения в столбцах NumPy
+
+    classes - номера классов (int), boxes - YOLO координаты
+    (x_center, y_center, width, height, относительные), person_boxes
+    и vehicle_boxes - исходные рамки человека и транспорта в пикселях
+    для найденных пар (NaN для аннотаций, добавленных вручную).
+    Преобразования в пиксели и строки файла разметки выполняются
+    сразу для всех аннотаций.
+    """
+
+    # Класс 0 для всех двух колесных людей
+    TWOWHEELEDHUMAN_CLASS = 0
+
+    def __init__(self, classes=None, boxes=None, person_boxes=None,
+                 vehicle_boxes=None):
+        self.classes = np.asarray(
+            classes if classes is not None else [], dtype=np.int64
+        ).reshape(-1)
+        count = len(self.classes)
+        self.boxes = self._column(boxes, count)
+        self.person_boxes = self._column(person_boxes, count)
+        self.vehicle_boxes = self._column(vehicle_boxes, count)
+
+    @staticmethod
+    def _column(values, count):
+        if values is None:
+            return np.full((count, 4), np.nan)
+        return np.asarray(values, dtype=np.float64).reshape(count, 4)
+
+    def __len__(self):
+        return len(self.classes)
+
+    @classmethod
+    def from_pixel_xyxy(cls, xyxy, img_width, img_height, classes=None,
+                        person_boxes=None, vehicle_boxes=None):
+        """Из рамок в пикселях (x1, y1, x2, y2)"""
+        xyxy = np.asarray(xyxy, dtype=np.float64).reshape(-1, 4)
+        size = np.array([img_width, img_height, img_width, img_height],
+                        dtype=np.float64)
+        boxes = np.concatenate(
+            [(xyxy[:, :2] + xyxy[:, 2:]) / 2, xyxy[:, 2:] - xyxy[:, :2]],
+            axis=1,
+        ) / size
+        if classes is None:
+            classes = np.full(len(xyxy), cls.TWOWHEELEDHUMAN_CLASS)
+        return cls(classes, boxes, person_boxes, vehicle_boxes)
+
+    @classmethod
+    def from_pairs(cls, pairs, img_width, img_height):
+        """Из найденных пар: объединенная рамка становится аннотацией"""
+        if not pairs:
+            return cls()
+        return cls.from_pixel_xyxy(
+            [pair["combined_box"] for pair in pairs],
+            img_width, img_height,
+            person_boxes=[pair["person_box"] for pair in pairs],
+            vehicle_boxes=[pair["vehicle_box"] for pair in pairs],
+        )
+
+    @classmethod
+    def from_yolo_lines(cls, lines):
+        """Из строк файла разметки (некорректные строки пропускаются)"""
+        classes = []
+        boxes = []
+        for line in lines:
+            parts = line.split()
+            if len(parts) != 5:
+                continue
+            try:
+                class_id = parse_class_id(parts[0])
+                box = [float(part) for part in parts[1:]]
+            except ValueError:
+                continue
+            classes.append(class_id)
+            boxes.append(box)
+        if not boxes:
+            return cls()
+        return cls(np.array(classes, dtype=np.int64),
+                   np.array(boxes, dtype=np.float64))
+
+    @classmethod
+    def load(cls, label_path):
+        """Чтение файла разметки (пустой набор, если файла нет)"""
+        if not os.path.exists(label_path):
+            return cls()
+        with open(label_path, "r") as f:
+            return cls.from_yolo_lines(f)
+
+    def to_pixel_xyxy(self, img_width, img_height):
+        """Рамки в пикселях (x1, y1, x2, y2) для всех аннотаций"""
+        size = np.array([img_width, img_height], dtype=np.float64)
+        centers = self.boxes[:, :2] * size
+        half = self.boxes[:, 2:] * size / 2
+        return np.concatenate([centers - half, centers + half], axis=1)
+
+    def format_row(self, index):
+        """Строка файла разметки для одной аннотации"""
+        x_center, y_center, width, height = self.boxes[index]
+        return (f"{self.classes[index]} {x_center:.6f} {y_center:.6f} "
+                f"{width:.6f} {height:.6f}")
+
+    def to_yolo_lines(self):
+        """Строки файла разметки для всех аннотаций"""
+        return [self.format_row(i) for i in range(len(self))]
+
+    def to_text(self):
+        """Содержимое файла разметки"""
+        return "".join(line + "\n" for line in self.to_yolo_lines())
+
+    def save(self, label_path, fsync=False):
+        """Атомарная запись файла разметки"""
+        write_text_atomic(label_path, self.to_text(), fsync)
+
+    def append(self, class_id, box):
+        """Добавление аннотации, введенной вручную"""
+        self.classes = np.append(self.classes, class_id)
+        self.boxes = np.vstack([self.boxes, box])
+        self.person_boxes = np.vstack([self.person_boxes,
+                                       np.full(4, np.nan)])
+        self.vehicle_boxes = np.vstack([self.vehicle_boxes,
+                                        np.full(4, np.nan)])
+
+    def replace(self, index, class_id, box):
+        """Замена аннотации (исходные рамки пары больше не актуальны)"""
+        self.classes[index] = class_id
+        self.boxes[index] = box
+        self.person_boxes[index] = np.nan
+        self.vehicle_boxes[index] = np.nan
+
+    def delete(self, index):
+        self.classes = np.delete(self.classes, index)
+        self.boxes = np.delete(self.boxes, index, axis=0)
+        self.person_boxes = np.delete(self.person_boxes, index, axis=0)
+        self.vehicle_boxes = np.delete(self.vehicle_boxes, index, axis=0)
+
+    def has_source_boxes(self):
+        """Маска аннотаций, у которых есть исходные рамки пары"""
+        return ~(np.isnan(self.person_boxes).any(axis=1)
+                 | np.isnan(self.vehicle_boxes).any(axis=1))
+
+
+def label_path_for(label_dir, filename):
+    """Путь к файлу разметки для изображения"""
+    label_file = os.path.splitext(filename)[0] + ".txt"
+    return os.path.join(label_dir, label_file)
+
+
+def model_signature(model_path, backend="torch"):
+    """Идентификатор весов модели: имя и хэш содержимого файла
+
+    Для ускоренных движков добавляется их название: их результаты
+    немного отличаются от torch.
+    """
+    name = os.path.basename(model_path)
+    if os.path.isfile(model_path):
+        digest = hashlib.sha1()
+        with open(model_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        name = f"{name}:{digest.hexdigest()[:16]}"
+    return name if backend == "torch" else f"{name}:{backend}"
+
+
+def resolve_model_path(model_path):
+    """Путь к локальному файлу весов
+
+    Стандартные веса ultralytics (например, yolov8s.pt) при первом
+    запуске скачиваются, а потом берутся из папки весов ultralytics.
+    Подпись модели включает хэш файла, поэтому ее нужно считать по этому
+    пути, а не по имени: иначе журнал и кэш первого запуска получили бы
+    подпись без хэша, и следующий запуск разметил бы все заново.
+    """
+    if os.path.isfile(model_path):
+        return model_path
+    from ultralytics.utils.downloads import attempt_download_asset
+
+    return str(attempt_download_asset(model_path))
+
+
+def exported_model_path(model_path, backend, export_dir):
+    """Путь к экспортированной модели в кэше экспорта
+
+    В имени - хэш весов, поэтому после замены весов модель
+    экспортируется заново. Суффиксы нужны ultralytics для выбора
+    движка при загрузке.
+    """
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    digest = model_signature(model_path).rpartition(":")[2]
+    name = f"{stem}-{digest}-{backend}"
+    if backend.startswith("openvino"):
+        return os.path.join(export_dir, name + "_openvino_model")
+    return os.path.join(export_dir, name + ".onnx")
+
+
+def export_model(model_path, backend, export_dir):
+    """Экспорт модели для движка backend, если его еще нет в кэше
+
+    ultralytics сохраняет результат рядом с весами, поэтому он
+    переносится в export_dir. INT8 для OpenVINO делает сам ultralytics
+    (калибровка на его стандартном наборе), для ONNX - динамическое
+    квантование весов onnxruntime.
+    """
+    target = exported_model_path(model_path, backend, export_dir)
+    if os.path.exists(target):
+        return target
+
+    from ultralytics import YOLO
+
+    fmt = backend.split("-")[0]
+    int8 = backend.endswith("-int8")
+    print(f"Экспорт {model_path} для {backend}...")
+    exported = YOLO(model_path).export(
+        format=fmt, imgsz=EXPORT_IMGSZ, dynamic=True,
+        int8=int8 and fmt == "openvino",
+    )
+    os.makedirs(export_dir, exist_ok=True)
+    tmp_path = target + ".tmp"
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    if int8 and fmt == "onnx":
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantize_dynamic(exported, tmp_path, weight_type=QuantType.QUInt8)
+        os.remove(exported)
+    else:
+        shutil.move(exported, tmp_path)
+    # Экспорт, прерванный на середине, не попадает в кэш
+    os.replace(tmp_path, target)
+    return target
+
+
+def load_yolo(model_path, backend="torch",
+              export_dir=os.path.join(STATE_DIR, EXPORT_DIR)):
+    """Загрузка модели YOLO
+
+    ultralytics (вместе с torch) импортируется только здесь, чтобы
+    интерфейс запускался без ожидания тяжелых библиотек. Для ускоренных
+    движков загружается экспортированная модель (при первом запуске
+    она создается export_model); вызов модели и ее результаты такие же,
+    как у torch.
+    """
+    from ultralytics import YOLO
+
+    model_path = resolve_model_path(model_path)
+    if backend == "torch":
+        return YOLO(model_path)
+    return YOLO(export_model(model_path, backend, export_dir), task="detect")
+
+
+class ModelLoader:
+    """Фоновая загрузка модели YOLO
+
+    Поток загружает веса, пока интерфейс уже работает; готовность
+    сообщается через событие ready, ошибка загрузки сохраняется в error.
+    signature - подпись загруженных (при необходимости скачанных) весов
+    для журнала и кэша детекций.
+    """
+
+    def __init__(self, model_path=YOLO_MODEL, backend=INFERENCE_BACKEND):
+        self.model_path = model_path
+        self.backend = backend
+        self.model = None
+        self.signature = None
+        self.error = None
+        self.load_seconds = None
+        self.ready = threading.Event()
+        self._thread = threading.Thread(target=self._load, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _load(self):
+        start = time.perf_counter()
+        try:
+            model_path = resolve_model_path(self.model_path)
+            self.model = load_yolo(model_path, self.backend)
+            self.signature = model_signature(model_path, self.backend)
+        except Exception as e:
+            self.error = e
+        self.load_seconds = time.perf_counter() - start
+        self.ready.set()
+
+
+class JobManifest:
+    """Журнал массовой разметки на диске
+
+    Для каждого изображения хранит статус (done - разметка уже была,
+    positive - найдены пары, negative - пар нет, error - ошибка), размер
+    и время изменения файла, модель, порог уверенности и параметры
+    детектора (DetectorConfig.signature). Записи
+    дописываются построчно в JSON Lines, поэтому прерывание или падение
+    не теряет уже обработанные изображения; последняя запись
+    по изображению главнее предыдущих.
+    """
+
+    # Статусы, при которых повторная разметка не нужна
+    FINISHED = ("done", "positive", "negative")
+
+    def __init__(self, path, model_path=YOLO_MODEL,
+                 conf_threshold=CONF_THRESHOLD, detector=None,
+                 backend=INFERENCE_BACKEND):
+        self.path = path
+        self.model = model_signature(model_path, backend)
+        self.conf_threshold = conf_threshold
+        self.detector = (detector or DetectorConfig()).signature()
+        # Разметка пишется в упакованный файл, а не в отдельные .txt
+        self.packed = False
+        self.records = {}
+        self._file = None
+        # record вызывается и из потока записи разметки (LabelWriterThread)
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Чтение журнала, при большом числе устаревших строк - сжатие"""
+        self.records = {}
+        lines = 0
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Недописанная строка после падения
+                    self.records[record["image"]] = record
+                    lines += 1
+
+        if lines > 2 * len(self.records) + 1000:
+            self.compact()
+
+    def compact(self):
+        """Перезапись журнала только с актуальными записями"""
+        self.close()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in self.records.values():
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def needs_processing(self, image_dir, label_dir, filename):
+        """Нужно ли (повторно) размечать изображение
+
+        Пропускаются изображения, которые уже обработаны той же моделью
+        с тем же порогом и параметрами детектора и не изменились с тех
+        пор. Для positive файл разметки еще должен существовать (кроме
+        упакованной разметки, которая еще не распакована). Разметку,
+        проверенную человеком (done), не меняет смена модели и
+        параметров - только изменение самого изображения.
+        """
+        record = self.records.get(filename)
+        if not record or record["status"] not in self.FINISHED:
+            return True
+        if record["status"] != "done" and (
+                record["model"] != self.model
+                or record["conf"] != self.conf_threshold
+                or record.get("detector") != self.detector):
+            return True
+        if (record["status"] == "positive" and not record.get("packed")
+                and not os.path.exists(label_path_for(label_dir, filename))):
+            return True
+        try:
+            stat = os.stat(os.path.join(image_dir, filename))
+        except OSError:
+            return True
+        return (record["size"] != stat.st_size
+                or record["mtime_ns"] != stat.st_mtime_ns)
+
+    def record(self, image_dir, filename, status, pairs=0, error=None,
+               duplicate_of=None):
+        """Добавить в журнал результат обработки изображения
+
+        duplicate_of - похожее изображение, с которого перенесена разметка.
+        """
+        try:
+            stat = os.stat(os.path.join(image_dir, filename))
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+        except OSError:
+            size, mtime_ns = None, None
+
+        record = {
+            "image": filename,
+            "status": status,
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "model": self.model,
+            "conf": self.conf_threshold,
+            "detector": self.detector,
+            "pairs": pairs,
+        }
+        if error is not None:
+            record["error"] = error
+        if duplicate_of is not None:
+            record["duplicate_of"] = duplicate_of
+        if self.packed and status == "positive":
+            record["packed"] = True
+        with self._lock:
+            self.records[filename] = record
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path) or ".",
+                            exist_ok=True)
+                self._file = open(self.path, "a", encoding="utf-8",
+                                  buffering=1)
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def file_sha1(path):
+    """SHA-1 содержимого файла (читается блоками по 1 МБ)"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def count_annotations(label_path):
+    """Число строк-аннотаций в файле разметки (0, если файла нет)"""
+    try:
+        with open(label_path, "r") as f:
+            return sum(1 for line in f if len(line.split()) == 5)
+    except OSError:
+        return 0
+
+
+def perceptual_hash(data):
+    """Перцептивный хэш dHash закодированного изображения (int, 64 бита)
+
+    Бит - ярче ли пиксель своего правого соседа в копии 9x8 оттенков
+    серого. Хэш почти не меняется от пережатия, изменения размера и
+    небольших правок, поэтому похожие изображения различаются в
+    нескольких битах. JPEG сразу декодируется в 1/8 размера.
+    """
+    gray = cv2.imdecode(data, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if gray is None or not gray.size:
+        return None
+    small = cv2.resize(gray, (PHASH_SIZE + 1, PHASH_SIZE),
+                       interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming_distance(hash1, hash2):
+    """Число различающихся битов двух хэшей"""
+    return (hash1 ^ hash2).bit_count()
+
+
+class BKTree:
+    """Дерево Буркхарда-Келлера для поиска хэшей по расстоянию Хэмминга
+
+    Узел - [хэш, имена, {расстояние: дочерний узел}]. Поиск обходит
+    только ветви, которые по неравенству треугольника могут содержать
+    хэши не дальше max_distance, а не все хэши подряд.
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, name):
+        if self.root is None:
+            self.root = [value, [name], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].append(name)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [name], {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """Найденные имена: [(расстояние, имя)] по возрастанию расстояния"""
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                found.extend((distance, name) for name in node[1])
+            for child_distance, child in node[2].items():
+                if abs(child_distance - distance) <= max_distance:
+                    stack.append(child)
+        return sorted(found)
+
+
+class ImageCatalog:
+    """Постоянный индекс изображений и их разметки в SQLite
+
+    Для каждого изображения хранит размер, время изменения, наличие
+    файла разметки и число аннотаций в нем. refresh обновляет индекс
+    инкрементально: обе папки просматриваются через os.scandir и для
+    каждого файла сравниваются размер и время изменения, поэтому
+    замечаются и правки файлов на месте (время изменения папки при этом
+    не меняется). Файлы разметки перечитываются только новые или
+    измененные, в базу пишутся только изменения.
+    """
+
+    def __init__(self, path, image_dir=IMAGE_DIR, label_dir=LABEL_DIR,
+                 supported_formats=SUPPORTED_FORMATS):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.image_dir = image_dir
+        self.label_dir = label_dir
+        self.supported_formats = supported_formats
+        self.connection = sqlite3.connect(path, timeout=30)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS images ("
+                "name TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                "labeled INTEGER NOT NULL DEFAULT 0, "
+                "annotations INTEGER NOT NULL DEFAULT 0, "
+                "label_mtime_ns INTEGER, sha1 TEXT, dhash INTEGER)"
+            )
+            # Индекс, созданный до появления хэшей содержимого
+            columns = [row[1] for row in self.connection.execute(
+                "PRAGMA table_info(images)"
+            )]
+            for column, column_type in (("sha1", "TEXT"),
+                                        ("dhash", "INTEGER")):
+                if column not in columns:
+                    self.connection.execute(
+                        f"ALTER TABLE images ADD COLUMN {column} "
+                        f"{column_type}"
+                    )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS meta ("
+                "key TEXT PRIMARY KEY, value TEXT)"
+            )
+
+        # Индекс построен для других папок - начинаем заново
+        if (self.get_meta("image_dir") != os.path.abspath(image_dir)
+                or self.get_meta("label_dir") != os.path.abspath(label_dir)):
+            with self.connection:
+                self.connection.execute("DELETE FROM images")
+                self.connection.execute("DELETE FROM meta")
+                self.set_meta("image_dir", os.path.abspath(image_dir))
+                self.set_meta("label_dir", os.path.abspath(label_dir))
+
+    def get_meta(self, key):
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, str(value))
+        )
+
+    def refresh(self):
+        """Инкрементальное обновление индекса по содержимому папок"""
+        with self.connection:
+            self._refresh_images()
+            self._refresh_labels()
+
+    def _refresh_images(self):
+        """Синхронизация списка изображений с папкой"""
+        known = {
+            name: (size, mtime_ns)
+            for name, size, mtime_ns in self.connection.execute(
+                "SELECT name, size, mtime_ns FROM images"
+            )
+        }
+        found = set()
+        changed = []
+        with os.scandir(self.image_dir) as entries:
+            for entry in entries:
+                if not entry.name.lower().endswith(self.supported_formats):
+                    continue
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                found.add(entry.name)
+                if known.get(entry.name) != (stat.st_size,
+                                             stat.st_mtime_ns):
+                    changed.append(
+                        (entry.name, stat.st_size, stat.st_mtime_ns)
+                    )
+
+        self.connection.executemany(
+            "INSERT INTO images (name, size, mtime_ns) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET "
+            "size = excluded.size, mtime_ns = excluded.mtime_ns, "
+            "sha1 = NULL, dhash = NULL",
+            changed,
+        )
+        self.connection.executemany(
+            "DELETE FROM images WHERE name = ?",
+            [(name,) for name in known if name not in found],
+        )
+
+    def _refresh_labels(self):
+        """Обновление признака разметки и числа аннотаций"""
+        label_mtimes = {}
+        with os.scandir(self.label_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(".txt") and entry.is_file():
+                    label_mtimes[entry.name[:-4]] = entry.stat().st_mtime_ns
+
+        updates = []
+        for name, labeled, label_mtime in self.connection.execute(
+            "SELECT name, labeled, label_mtime_ns FROM images"
+        ).fetchall():
+            mtime = label_mtimes.get(os.path.splitext(name)[0])
+            if mtime is None:
+                if labeled:
+                    updates.append((0, 0, None, name))
+            elif mtime != label_mtime:
+                label_path = label_path_for(self.label_dir, name)
+                updates.append((1, count_annotations(label_path),
+                                mtime, name))
+
+        self.connection.executemany(
+            "UPDATE images SET labeled = ?, annotations = ?, "
+            "label_mtime_ns = ? WHERE name = ?",
+            updates,
+        )
+
+    def rows(self):
+        """Отсортированный список (имя, размечено, число аннотаций)"""
+        return [
+            (name, bool(labeled), annotations)
+            for name, labeled, annotations in self.connection.execute(
+                "SELECT name, labeled, annotations FROM images ORDER BY name"
+            )
+        ]
+
+    def labeled(self):
+        """Размеченные изображения: (имя, размер, число аннотаций)"""
+        return list(self.connection.execute(
+            "SELECT name, size, annotations FROM images WHERE labeled = 1 "
+            "ORDER BY name"
+        ))
+
+    def unlabeled(self):
+        """Отсортированный список изображений без файла разметки"""
+        return [
+            name for (name,) in self.connection.execute(
+                "SELECT name FROM images WHERE labeled = 0 ORDER BY name"
+            )
+        ]
+
+    def sizes(self):
+        """Множество размеров файлов изображений"""
+        return {size for (size,) in self.connection.execute(
+            "SELECT DISTINCT size FROM images"
+        )}
+
+    def content_hashes(self, sizes, workers=1):
+        """SHA-1 изображений с размерами из sizes: {хэш: имя}
+
+        Недостающие хэши считаются в пуле потоков и сохраняются,
+        поэтому каждое изображение хэшируется один раз.
+        """
+        hashes = {}
+        missing = []
+        for name, size, sha1 in self.connection.execute(
+            "SELECT name, size, sha1 FROM images"
+        ).fetchall():
+            if size not in sizes:
+                continue
+            if sha1 is None:
+                missing.append(name)
+            else:
+                hashes[sha1] = name
+
+        def hash_image(name):
+            try:
+                return file_sha1(os.path.join(self.image_dir, name))
+            except OSError:
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            computed = [(sha1, name) for name, sha1
+                        in zip(missing, pool.map(hash_image, missing))
+                        if sha1 is not None]
+        self.set_hashes(computed)
+        hashes.update(computed)
+        return hashes
+
+    def set_hashes(self, hashes):
+        """Сохранение хэшей содержимого: пары (хэш, имя)"""
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE images SET sha1 = ? WHERE name = ?", hashes
+            )
+
+    def perceptual_hashes(self, workers=1):
+        """Перцептивные хэши (perceptual_hash) всех изображений: {имя: хэш}
+
+        Недостающие считаются в пуле потоков и сохраняются. У файлов,
+        которые не удалось декодировать, хэша нет.
+        """
+        hashes = {}
+        missing = []
+        for name, value in self.connection.execute(
+            "SELECT name, dhash FROM images"
+        ).fetchall():
+            if value is None:
+                missing.append(name)
+            else:
+                hashes[name] = value % (1 << 64)  # SQLite хранит со знаком
+
+        def hash_image(name):
+            data = read_file_bytes(os.path.join(self.image_dir, name))
+            return None if data is None else perceptual_hash(data)
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            computed = [(name, value) for name, value
+                        in zip(missing, pool.map(hash_image, missing))
+                        if value is not None]
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE images SET dhash = ? WHERE name = ?",
+                [(value - (1 << 64) if value >= 1 << 63 else value, name)
+                 for name, value in computed]
+            )
+        hashes.update(computed)
+        return hashes
+
+    def set_label(self, name, annotations):
+        """Учет записанного (или удаленного при 0 аннотаций) файла разметки"""
+        label_path = label_path_for(self.label_dir, name)
+        try:
+            label_mtime = os.stat(label_path).st_mtime_ns
+        except OSError:
+            label_mtime = None
+        with self.connection:
+            self.connection.execute(
+                "UPDATE images SET labeled = ?, annotations = ?, "
+                "label_mtime_ns = ? WHERE name = ?",
+                (int(label_mtime is not None), annotations, label_mtime,
+                 name),
+            )
+
+    def remove(self, name):
+        """Удаление изображения из индекса"""
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM images WHERE name = ?", (name,)
+            )
+
+    def close(self):
+        self.connection.close()
+
+
+class LabelIndex:
+    """Все рамки разметки в одной таблице NumPy, открытой через memmap
+
+    Строка таблицы - одна рамка: номер изображения, класс, YOLO
+    координаты и соотношение сторон в пикселях. Номера изображений и
+    время изменения проиндексированных файлов разметки хранятся в базе
+    каталога (ImageCatalog), поэтому sync перечитывает только файлы,
+    изменившиеся с прошлого раза. Старые рамки измененного изображения
+    помечаются удаленными (номер -1), новые дописываются в конец; когда
+    место кончается, таблица переписывается вдвое большей без удаленных
+    строк. Запросы выполняются сразу над всей таблицей.
+    """
+
+    DTYPE = np.dtype([("image", "<i4"), ("cls", "<i4"), ("x", "<f4"),
+                      ("y", "<f4"), ("w", "<f4"), ("h", "<f4"),
+                      ("aspect", "<f4")])
+
+    def __init__(self, path, catalog):
+        self.path = path
+        self.catalog = catalog
+        self.connection = catalog.connection
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS label_index ("
+                "name TEXT PRIMARY KEY, id INTEGER UNIQUE, "
+                "label_mtime_ns INTEGER)"
+            )
+
+        count = catalog.get_meta("label_index_rows")
+        if count is None or not os.path.exists(path):
+            # Каталог начат заново или таблицы нет - индекс тоже
+            self.rows = self._create_table(path, LABEL_INDEX_MIN_ROWS)
+            with self.connection:
+                self.connection.execute("DELETE FROM label_index")
+                catalog.set_meta("label_index_rows", 0)
+            count = 0
+        else:
+            self.rows = np.lib.format.open_memmap(path, mode="r+")
+        self.count = int(count)
+        self.names = dict(
+            self.connection.execute("SELECT id, name FROM label_index")
+        )
+        self.next_id = max(self.names, default=-1) + 1
+
+    @classmethod
+    def _create_table(cls, path, capacity):
+        """Новая пустая таблица на диске (все строки помечены удаленными)"""
+        rows = np.lib.format.open_memmap(path, mode="w+", dtype=cls.DTYPE,
+                                         shape=(capacity,))
+        rows["image"] = -1
+        return rows
+
+    def sync(self, names=None):
+        """Перечитывание изменившихся файлов разметки
+
+        names - проверить только эти изображения (после сохранения или
+        удаления в интерфейсе), иначе все, у которых время изменения
+        разметки в каталоге отличается от проиндексированного. Каталог
+        к этому моменту должен быть обновлен.
+        """
+        if names is None:
+            changed = self.connection.execute(
+                "SELECT i.name, i.label_mtime_ns, l.id FROM images i "
+                "LEFT JOIN label_index l ON l.name = i.name "
+                "WHERE i.label_mtime_ns IS NOT l.label_mtime_ns "
+                "UNION ALL "
+                "SELECT name, NULL, id FROM label_index "
+                "WHERE name NOT IN (SELECT name FROM images)"
+            ).fetchall()
+        else:
+            changed = []
+            for name in names:
+                row = self.connection.execute(
+                    "SELECT label_mtime_ns FROM images WHERE name = ?",
+                    (name,)
+                ).fetchone()
+                label_mtime = row[0] if row else None
+                image_id, indexed_mtime = self.connection.execute(
+                    "SELECT id, label_mtime_ns FROM label_index "
+                    "WHERE name = ?", (name,)
+                ).fetchone() or (None, None)
+                if label_mtime != indexed_mtime:
+                    changed.append((name, label_mtime, image_id))
+        if not changed:
+            return
+
+        dead = []
+        entries = []
+        removed = []
+        new_rows = []
+        for name, label_mtime, image_id in changed:
+            if image_id is not None:
+                dead.append(image_id)
+            if label_mtime is None:
+                removed.append(name)
+                continue
+            if image_id is None:
+                image_id = self.next_id
+                self.next_id += 1
+            new_rows.append(self._read_rows(name, image_id))
+            entries.append((name, image_id, label_mtime))
+
+        # Сначала отметка "не проиндексировано": если запись оборвется,
+        # следующий sync перечитает эти файлы заново
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE label_index SET label_mtime_ns = NULL WHERE id = ?",
+                [(image_id,) for image_id in dead]
+            )
+        if dead:
+            images = self.rows["image"][:self.count]
+            images[np.isin(images, dead)] = -1
+
+        new_rows = (np.concatenate(new_rows) if new_rows
+                    else np.empty(0, dtype=self.DTYPE))
+        self.reserve(len(new_rows))
+        self.rows[self.count:self.count + len(new_rows)] = new_rows
+        self.rows.flush()
+        self.count += len(new_rows)
+
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM label_index WHERE name = ?",
+                [(name,) for name in removed]
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO label_index VALUES (?, ?, ?)",
+                entries
+            )
+            self.catalog.set_meta("label_index_rows", self.count)
+        for image_id in dead:
+            self.names.pop(image_id, None)
+        for name, image_id, _ in entries:
+            self.names[image_id] = name
+
+    def _read_rows(self, name, image_id):
+        """Строки таблицы для файла разметки изображения"""
+        store = AnnotationStore.load(
+            label_path_for(self.catalog.label_dir, name)
+        )
+        rows = np.empty(len(store), dtype=self.DTYPE)
+        if not len(store):
+            return rows
+        rows["image"] = image_id
+        rows["cls"] = store.classes
+        for column, field in enumerate(("x", "y", "w", "h")):
+            rows[field] = store.boxes[:, column]
+        try:
+            width, height = read_image_size(
+                os.path.join(self.catalog.image_dir, name)
+            )
+        except OSError:
+            rows["aspect"] = np.nan
+        else:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                rows["aspect"] = (store.boxes[:, 2] * width
+                                  / (store.boxes[:, 3] * height))
+        return rows
+
+    def reserve(self, extra):
+        """Место под extra новых строк: при нехватке таблица
+        переписывается без удаленных строк с запасом вдвое"""
+        if self.count + extra <= len(self.rows):
+            return
+        live = self.live()
+        capacity = max(LABEL_INDEX_MIN_ROWS, 2 * (len(live) + extra))
+        tmp_path = self.path + ".tmp.npy"
+        rows = self._create_table(tmp_path, capacity)
+        rows[:len(live)] = live
+        rows.flush()
+        del rows
+        self.rows = None  # Отображение старого файла закрывается
+        os.replace(tmp_path, self.path)
+        self.rows = np.lib.format.open_memmap(self.path, mode="r+")
+        self.count = len(live)
+        with self.connection:
+            self.catalog.set_meta("label_index_rows", self.count)
+
+    def live(self):
+        """Копия действующих строк таблицы"""
+        rows = self.rows[:self.count]
+        return rows[rows["image"] >= 0]
+
+    @staticmethod
+    def box_mask(rows, cls=None, min_area=None, max_area=None,
+                 min_aspect=None, max_aspect=None):
+        """Маска рамок по классу, площади (доля изображения) и
+        соотношению сторон (ширина / высота в пикселях)"""
+        mask = np.ones(len(rows), dtype=bool)
+        if cls is not None:
+            mask &= rows["cls"] == cls
+        area = rows["w"] * rows["h"]
+        if min_area is not None:
+            mask &= area >= min_area
+        if max_area is not None:
+            mask &= area < max_area
+        if min_aspect is not None:
+            mask &= rows["aspect"] >= min_aspect
+        if max_aspect is not None:
+            mask &= rows["aspect"] < max_aspect
+        return mask
+
+    def image_ids(self):
+        return np.fromiter(self.names, dtype=np.int64,
+                           count=len(self.names))
+
+    def query(self, min_boxes=1, max_boxes=None, **box_filters):
+        """Отсортированные имена размеченных изображений, у которых число
+        рамок, подходящих под условия box_mask, от min_boxes до max_boxes
+
+        Например, query(min_boxes=4) - больше трех пар,
+        query(max_area=0.01) - есть рамка меньше 1% площади.
+        """
+        rows = self.live()
+        mask = self.box_mask(rows, **box_filters)
+        ids = self.image_ids()
+        counts = np.bincount(rows["image"][mask],
+                             minlength=self.next_id)[ids]
+        keep = counts >= min_boxes
+        if max_boxes is not None:
+            keep &= counts <= max_boxes
+        return sorted(self.names[image_id] for image_id in ids[keep])
+
+    def statistics(self):
+        """Сводка по всей разметке: число изображений и рамок, гистограммы
+        классов, числа рамок на изображении, площади и соотношения сторон"""
+        rows = self.live()
+        per_image = np.bincount(rows["image"],
+                                minlength=self.next_id)[self.image_ids()]
+        classes, class_counts = np.unique(rows["cls"], return_counts=True)
+        aspect = rows["aspect"][np.isfinite(rows["aspect"])]
+        return {
+            "images": len(per_image),
+            "boxes": len(rows),
+            "classes": dict(zip(classes.tolist(), class_counts.tolist())),
+            "boxes_per_image": np.bincount(per_image).tolist(),
+            "area": np.histogram(rows["w"] * rows["h"],
+                                 bins=LABEL_AREA_BINS)[0].tolist(),
+            "aspect": np.histogram(aspect,
+                                   bins=LABEL_ASPECT_BINS)[0].tolist(),
+        }
+
+    def close(self):
+        if self.rows is not None:
+            self.rows.flush()
+            self.rows = None
+
+
+def print_label_statistics(image_dir=IMAGE_DIR, label_dir=LABEL_DIR,
+                           state_dir=STATE_DIR):
+    """Вывод сводки по разметке в консоль (индекс обновляется)"""
+    catalog = ImageCatalog(os.path.join(state_dir, CATALOG_FILE),
+                           image_dir, label_dir)
+    catalog.refresh()
+    index = LabelIndex(os.path.join(state_dir, LABEL_INDEX_FILE), catalog)
+    index.sync()
+    stats = index.statistics()
+    index.close()
+    catalog.close()
+
+    def ranges(edges, counts, unit=""):
+        return ", ".join(
+            f"{low:g}-{high:g}{unit}: {count}"
+            for low, high, count in zip(edges, edges[1:], counts)
+        )
+
+    print(f"Изображений с разметкой: {stats['images']}, "
+          f"рамок: {stats['boxes']}")
+    print("Классы: " + ", ".join(f"{cls}: {count}" for cls, count
+                                 in stats["classes"].items()))
+    print("Рамок на изображении: " + ", ".join(
+        f"{boxes}: {count}"
+        for boxes, count in enumerate(stats["boxes_per_image"]) if count
+    ))
+    print("Площадь рамки (доля изображения): "
+          + ranges(LABEL_AREA_BINS, stats["area"]))
+    print("Ширина / высота рамки: "
+          + ranges(LABEL_ASPECT_BINS, stats["aspect"]))
+
+
+class DetectionCache:
+    """Кэш сырых детекций людей, велосипедов и мотоциклов на диске
+
+    Ключ - хэш содержимого изображения, идентификатор весов модели,
+    размер изображения и параметры детектора (DetectorConfig). Хранятся
+    все детекции нужных классов выше порога детектора, поэтому порог
+    поиска пар можно менять без повторного запуска модели. При
+    превышении max_mb удаляются давно не использованные записи (LRU).
+
+    Базу одновременно используют процессы разметки, поэтому размер
+    кэша берется из базы (SUM(size)), а не только из своих записей,
+    а время использования записывается пачками (flush), чтобы чтение
+    из кэша не занимало блокировку записи.
+    """
+
+    def __init__(self, path, model_path=YOLO_MODEL,
+                 max_mb=DETECTION_CACHE_MB, backend=INFERENCE_BACKEND):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.model = model_signature(model_path, backend)
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS detections ("
+            "key TEXT PRIMARY KEY, data BLOB NOT NULL, "
+            "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS detections_last_used "
+            "ON detections (last_used)"
+        )
+        self.connection.commit()
+        self.touched = {}  # Ключ -> время использования, еще не записанное
+        self.unchecked_bytes = 0  # Добавлено с последней сверки с базой
+        self.total_bytes = self.database_bytes()
+
+    def database_bytes(self):
+        """Размер кэша по всем записям базы"""
+        return self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM detections"
+        ).fetchone()[0]
+
+    def key(self, frame, variant=""):
+        """Ключ кэша для декодированного изображения
+
+        variant - режим детектора (например, тайлы), если он отличается
+        от обычного запуска на целом изображении.
+        """
+        key = (f"{frame.content_hash}:{self.model}:"
+               f"{frame.width}x{frame.height}")
+        return f"{key}:{variant}" if variant else key
+
+    def get(self, frame, variant=""):
+        """Детекции из кэша или None"""
+        key = self.key(frame, variant)
+        row = self.connection.execute(
+            "SELECT data FROM detections WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        self.touched[key] = time.time()
+        if len(self.touched) >= DETECTION_CACHE_TOUCH_BATCH:
+            self.flush()
+        return np.frombuffer(row[0], dtype=np.float32).reshape(-1, 6) \
+            .astype(np.float64)
+
+    def put(self, frame, detections, variant=""):
+        """Сохранить детекции изображения"""
+        data = np.ascontiguousarray(detections, dtype=np.float32).tobytes()
+        # Служебные данные строки тоже занимают место
+        size = len(data) + 128
+        key = self.key(frame, variant)
+        with self.connection:
+            self._write_touched()
+            old = self.connection.execute(
+                "SELECT size FROM detections WHERE key = ?", (key,)
+            ).fetchone()
+            added = size - (old[0] if old is not None else 0)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO detections VALUES (?, ?, ?, ?)",
+                (key, data, size, time.time()),
+            )
+            self.total_bytes += added
+            self.unchecked_bytes += added
+            if (self.total_bytes > self.max_bytes or self.unchecked_bytes
+                    > self.max_bytes * DETECTION_CACHE_CHECK):
+                # Другие процессы тоже пишут в базу
+                self.total_bytes = self.database_bytes()
+                self.unchecked_bytes = 0
+                if self.total_bytes > self.max_bytes:
+                    self.evict()
+
+    def flush(self):
+        """Запись накопленного времени использования записей"""
+        if self.touched:
+            with self.connection:
+                self._write_touched()
+
+    def _write_touched(self):
+        self.connection.executemany(
+            "UPDATE detections SET last_used = ? WHERE key = ?",
+            [(used, key) for key, used in self.touched.items()],
+        )
+        self.touched = {}
+
+    def evict(self):
+        """Удаление давно не использованных записей до 90% лимита"""
+        target = self.max_bytes * 0.9
+        rows = self.connection.execute(
+            "SELECT key, size FROM detections ORDER BY last_used"
+        )
+        stale = []
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            stale.append((key,))
+            self.total_bytes -= size
+        self.connection.executemany(
+            "DELETE FROM detections WHERE key = ?", stale
+        )
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+def tile_grid(width, height, tile_size, overlap=TILE_OVERLAP):
+    """Тайлы (x1, y1, x2, y2), покрывающие изображение с перекрытием
+
+    Последний тайл в ряду прижимается к краю изображения, поэтому все
+    тайлы (кроме изображений меньше тайла) одного размера.
+    """
+    step = max(1, int(tile_size * (1 - overlap)))
+
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        return list(range(0, length - tile_size, step)) + [length - tile_size]
+
+    return np.array([
+        [x, y, min(x + tile_size, width), min(y + tile_size, height)]
+        for y in starts(height)
+        for x in starts(width)
+    ], dtype=np.float64)
+
+
+def merge_tile_detections(detections, threshold=TILE_MERGE_IOMIN):
+    """Слияние рамок одного объекта, найденных в соседних тайлах
+
+    Рамки одного класса группируются по убыванию уверенности: к лучшей
+    еще не занятой рамке присоединяются все, у которых пересечение
+    с ней больше threshold от меньшей из площадей (обрезанная стыком
+    часть объекта почти целиком лежит внутри полной рамки). Итоговая
+    рамка - объединение рамок группы с уверенностью не ниже
+    TILE_MERGE_CONF_RATIO от лучшей, уверенность - лучшая в группе.
+    """
+    if not len(detections):
+        return detections
+    detections = detections[np.argsort(-detections[:, 4], kind="stable")]
+    boxes = detections[:, :4]
+    areas = np.maximum((boxes[:, 2] - boxes[:, 0])
+                       * (boxes[:, 3] - boxes[:, 1]), 1e-9)
+    width = (np.minimum(boxes[:, None, 2], boxes[None, :, 2])
+             - np.maximum(boxes[:, None, 0], boxes[None, :, 0]))
+    height = (np.minimum(boxes[:, None, 3], boxes[None, :, 3])
+              - np.maximum(boxes[:, None, 1], boxes[None, :, 1]))
+    overlap = (np.clip(width, 0, None) * np.clip(height, 0, None)
+               / np.minimum(areas[:, None], areas[None, :]))
+    same = ((detections[:, None, 5] == detections[None, :, 5])
+            & (overlap > threshold))
+
+    used = np.zeros(len(detections), dtype=bool)
+    merged = []
+    for i in range(len(detections)):
+        if used[i]:
+            continue
+        group = same[i] & ~used
+        group[i] = True
+        used |= group
+        members = detections[group]
+        strong = members[members[:, 4]
+                         >= members[0, 4] * TILE_MERGE_CONF_RATIO]
+        merged.append(np.concatenate([strong[:, :2].min(axis=0),
+                                      strong[:, 2:4].max(axis=0),
+                                      members[0, 4:6]]))
+    return np.array(merged)
+
+
+def detect_tiled(yolo_model, frame, detector):
+    """Детекции на большом изображении по перекрывающимся тайлам
+
+    Сначала дешевый проход по целому изображению (модель сама
+    уменьшает его) с низким порогом уверенности: он находит крупные
+    объекты и показывает, где могут быть мелкие. Тайлы, которых
+    не касается ни одна рамка грубого прохода, пропускаются, остальные
+    подаются в модель одной пачкой в полном разрешении. Рамки тайлов
+    переводятся в координаты изображения и сливаются на стыках вместе
+    с рамками грубого прохода.
+    """
+    pixels = frame.pixels
+    coarse = relevant_detections(
+        yolo_model(pixels, **detector.model_kwargs(
+            conf=min(TILE_PROBE_CONF, detector.conf)
+        )),
+        detector.classes,
+    )
+    coarse_boxes = coarse[:, :4]
+    # Уверенные рамки грубого прохода идут в результат наравне с тайлами
+    coarse = coarse[coarse[:, 4] >= detector.conf]
+    tiles = tile_grid(frame.width, frame.height, detector.tile_size)
+    tiles = tiles[intersection_matrix(tiles, coarse_boxes).any(axis=1)]
+
+    found = [coarse]
+    if len(tiles):
+        crops = [
+            np.ascontiguousarray(pixels[int(y1):int(y2), int(x1):int(x2)])
+            for x1, y1, x2, y2 in tiles
+        ]
+        results = yolo_model(crops, **detector.model_kwargs(
+            imgsz=detector.tile_size
+        ))
+        for (x1, y1, _, _), result in zip(tiles, results):
+            detections = relevant_detections([result], detector.classes)
+            detections[:, :4] += (x1, y1, x1, y1)
+            found.append(detections)
+    return merge_tile_detections(np.concatenate(found))
+
+
+def detect_frames(yolo_model, frames, cache=None, detector=None):
+    """Сырые детекции нужных классов для пачки изображений
+
+    Параметры модели берутся из detector (DetectorConfig). Изображения,
+    найденные в кэше, в модель не подаются; остальные обрабатываются
+    одним вызовом модели и добавляются в кэш. Большие изображения
+    в режиме тайлов размечаются detect_tiled. Детекции изображения
+    остаются одним массивом до поиска пар.
+    """
+    detector = detector or DetectorConfig()
+    variants = [detector.cache_variant(frame) for frame in frames]
+    detections = [cache.get(frame, variant) if cache else None
+                  for frame, variant in zip(frames, variants)]
+    missing = [i for i, found in enumerate(detections) if found is None]
+    whole = [i for i in missing if not detector.uses_tiles(frames[i])]
+
+    if whole:
+        results = yolo_model([frames[i].pixels for i in whole],
+                             **detector.model_kwargs())
+        for i, result in zip(whole, results):
+            detections[i] = relevant_detections([result], detector.classes)
+    for i in missing:
+        if detector.uses_tiles(frames[i]):
+            detections[i] = detect_tiled(yolo_model, frames[i], detector)
+        if cache:
+            cache.put(frames[i], detections[i], variants[i])
+
+    return detections
+
+
+def detect_pairs_batch(yolo_model, frames, conf_threshold=CONF_THRESHOLD,
+                       cache=None, detector=None):
+    """Поиск пар на пачке изображений за один вызов модели
+
+    Возвращает список найденных пар для каждого изображения пачки
+    в том же порядке.
+    """
+    return [
+        find_twowheeledhuman_pairs(detections, conf_threshold)
+        for detections in detect_frames(yolo_model, frames, cache,
+                                        detector)
+    ]
+
+
+def write_label_file(label_path, pairs, img_width, img_height):
+    """Запись найденных пар в файл разметки YOLO"""
+    AnnotationStore.from_pairs(pairs, img_width, img_height).save(label_path)
+
+
+def read_packed_records(label_dir):
+    """Упакованная разметка: {имя файла .txt: (содержимое, время записи)}
+
+    Последняя запись по файлу главнее предыдущих. У строк, записанных
+    без времени, оно считается равным времени изменения упакованного
+    файла.
+    """
+    records = {}
+    pack_path = os.path.join(label_dir, LABEL_PACK_FILE)
+    if not os.path.exists(pack_path):
+        return records
+    pack_mtime = os.stat(pack_path).st_mtime_ns
+    with open(pack_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # Недописанная строка после падения
+            records[record["label"]] = (record["text"],
+                                        record.get("time_ns", pack_mtime))
+    return records
+
+
+def read_packed_labels(label_dir):
+    """Упакованная разметка: {имя файла .txt: содержимое}"""
+    return {name: text
+            for name, (text, _) in read_packed_records(label_dir).items()}
+
+
+def unpack_labels(label_dir, fsync=LABEL_FSYNC):
+    """Распаковка упакованной разметки в отдельные файлы .txt
+
+    Последняя запись по файлу главнее предыдущих. Файл .txt, измененный
+    после упакованной записи (например, исправленный вручную), не
+    заменяется. Упакованный файл удаляется только после записи всех
+    файлов. Возвращает число записанных файлов.
+    """
+    pack_path = os.path.join(label_dir, LABEL_PACK_FILE)
+    if not os.path.exists(pack_path):
+        return 0
+    written = 0
+    for name, (text, time_ns) in read_packed_records(label_dir).items():
+        path = os.path.join(label_dir, name)
+        try:
+            if os.stat(path).st_mtime_ns > time_ns:
+                continue
+        except FileNotFoundError:
+            pass
+        write_text_atomic(path, text, fsync != "never")
+        written += 1
+    if fsync != "never":
+        fsync_dir(label_dir)
+    os.remove(pack_path)
+    return written
+
+
+def read_file_bytes(path):
+    """Содержимое файла как массив NumPy или None при ошибке чтения
+
+    Чтение через NumPy работает и с путями, содержащими кириллицу.
+    """
+    try:
+        data = np.fromfile(path, dtype=np.uint8)
+    except OSError:
+        return None
+    return data if data.size else None
+
+
+def read_image_size(path):
+    """Размер изображения по заголовку файла, без декодирования пикселей
+
+    Учитывает EXIF-ориентацию так же, как cv2.imdecode: при повороте
+    на 90 градусов ширина и высота меняются местами.
+    """
+    with Image.open(path) as img:
+        width, height = img.size
+        if img.getexif().get(EXIF_ORIENTATION) in (5, 6, 7, 8):
+            width, height = height, width
+    return width, height
+
+
+def bgr_to_pil(pixels, width, height):
+    """Копия BGR массива нужного размера в формате PIL (RGB)"""
+    if (width, height) == (pixels.shape[1], pixels.shape[0]):
+        small = pixels
+    else:
+        interpolation = (cv2.INTER_AREA if width < pixels.shape[1]
+                         else cv2.INTER_LANCZOS4)
+        small = cv2.resize(pixels, (width, height),
+                           interpolation=interpolation)
+    return Image.fromarray(cv2.cvtColor(small, cv2.COLOR_BGR2RGB))
+
+
+def fit_size(img_width, img_height, box_width, box_height):
+    """Размер изображения, вписанного в прямоугольник с сохранением
+    пропорций"""
+    ratio = min(box_width / img_width, box_height / img_height)
+    return int(img_width * ratio), int(img_height * ratio)
+
+
+class DecodedFrame:
+    """Изображение, декодированное один раз для отображения и детектора
+
+    Пиксели хранятся в BGR массиве, который без копирования передается
+    в YOLO. Для отображения уменьшается и переводится в RGB только
+    уменьшенная копия. Кадр, созданный через lazy, знает только размер
+    из заголовка и декодирует файл при первом обращении к pixels.
+    """
+
+    def __init__(self, pixels=None, path=None, content_hash=None,
+                 size=None):
+        self._pixels = pixels
+        self.path = path
+        self._content_hash = content_hash  # SHA-1 байтов файла
+        if pixels is not None:
+            self.height, self.width = pixels.shape[:2]
+        else:
+            self.width, self.height = size
+
+    @classmethod
+    def load(cls, path):
+        """Декодирование файла изображения"""
+        frame = cls.try_load(path)
+        if frame is None:
+            raise ValueError("Не удалось загрузить изображение")
+        return frame
+
+    @classmethod
+    def try_load(cls, path):
+        """Декодирование файла изображения, None при ошибке"""
+        data = read_file_bytes(path)
+        if data is None:
+            return None
+        pixels = cv2.imdecode(data, cv2.IMREAD_COLOR)
+        if pixels is None:
+            return None
+        return cls(pixels, path, hashlib.sha1(data).hexdigest())
+
+    @classmethod
+    def lazy(cls, path):
+        """Кадр без декодирования: только размер из заголовка файла"""
+        return cls(path=path, size=read_image_size(path))
+
+    @property
+    def is_decoded(self):
+        return self._pixels is not None
+
+    @property
+    def pixels(self):
+        if self._pixels is None:
+            frame = self.load(self.path)
+            self._pixels = frame.pixels
+            self._content_hash = frame.content_hash
+            self.height, self.width = self._pixels.shape[:2]
+        return self._pixels
+
+    @property
+    def content_hash(self):
+        if self._content_hash is None:
+            self.pixels  # Хэш считается при декодировании
+        return self._content_hash
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    def to_pil(self, width, height):
+        """Уменьшенная (или увеличенная) копия для отображения"""
+        return bgr_to_pil(self.pixels, width, height)
+
+
+class DisplayCache:
+    """Кэш изображений для быстрого переключения в интерфейсе
+
+    На диске хранятся уменьшенные копии (по длинной стороне из levels),
+    поэтому для показа не нужно декодировать полное изображение.
+    В памяти держатся последние показанные PhotoImage, а соседние
+    изображения списка готовятся заранее в фоновых потоках. PhotoImage
+    создается только в главном потоке, фон готовит изображения PIL.
+    Уменьшенные копии тоже пишутся в фоне, в очереди не больше
+    pending_saves кадров; при превышении max_mb удаляются давно
+    не показанные копии (LRU).
+    """
+
+    def __init__(self, cache_dir, levels=DISPLAY_LEVELS,
+                 memory_items=DISPLAY_MEMORY_ITEMS,
+                 max_mb=THUMBNAIL_CACHE_MB,
+                 pending_saves=THUMBNAIL_PENDING_SAVES):
+        self.cache_dir = cache_dir
+        self.levels = sorted(levels)
+        self.memory_items = memory_items
+        self.pending_saves = pending_saves
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.photos = OrderedDict()  # Готовые PhotoImage (LRU)
+        self.ready = OrderedDict()  # Изображения PIL из предзагрузки
+        self.pending = set()
+        self.saving = set()  # Кадры, копии которых сейчас пишутся
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        # Копии на диске в порядке последнего использования и их размер
+        self.files = OrderedDict()
+        self.total_bytes = 0
+        self.scan_files()
+
+    def scan_files(self):
+        """Учет копий, сохраненных в прошлых запусках"""
+        entries = []
+        for level in self.levels:
+            try:
+                with os.scandir(os.path.join(self.cache_dir,
+                                             str(level))) as it:
+                    for entry in it:
+                        if entry.name.endswith(".jpg"):
+                            stat = entry.stat()
+                            entries.append((stat.st_mtime_ns, entry.path,
+                                            stat.st_size))
+            except FileNotFoundError:
+                continue
+        for _, path, size in sorted(entries):
+            self.files[path] = size
+            self.total_bytes += size
+
+    def thumbnail_path(self, path, level):
+        """Файл уменьшенной копии; ключ меняется при изменении файла"""
+        stat = os.stat(path)
+        key = hashlib.sha1(
+            f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+            .encode("utf-8")
+        ).hexdigest()
+        return os.path.join(self.cache_dir, str(level), key + ".jpg")
+
+    def memory_key(self, path, width, height):
+        return path, os.stat(path).st_mtime_ns, width, height
+
+    def render(self, frame, width, height):
+        """Изображение PIL размера width x height для показа
+
+        Если кадр еще не декодирован, берется подходящая уменьшенная
+        копия с диска. Иначе (или если копии нет) используется полное
+        изображение, а копии для всех уровней сохраняются на будущее.
+        """
+        if not frame.is_decoded:
+            level = next((level for level in self.levels
+                          if level >= max(width, height)), None)
+            if level is not None and level < max(frame.size):
+                path = self.thumbnail_path(frame.path, level)
+                data = read_file_bytes(path)
+                if data is not None:
+                    thumbnail = cv2.imdecode(data, cv2.IMREAD_COLOR)
+                    if thumbnail is not None:
+                        self.touch(path)
+                        return bgr_to_pil(thumbnail, width, height)
+
+        image = frame.to_pil(width, height)
+        # Если запись копий отстает, кадр не ставится в очередь: копии
+        # сохранятся при следующем показе
+        with self.lock:
+            submit = (frame.path not in self.saving
+                      and len(self.saving) < self.pending_saves)
+            if submit:
+                self.saving.add(frame.path)
+        if submit:
+            self.executor.submit(self._save_thumbnails, frame)
+        return image
+
+    def touch(self, path):
+        """Отметка использования копии (время изменения - порядок LRU)"""
+        with self.lock:
+            if path in self.files:
+                self.files.move_to_end(path)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _save_thumbnails(self, frame):
+        try:
+            self.save_thumbnails(frame)
+        except Exception:
+            pass  # Без копии изображение просто декодируется целиком
+        finally:
+            with self.lock:
+                self.saving.discard(frame.path)
+
+    def save_thumbnails(self, frame):
+        """Сохранение уменьшенных копий декодированного кадра
+
+        Выполняется в фоновом потоке, чтобы кодирование и запись JPEG
+        не задерживали показ изображения.
+        """
+        for level in self.levels:
+            if level >= max(frame.size):
+                break
+            path = self.thumbnail_path(frame.path, level)
+            if os.path.exists(path):
+                continue
+            width, height = fit_size(frame.width, frame.height, level, level)
+            thumbnail = cv2.resize(frame.pixels, (width, height),
+                                   interpolation=cv2.INTER_AREA)
+            ok, encoded = cv2.imencode(".jpg", thumbnail,
+                                       [cv2.IMWRITE_JPEG_QUALITY, 90])
+            if not ok:
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            encoded.tofile(tmp_path)
+            os.replace(tmp_path, path)
+            with self.lock:
+                self.total_bytes += encoded.size - self.files.pop(path, 0)
+                self.files[path] = encoded.size
+        self.evict()
+
+    def evict(self):
+        """Удаление давно не показанных копий до 90% лимита"""
+        stale = []
+        with self.lock:
+            if self.total_bytes <= self.max_bytes:
+                return
+            target = self.max_bytes * 0.9
+            while self.files and self.total_bytes > target:
+                path, size = self.files.popitem(last=False)
+                self.total_bytes -= size
+                stale.append(path)
+        for path in stale:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def discard(self, path):
+        """Удаление копий изображения (до удаления самого файла)"""
+        try:
+            thumbnails = [self.thumbnail_path(path, level)
+                          for level in self.levels]
+        except OSError:
+            return
+        with self.lock:
+            for thumbnail in thumbnails:
+                self.total_bytes -= self.files.pop(thumbnail, 0)
+            for cache in (self.photos, self.ready):
+                for key in [key for key in cache if key[0] == path]:
+                    del cache[key]
+        for thumbnail in thumbnails:
+            try:
+                os.remove(thumbnail)
+            except OSError:
+                pass
+
+    def photo(self, frame, width, height):
+        """PhotoImage для показа и исходное изображение PIL
+
+        Вызывать только из главного потока.
+        """
+        key = self.memory_key(frame.path, width, height)
+        if key in self.photos:
+            self.photos.move_to_end(key)
+            return self.photos[key]
+
+        with self.lock:
+            image = self.ready.pop(key, None)
+        if image is None:
+            image = self.render(frame, width, height)
+
+        self.photos[key] = (ImageTk.PhotoImage(image), image)
+        while len(self.photos) > self.memory_items:
+            self.photos.popitem(last=False)
+        return self.photos[key]
+
+    def prefetch(self, paths, box_width, box_height):
+        """Фоновая подготовка изображений для показа в прямоугольнике"""
+        for path in paths:
+            with self.lock:
+                if path in self.pending:
+                    continue
+                self.pending.add(path)
+            self.executor.submit(self._prefetch_one, path,
+                                 box_width, box_height)
+
+    def _prefetch_one(self, path, box_width, box_height):
+        try:
+            frame = DecodedFrame.lazy(path)
+            width, height = fit_size(frame.width, frame.height,
+                                     box_width, box_height)
+            key = self.memory_key(path, width, height)
+            if key in self.photos or key in self.ready:
+                return
+            image = self.render(frame, width, height)
+            with self.lock:
+                self.ready[key] = image
+                while len(self.ready) > self.memory_items:
+                    self.ready.popitem(last=False)
+        except Exception:
+            pass  # Ошибку покажет обычная загрузка при выборе изображения
+        finally:
+            with self.lock:
+                self.pending.discard(path)
+
+
+def prefetch_images(image_dir, filenames, prefetch=PREFETCH_IMAGES,
+                    workers=DECODE_WORKERS, max_mb=PREFETCH_MB):
+    """Декодирование изображений в пуле потоков с опережением
+
+    Держит в работе не более prefetch изображений вперед и выдает пары
+    (имя файла, DecodedFrame или None) в исходном порядке, так что чтение
+    с диска идет параллельно с работой модели. Пока изображения в работе
+    занимают (по размеру из заголовка файла) max_mb и больше, новые
+    не ставятся, поэтому предел превышается не больше чем на одно
+    изображение.
+    """
+    filenames = iter(filenames)
+    max_bytes = max_mb * 1024 * 1024
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        window = deque()
+        window_bytes = 0
+
+        def decoded_size(path):
+            try:
+                width, height = read_image_size(path)
+            except Exception:
+                return 0  # Ошибку покажет декодирование
+            return width * height * 3
+
+        def fill():
+            nonlocal window_bytes
+            while len(window) < max(1, prefetch):
+                filename = next(filenames, None)
+                if filename is None:
+                    return
+                path = os.path.join(image_dir, filename)
+                size = decoded_size(path)
+                window.append((filename, size,
+                               pool.submit(DecodedFrame.try_load, path)))
+                window_bytes += size
+                if window_bytes >= max_bytes:
+                    return
+
+        fill()
+        while window:
+            filename, size, future = window.popleft()
+            window_bytes -= size
+            if window_bytes < max_bytes:
+                fill()
+            yield filename, future.result()
+
+
+class LabelWriterThread(threading.Thread):
+    """Фоновая запись файлов разметки из ограниченной очереди
+
+    Файлы накапливаются и сбрасываются на диск пачкой: по batch_size
+    файлов или через flush_seconds после первого файла пачки. Повторная
+    запись того же файла в пачке заменяет предыдущую. Каждый файл
+    пишется атомарно (write_text_atomic), fsync - одна из
+    LABEL_FSYNC_POLICIES. С pack=True разметка дописывается строками
+    в LABEL_PACK_FILE папки разметки (см. unpack_labels) вместо
+    отдельных файлов. on_written вызывается в потоке записи после того,
+    как файл (строка упакованной разметки) записан; при ошибке записи -
+    нет.
+    """
+
+    def __init__(self, queue_size=WRITE_QUEUE_SIZE, fsync=LABEL_FSYNC,
+                 pack=False, batch_size=LABEL_FLUSH_BATCH,
+                 flush_seconds=LABEL_FLUSH_SECONDS):
+        super().__init__(daemon=True)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.fsync = fsync
+        self.pack = pack
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.written = 0
+        self.errors = 0
+
+    def put(self, label_path, pairs, img_width, img_height,
+            on_written=None):
+        """Поставить файл разметки найденных пар в очередь на запись"""
+        self.put_text(label_path, AnnotationStore.from_pairs(
+            pairs, img_width, img_height
+        ).to_text(), on_written)
+
+    def put_text(self, label_path, text, on_written=None):
+        """Поставить готовое содержимое файла разметки в очередь"""
+        self.queue.put((label_path, text, on_written))
+
+    def flush(self):
+        """Дождаться записи всего, что уже поставлено в очередь"""
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def run(self):
+        pending = {}
+        deadline = None
+        while True:
+            timeout = (max(0.0, deadline - time.monotonic())
+                       if pending else None)
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = ()  # Истекло время ожидания пачки
+
+            if isinstance(item, tuple) and item:
+                if not pending:
+                    deadline = time.monotonic() + self.flush_seconds
+                label_path, text, on_written = item
+                # Замененная запись тоже считается записанной
+                callbacks = pending.pop(label_path, (None, []))[1]
+                if on_written is not None:
+                    callbacks.append(on_written)
+                pending[label_path] = (text, callbacks)
+                if len(pending) < self.batch_size:
+                    continue
+
+            if pending:
+                self.write_batch(pending)
+                pending = {}
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                break
+
+    def write_batch(self, pending):
+        """Запись накопленной пачки файлов"""
+        if self.pack:
+            written = self.write_packed(pending)
+        else:
+            written = self.write_files(pending)
+        for label_path in written:
+            for on_written in pending[label_path][1]:
+                try:
+                    on_written()
+                except Exception as e:
+                    print(f"Ошибка после записи {label_path}: {str(e)}",
+                          file=sys.stderr)
+
+    def write_files(self, pending):
+        """Запись пачки в отдельные файлы, возвращает записанные пути"""
+        written = []
+        folders = set()
+        for label_path, (text, _) in pending.items():
+            try:
+                write_text_atomic(label_path, text, self.fsync != "never")
+                self.written += 1
+                written.append(label_path)
+                folders.add(os.path.dirname(label_path))
+                if self.fsync == "always":
+                    fsync_dir(os.path.dirname(label_path))
+            except Exception as e:
+                self.errors += 1
+                print(f"Ошибка записи {label_path}: {str(e)}",
+                      file=sys.stderr)
+        if self.fsync == "batch":
+            for folder in folders:
+                fsync_dir(folder)
+        return written
+
+    def write_packed(self, pending):
+        """Дописывание пачки в упакованные файлы разметки
+
+        У строки есть время записи: unpack_labels не заменяет файлы .txt,
+        исправленные после нее. Возвращает записанные пути.
+        """
+        by_pack = {}
+        now = time.time_ns()
+        for label_path, (text, _) in pending.items():
+            folder, name = os.path.split(label_path)
+            record = json.dumps({"label": name, "text": text,
+                                 "time_ns": now}, ensure_ascii=False)
+            by_pack.setdefault(os.path.join(folder, LABEL_PACK_FILE),
+                               []).append((label_path, record + "\n"))
+
+        written = []
+        for pack_path, lines in by_pack.items():
+            try:
+                with open(pack_path, "a", encoding="utf-8") as f:
+                    f.write("".join(line for _, line in lines))
+                    f.flush()
+                    if self.fsync != "never":
+                        os.fsync(f.fileno())
+                self.written += len(lines)
+                written.extend(label_path for label_path, _ in lines)
+            except Exception as e:
+                self.errors += len(lines)
+                print(f"Ошибка записи {pack_path}: {str(e)}",
+                      file=sys.stderr)
+        return written
+
+    def close(self):
+        """Дождаться записи всех файлов из очереди"""
+        self.queue.put(None)
+        self.join()
+
+
+class ProgressReporter:
+    """Печать прогресса и скорости консольной разметки
+
+    total может быть неизвестен (None), например у камеры.
+    """
+
+    def __init__(self, total, every=HEADLESS_REPORT_EVERY, unit="изобр."):
+        self.total = total
+        self.every = every
+        self.unit = unit
+        self.processed = 0
+        self.next_report = every
+        self.start = time.perf_counter()
+
+    def update(self, count):
+        """Учесть count обработанных изображений"""
+        self.processed += count
+        if self.processed >= self.next_report or self.processed == self.total:
+            self.next_report = self.processed + self.every
+            done = (f"{self.processed}/{self.total}" if self.total
+                    else f"{self.processed}")
+            print(f"[{done}] {self.rate():.2f} {self.unit}/с")
+
+    def rate(self):
+        """Скорость обработки с начала работы"""
+        return self.processed / max(self.elapsed(), 1e-9)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+
+def label_images_sequential(image_dir, label_dir, filenames, yolo_model,
+                            conf_threshold, batch_size, prefetch,
+                            decode_workers, progress, manifest, cache,
+                            detector=None, writer=None):
+    """Разметка в текущем процессе: предзагрузка, пачки, фоновая запись
+
+    writer - еще не запущенный LabelWriterThread (по умолчанию обычный).
+    Возвращает число изображений с найденными парами и число ошибок.
+    """
+    errors = 0
+    writer = writer or LabelWriterThread()
+    writer.start()
+
+    def flush_batch(batch_files, frames):
+        """Инференс пачки и постановка найденной разметки в очередь"""
+        try:
+            batch_pairs = detect_pairs_batch(yolo_model, frames,
+                                             conf_threshold, cache,
+                                             detector)
+        except Exception as e:
+            print(f"Ошибка разметки пачки {batch_files[0]}...: {str(e)}",
+                  file=sys.stderr)
+            for filename in batch_files:
+                manifest.record(image_dir, filename, "error", error=str(e))
+            return len(frames)
+
+        for filename, frame, pairs in zip(batch_files, frames, batch_pairs):
+            # НЕ создаем пустой файл разметки, если пар нет
+            if pairs:
+                # В журнал - только после записи разметки
+                writer.put(label_path_for(label_dir, filename),
+                           pairs, frame.width, frame.height,
+                           functools.partial(manifest.record, image_dir,
+                                             filename, "positive",
+                                             len(pairs)))
+            else:
+                manifest.record(image_dir, filename, "negative")
+        return 0
+
+    batch_files = []
+    frames = []
+    pending = 0
+    decoded = prefetch_images(image_dir, filenames,
+                              max(prefetch, batch_size), decode_workers)
+    for number, (filename, frame) in enumerate(decoded, start=1):
+        pending += 1
+        if frame is None:
+            errors += 1
+            print(f"Ошибка разметки {filename}: "
+                  f"Не удалось загрузить изображение", file=sys.stderr)
+            manifest.record(image_dir, filename, "error",
+                            error="Не удалось загрузить изображение")
+        else:
+            batch_files.append(filename)
+            frames.append(frame)
+
+        if len(frames) < batch_size and number < len(filenames):
+            continue
+
+        if frames:
+            errors += flush_batch(batch_files, frames)
+        batch_files = []
+        frames = []
+        progress.update(pending)
+        pending = 0
+
+    writer.close()
+    return writer.written, errors + writer.errors
+
+
+# Модель процесса-исполнителя (своя в каждом процессе пула)
+_worker_model = None
+_worker_conf = CONF_THRESHOLD
+_worker_cache = None
+_worker_detector = None
+_worker_init_error = None  # Почему процесс не смог загрузить модель
+
+
+class WorkerInitError(RuntimeError):
+    """Процесс пула не смог загрузить модель (неверный путь к весам,
+    не установлен движок инференса) - разметка невозможна"""
+
+
+def _init_worker(model_path, conf_threshold, torch_threads, cache_path,
+                 detector, backend, export_dir):
+    """Инициализация процесса пула: ограничение потоков и загрузка модели
+
+    Ошибка загрузки не роняет процесс (иначе пул сломается так же, как
+    при падении на изображении), а запоминается: каждое задание затем
+    завершается WorkerInitError.
+    """
+    global _worker_model, _worker_conf, _worker_cache, _worker_detector
+    global _worker_init_error
+    try:
+        import torch
+
+        torch.set_num_threads(torch_threads)
+        cv2.setNumThreads(1)
+        _worker_model = load_yolo(model_path, backend, export_dir)
+    except Exception as e:
+        _worker_init_error = f"{type(e).__name__}: {e}"
+        return
+    _worker_conf = conf_threshold
+    _worker_detector = detector
+    if cache_path:
+        _worker_cache = DetectionCache(cache_path, model_path,
+                                       backend=backend)
+
+
+def _label_shard(image_dir, filenames, batch_size):
+    """Разметка задания в процессе пула
+
+    Файлы не пишутся: возвращается список (имя файла, ширина, высота,
+    пары или None, текст ошибки или None), запись делает координатор.
+    """
+    if _worker_init_error is not None:
+        raise WorkerInitError(_worker_init_error)
+    results = []
+    for batch_start in range(0, len(filenames), batch_size):
+        batch_files = []
+        frames = []
+        for filename in filenames[batch_start:batch_start + batch_size]:
+            frame = DecodedFrame.try_load(os.path.join(image_dir, filename))
+            if frame is None:
+                results.append((filename, 0, 0, None,
+                                "Не удалось загрузить изображение"))
+            else:
+                batch_files.append(filename)
+                frames.append(frame)
+        if not frames:
+            continue
+
+        try:
+            batch_pairs = detect_pairs_batch(_worker_model, frames,
+                                             _worker_conf, _worker_cache,
+                                             _worker_detector)
+        except Exception as e:
+            results.extend((filename, 0, 0, None, str(e))
+                           for filename in batch_files)
+            continue
+
+        for filename, frame, pairs in zip(batch_files, frames, batch_pairs):
+            results.append((filename, frame.width, frame.height, pairs, None))
+    if _worker_cache is not None:
+        _worker_cache.flush()  # Процесс пула кэш не закрывает
+    return results
+
+
+def _run_shards(shards, image_dir, model_path, conf_threshold, batch_size,
+                workers, cache_path, on_result, detector=None,
+                backend="torch", export_dir=None):
+    """Прогон заданий из очереди shards в новом пуле процессов
+
+    Одновременно в работе не больше двух заданий на процесс, готовые
+    результаты сразу передаются в on_result. Если пул сломался из-за
+    падения процесса, возвращает задания, которые были в работе
+    (неотправленные остаются в shards); иначе пустой список.
+    WorkerInitError (процесс не загрузил модель) передается дальше.
+    """
+    torch_threads = max(1, (os.cpu_count() or 1) // workers)
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(model_path, conf_threshold, torch_threads, cache_path,
+                  detector, backend, export_dir),
+    ) as pool:
+        in_flight = {}
+        while shards or in_flight:
+            while shards and len(in_flight) < workers * 2:
+                shard = shards.popleft()
+                future = pool.submit(_label_shard, image_dir, shard,
+                                     batch_size)
+                in_flight[future] = shard
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                shard = in_flight.pop(future)
+                try:
+                    on_result(shard, future.result())
+                except BrokenProcessPool:
+                    # Пул сломан: все задания в работе придется повторить
+                    crashed = [shard] + list(in_flight.values())
+                    for other in in_flight:
+                        other.cancel()
+                    return crashed
+    return []
+
+
+def label_images_sharded(image_dir, label_dir, filenames, model_path,
+                         conf_threshold, batch_size, workers, progress,
+                         manifest, cache_path, detector=None,
+                         backend="torch", export_dir=None, writer=None):
+    """Разметка в пуле процессов, по одной модели на процесс
+
+    Список изображений делится на задания по SHARD_SIZE, координатор
+    пишет разметку по мере готовности заданий. Если процесс упал,
+    задания, бывшие в работе, повторяются по одному в отдельном
+    процессе; упавшее снова задание дробится до отдельных изображений,
+    чтобы найти сломанный файл. Готовая разметка при этом не теряется.
+    Если процессы не смогли загрузить модель, разметка прерывается
+    с WorkerInitError без дробления заданий и записей об ошибках.
+    """
+    shards = deque(
+        filenames[i:i + SHARD_SIZE]
+        for i in range(0, len(filenames), SHARD_SIZE)
+    )
+    suspects = deque()
+    errors = 0
+    writer = writer or LabelWriterThread()
+    writer.start()
+
+    def on_result(shard, shard_results):
+        nonlocal errors
+        for filename, width, height, pairs, error in shard_results:
+            if error is not None:
+                errors += 1
+                print(f"Ошибка разметки {filename}: {error}",
+                      file=sys.stderr)
+                manifest.record(image_dir, filename, "error", error=error)
+            elif pairs:
+                # НЕ создаем пустой файл разметки, если пар нет
+                writer.put(label_path_for(label_dir, filename),
+                           pairs, width, height,
+                           functools.partial(manifest.record, image_dir,
+                                             filename, "positive",
+                                             len(pairs)))
+            else:
+                manifest.record(image_dir, filename, "negative")
+        progress.update(len(shard))
+
+    try:
+        while shards or suspects:
+            if shards:
+                crashed = _run_shards(shards, image_dir, model_path,
+                                      conf_threshold, batch_size, workers,
+                                      cache_path, on_result, detector, backend,
+                                      export_dir)
+                if crashed:
+                    print(f"Процесс разметки аварийно завершился, повторяем "
+                          f"{len(crashed)} заданий по одному", file=sys.stderr)
+                suspects.extend(crashed)
+                continue
+
+            # Подозрительное задание запускаем отдельно, чтобы точно знать,
+            # на каком из них падает процесс
+            shard = suspects.popleft()
+            if not _run_shards(deque([shard]), image_dir, model_path,
+                               conf_threshold, batch_size, 1, cache_path,
+                               on_result, detector, backend, export_dir):
+                continue
+            if len(shard) > 1:
+                middle = len(shard) // 2
+                suspects.extendleft([shard[middle:], shard[:middle]])
+            else:
+                errors += 1
+                print(f"Ошибка разметки {shard[0]}: процесс разметки "
+                      f"аварийно завершился", file=sys.stderr)
+                manifest.record(image_dir, shard[0], "error",
+                                error="процесс разметки аварийно завершился")
+                progress.update(1)
+
+    finally:
+        writer.close()
+    return writer.written, errors + writer.errors
+
+
+def near_duplicate_groups(hashes, max_distance=NEAR_DUPLICATE_DISTANCE):
+    """Группы похожих изображений по хэшам {имя: хэш}
+
+    Похожесть транзитивна: изображения попадают в одну группу и через
+    цепочку похожих. Возвращает отсортированные группы из двух и более
+    имен.
+    """
+    parent = {}
+
+    def find(name):
+        while parent[name] != name:
+            parent[name] = parent[parent[name]]
+            name = parent[name]
+        return name
+
+    tree = BKTree()
+    for name in sorted(hashes):
+        parent[name] = name
+        for _, other in tree.search(hashes[name], max_distance):
+            parent[find(other)] = find(name)
+        tree.add(hashes[name], name)
+
+    groups = {}
+    for name in parent:
+        groups.setdefault(find(name), []).append(name)
+    return sorted(sorted(group) for group in groups.values()
+                  if len(group) > 1)
+
+
+def split_near_duplicates(catalog, filenames,
+                          max_distance=NEAR_DUPLICATE_DISTANCE,
+                          workers=DECODE_WORKERS):
+    """Деление изображений на те, что нужно разметить моделью, и похожие
+
+    Изображение считается похожим, если на расстоянии не больше
+    max_distance есть уже размеченное изображение или одно из ранее
+    оставленных для модели с тем же соотношением сторон (обрезанная
+    копия похожа по хэшу, но рамки на нее переносить нельзя).
+    Возвращает (список для модели, {похожее: изображение, с которого
+    взять разметку}).
+    """
+    hashes = catalog.perceptual_hashes(workers)
+    aspects = {}
+
+    def aspect(name):
+        if name not in aspects:
+            try:
+                width, height = read_image_size(
+                    os.path.join(catalog.image_dir, name)
+                )
+                aspects[name] = width / height
+            except Exception:
+                aspects[name] = None
+        return aspects[name]
+
+    def same_aspect(name, other):
+        first, second = aspect(name), aspect(other)
+        return (first is not None and second is not None
+                and abs(first - second) <= NEAR_DUPLICATE_ASPECT * first)
+
+    tree = BKTree()
+    for name, _, _ in catalog.labeled():
+        if name in hashes:
+            tree.add(hashes[name], name)
+
+    representatives = []
+    followers = {}
+    for name in filenames:
+        value = hashes.get(name)
+        found = tree.search(value, max_distance) if value is not None else []
+        source = next((other for _, other in found
+                       if same_aspect(name, other)), None)
+        if source is not None:
+            followers[name] = source
+            continue
+        representatives.append(name)
+        if value is not None:
+            tree.add(value, name)
+    return representatives, followers
+
+
+def reuse_near_duplicate_labels(image_dir, label_dir, followers, manifest,
+                                writer):
+    """Перенос разметки на похожие изображения вместо запуска модели
+
+    Разметка источника берется из файла .txt или упакованной разметки;
+    если у источника пар нет (negative в журнале), похожее тоже
+    отмечается negative. Похожие, у источника которых нет результата
+    (ошибка, прерванная разметка), остаются неразмеченными. writer -
+    еще не запущенный LabelWriterThread. Возвращает число перенесенных.
+    """
+    packed = read_packed_labels(label_dir)
+    writer.start()
+    reused = 0
+    for name, source in followers.items():
+        label_file = os.path.basename(label_path_for(label_dir, source))
+        text = packed.get(label_file)
+        if text is None:
+            try:
+                with open(os.path.join(label_dir, label_file), "r") as f:
+                    text = f.read()
+            except OSError:
+                text = None
+
+        if text is not None:
+            pairs = sum(1 for line in text.splitlines()
+                        if len(line.split()) == 5)
+            writer.put_text(label_path_for(label_dir, name), text,
+                            functools.partial(manifest.record, image_dir,
+                                              name, "positive", pairs,
+                                              duplicate_of=source))
+        elif manifest.records.get(source, {}).get("status") == "negative":
+            manifest.record(image_dir, name, "negative",
+                            duplicate_of=source)
+        else:
+            continue
+        reused += 1
+    writer.close()
+    return reused
+
+
+def run_headless(image_dir=IMAGE_DIR, label_dir=LABEL_DIR,
+                 model_path=YOLO_MODEL, conf_threshold=CONF_THRESHOLD,
+                 batch_size=BATCH_SIZE, prefetch=PREFETCH_IMAGES,
+                 decode_workers=DECODE_WORKERS, workers=WORKERS,
+                 state_dir=STATE_DIR, use_cache=True, detector=None,
+                 backend=INFERENCE_BACKEND, fsync=LABEL_FSYNC, pack=False,
+                 near_distance=None):
+    """Разметка всех неразмеченных изображений без графического интерфейса
+
+    Использует ту же логику поиска пар, что и интерфейс, но не трогает
+    холст: изображения декодируются заранее в пуле потоков, подаются
+    в модель пачками по batch_size, а файлы разметки пишет отдельный
+    поток. При workers > 1 список делится между процессами, у каждого
+    своя модель. Результаты заносятся в журнал заданий, поэтому повторный
+    запуск пропускает уже проверенные изображения без пар, а сырые
+    детекции кэшируются (use_cache). detector (DetectorConfig) задает
+    классы, пороги, размер входа модели и тайлы. backend выбирает движок
+    инференса (модель экспортируется один раз до запуска процессов).
+    Разметка пишется атомарно с политикой fsync, при pack=True -
+    в упакованный файл (см. unpack_labels). Модель запускается на одном
+    изображении из группы похожих (перцептивный хэш не дальше
+    near_distance, по умолчанию None - не искать), остальным разметка
+    переносится (split_near_duplicates). В консоль выводится скорость обработки
+    (изображений в секунду).
+    """
+    os.makedirs(label_dir, exist_ok=True)
+    catalog = ImageCatalog(os.path.join(state_dir, CATALOG_FILE),
+                           image_dir, label_dir)
+    catalog.refresh()
+    unlabeled_images = catalog.unlabeled()
+    # Подпись модели в журнале и кэше - по файлу весов, поэтому веса
+    # скачиваются до их открытия (и только если есть что размечать)
+    if unlabeled_images:
+        model_path = resolve_model_path(model_path)
+    manifest = JobManifest(os.path.join(state_dir, MANIFEST_FILE),
+                           model_path, conf_threshold, detector, backend)
+    manifest.packed = pack
+    unlabeled_images = [
+        filename
+        for filename in unlabeled_images
+        if manifest.needs_processing(image_dir, label_dir, filename)
+    ]
+    followers = {}
+    if near_distance is not None and unlabeled_images:
+        unlabeled_images, followers = split_near_duplicates(
+            catalog, unlabeled_images, near_distance, decode_workers
+        )
+    catalog.close()
+    total = len(unlabeled_images)
+    if not total and not followers:
+        manifest.close()
+        print("Все изображения уже размечены или проверены")
+        return
+    if followers:
+        print(f"Похожих на другие изображения: {len(followers)}, "
+              f"разметка будет перенесена без запуска модели")
+
+    batch_size = max(1, batch_size)
+    print(f"Найдено {total} неразмеченных изображений")
+    cache_path = (os.path.join(state_dir, DETECTION_CACHE_FILE)
+                  if use_cache else None)
+    export_dir = os.path.join(state_dir, EXPORT_DIR)
+    writer = LabelWriterThread(fsync=fsync, pack=pack)
+
+    progress = ProgressReporter(total)
+    positive = errors = 0
+    if not total:
+        pass  # Все неразмеченные похожи на уже размеченные
+    elif workers > 1:
+        if backend != "torch":
+            export_model(model_path, backend, export_dir)
+        try:
+            positive, errors = label_images_sharded(
+                image_dir, label_dir, unlabeled_images, model_path,
+                conf_threshold, batch_size, workers, progress, manifest,
+                cache_path, detector, backend, export_dir, writer
+            )
+        except WorkerInitError:
+            manifest.close()
+            raise
+    else:
+        yolo_model = load_yolo(model_path, backend, export_dir)
+        cache = (DetectionCache(cache_path, model_path, backend=backend)
+                 if cache_path else None)
+        positive, errors = label_images_sequential(
+            image_dir, label_dir, unlabeled_images, yolo_model,
+            conf_threshold, batch_size, prefetch, decode_workers, progress,
+            manifest, cache, detector, writer
+        )
+        if cache:
+            cache.close()
+    reused = reuse_near_duplicate_labels(
+        image_dir, label_dir, followers, manifest,
+        LabelWriterThread(fsync=fsync, pack=pack)
+    )
+    manifest.close()
+
+    elapsed = progress.elapsed()
+    print(f"Готово: {total} изображений за {elapsed:.1f} с "
+          f"({progress.rate():.2f} изобр./с), с парами: {positive}, "
+          f"ошибок: {errors}, разметка перенесена на похожие: {reused}")
+
+
+def match_detections(reference, candidate, min_iou=PARITY_MIN_IOU):
+    """Число рамок reference, которым нашлась своя рамка в candidate
+
+    Рамки сопоставляются жадно по убыванию уверенности: тот же класс
+    и IoU не меньше min_iou, каждая рамка candidate - не больше одной.
+    """
+    if not len(reference) or not len(candidate):
+        return 0
+    reference = reference[np.argsort(-reference[:, 4], kind="stable")]
+    iou = iou_matrix(reference[:, :4], candidate[:, :4])
+    iou[reference[:, None, 5] != candidate[None, :, 5]] = 0
+    free = np.ones(len(candidate), dtype=bool)
+    matched = 0
+    for row in iou:
+        row = np.where(free, row, 0)
+        best = int(np.argmax(row))
+        if row[best] >= min_iou:
+            free[best] = False
+            matched += 1
+    return matched
+
+
+def check_backend_parity(image_dir=IMAGE_DIR, model_path=YOLO_MODEL,
+                         backend=INFERENCE_BACKEND,
+                         conf_threshold=CONF_THRESHOLD, state_dir=STATE_DIR,
+                         samples=PARITY_SAMPLES, detector=None):
+    """Сверка ускоренного движка с torch на первых samples изображениях
+
+    Сравниваются уверенные рамки нужных классов (см. match_detections)
+    и число найденных пар. Печатает отчет и возвращает True, если доля
+    совпавших рамок не меньше PARITY_MIN_AGREEMENT.
+    """
+    filenames = sorted(
+        name for name in os.listdir(image_dir)
+        if name.lower().endswith(SUPPORTED_FORMATS)
+    )[:samples]
+    reference_model = load_yolo(model_path)
+    candidate_model = load_yolo(model_path, backend,
+                                os.path.join(state_dir, EXPORT_DIR))
+
+    matched = 0
+    total = 0
+    pair_mismatches = 0
+    seconds = {"torch": 0.0, backend: 0.0}
+    for filename in filenames:
+        frame = DecodedFrame.try_load(os.path.join(image_dir, filename))
+        if frame is None:
+            continue
+        found = {}
+        for name, yolo_model in (("torch", reference_model),
+                                 (backend, candidate_model)):
+            start = time.perf_counter()
+            detections = detect_frames(yolo_model, [frame],
+                                       detector=detector)[0]
+            seconds[name] += time.perf_counter() - start
+            found[name] = detections[detections[:, 4] >= conf_threshold]
+
+        reference, candidate = found["torch"], found[backend]
+        matched += match_detections(reference, candidate)
+        total += max(len(reference), len(candidate))
+        if (len(find_twowheeledhuman_pairs(reference, conf_threshold))
+                != len(find_twowheeledhuman_pairs(candidate,
+                                                  conf_threshold))):
+            pair_mismatches += 1
+
+    agreement = matched / total if total else 1.0
+    print(f"Сверка {backend} с torch на {len(filenames)} изображениях: "
+          f"совпало рамок {matched} из {total} ({agreement:.1%}), "
+          f"изображений с другим числом пар: {pair_mismatches}")
+    print(f"Время модели: torch {seconds['torch']:.1f} с, "
+          f"{backend} {seconds[backend]:.1f} с")
+    return agreement >= PARITY_MIN_AGREEMENT
+
+
+def unique_name(filename, taken_stems):
+    """Имя, основа которого не занята ни изображением, ни разметкой
+
+    taken_stems - основы имен (без расширения), в него же добавляется
+    выбранная. При совпадении к имени добавляется _1, _2 и т.д.
+    """
+    stem, ext = os.path.splitext(filename)
+    candidate = stem
+    counter = 1
+    while candidate in taken_stems:
+        candidate = f"{stem}_{counter}"
+        counter += 1
+    taken_stems.add(candidate)
+    return candidate + ext
+
+
+def add_tar_member(tar, name, data, mtime):
+    """Добавление файла в tar, возвращает смещение его данных в архиве"""
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = mtime
+    offset = tar.offset + len(info.tobuf(tar.format, tar.encoding,
+                                         tar.errors))
+    tar.addfile(info, io.BytesIO(data))
+    return offset
+
+
+def close_dataset_shard(tar, path, samples):
+    """Закрытие шарда: перенос под постоянное имя и описание для индекса"""
+    tar.close()
+    os.replace(path + ".tmp", path)
+    return {
+        "name": os.path.basename(path),
+        "samples": samples,
+        "bytes": os.path.getsize(path),
+        "sha1": file_sha1(path),
+    }
+
+
+def export_dataset(out_dir, image_dir=IMAGE_DIR, label_dir=LABEL_DIR,
+                   state_dir=STATE_DIR, shard_mb=DATASET_SHARD_MB):
+    """Упаковка размеченных изображений в шарды tar для обучения
+
+    Список образцов берется из каталога (ImageCatalog) после
+    обновления, файлы читаются по одному и сверяются с каталогом:
+    при другом размере изображения или числе аннотаций образец
+    пропускается и попадает в список проблем. Индекс (DATASET_INDEX_FILE)
+    хранит для каждого образца шард, смещения и размеры файлов внутри
+    него и SHA-1 содержимого, так что образец можно прочитать из шарда
+    напрямую, без разбора tar. Возвращает (число образцов, проблемы).
+    """
+    if os.path.exists(os.path.join(label_dir, LABEL_PACK_FILE)):
+        return 0, ["разметка упакована, сначала выполните --unpack-labels"]
+    catalog = ImageCatalog(os.path.join(state_dir, CATALOG_FILE),
+                           image_dir, label_dir)
+    catalog.refresh()
+    entries = catalog.labeled()
+    catalog.close()
+
+    os.makedirs(out_dir, exist_ok=True)
+    shard_limit = max(1, shard_mb) * 1024 * 1024
+    mtime = int(time.time())
+    shards = []
+    samples = []
+    problems = []
+    tar = None
+    shard_path = None
+    shard_samples = 0
+    for name, size, annotations in entries:
+        try:
+            with open(os.path.join(image_dir, name), "rb") as f:
+                image = f.read()
+            with open(label_path_for(label_dir, name), "rb") as f:
+                label = f.read()
+        except OSError as e:
+            problems.append(f"{name}: {e}")
+            continue
+        found = sum(1 for line in label.splitlines()
+                    if len(line.split()) == 5)
+        if len(image) != size or found != annotations:
+            problems.append(
+                f"{name}: не совпадает с каталогом (размер {len(image)} "
+                f"из {size}, аннотаций {found} из {annotations})"
+            )
+            continue
+
+        # Заголовки двух файлов и выравнивание - не больше 4 блоков
+        sample_bytes = len(image) + len(label) + 4 * tarfile.BLOCKSIZE
+        if tar is not None and tar.offset + sample_bytes > shard_limit:
+            shards.append(close_dataset_shard(tar, shard_path,
+                                              shard_samples))
+            tar = None
+        if tar is None:
+            shard_path = os.path.join(
+                out_dir, DATASET_SHARD_PATTERN.format(len(shards))
+            )
+            tar = tarfile.open(shard_path + ".tmp", "w",
+                               format=tarfile.USTAR_FORMAT)
+            shard_samples = 0
+
+        key = f"{len(samples):08d}"
+        image_member = key + os.path.splitext(name)[1].lower()
+        label_member = key + ".txt"
+        image_offset = add_tar_member(tar, image_member, image, mtime)
+        label_offset = add_tar_member(tar, label_member, label, mtime)
+        samples.append({
+            "key": key,
+            "name": name,
+            "shard": os.path.basename(shard_path),
+            "image_member": image_member,
+            "image_offset": image_offset,
+            "image_size": len(image),
+            "image_sha1": hashlib.sha1(image).hexdigest(),
+            "label_member": label_member,
+            "label_offset": label_offset,
+            "label_size": len(label),
+            "label_sha1": hashlib.sha1(label).hexdigest(),
+            "annotations": annotations,
+        })
+        shard_samples += 1
+    if tar is not None:
+        shards.append(close_dataset_shard(tar, shard_path, shard_samples))
+
+    # Шарды прошлой выгрузки, которых нет в новом индексе
+    shard_prefix = DATASET_SHARD_PATTERN.split("{")[0]
+    written = {shard["name"] for shard in shards}
+    for filename in os.listdir(out_dir):
+        if (filename.startswith(shard_prefix) and filename.endswith(".tar")
+                and filename not in written):
+            os.remove(os.path.join(out_dir, filename))
+
+    index = {"version": 1, "created": mtime, "shards": shards,
+             "samples": samples}
+    write_text_atomic(os.path.join(out_dir, DATASET_INDEX_FILE),
+                      json.dumps(index, ensure_ascii=False, indent=1))
+    return len(samples), problems
+
+
+def load_dataset_index(archive_dir):
+    """Индекс упакованного набора данных"""
+    with open(os.path.join(archive_dir, DATASET_INDEX_FILE), "r",
+              encoding="utf-8") as f:
+        return json.load(f)
+
+
+def check_dataset_shard(path, shard):
+    """Описание проблемы с файлом шарда или None, если шард цел"""
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return f"{shard['name']}: файл не найден"
+    if size != shard["bytes"]:
+        return f"{shard['name']}: размер {size} вместо {shard['bytes']}"
+    if file_sha1(path) != shard["sha1"]:
+        return f"{shard['name']}: содержимое повреждено"
+    return None
+
+
+def read_dataset_samples(archive_dir, index, problems):
+    """Образцы упакованного набора: (описание, изображение, разметка)
+
+    Шарды открываются через mmap, файлы берутся по смещениям из индекса
+    без разбора tar и сверяются с хэшами. Поврежденные шарды и образцы
+    пропускаются, описание проблемы добавляется в problems.
+    """
+    by_shard = {}
+    for sample in index["samples"]:
+        by_shard.setdefault(sample["shard"], []).append(sample)
+
+    for shard in index["shards"]:
+        path = os.path.join(archive_dir, shard["name"])
+        problem = check_dataset_shard(path, shard)
+        if problem:
+            problems.append(problem)
+            continue
+        with open(path, "rb") as f, mmap.mmap(
+                f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for sample in by_shard.get(shard["name"], ()):
+                image_offset = sample["image_offset"]
+                label_offset = sample["label_offset"]
+                image = data[image_offset:image_offset + sample["image_size"]]
+                label = data[label_offset:label_offset + sample["label_size"]]
+                if (hashlib.sha1(image).hexdigest() != sample["image_sha1"]
+                        or hashlib.sha1(label).hexdigest()
+                        != sample["label_sha1"]):
+                    problems.append(f"{sample['name']}: смещения в индексе "
+                                    f"не совпадают с шардом")
+                    continue
+                yield sample, image, label
+
+
+def verify_dataset(archive_dir, image_dir=None, label_dir=LABEL_DIR,
+                   state_dir=STATE_DIR):
+    """Проверка упакованного набора, возвращает список проблем
+
+    Проверяются хэши шардов и каждого образца и число аннотаций в его
+    разметке. Если задана image_dir, набор сверяется с каталогом: каждое
+    размеченное изображение должно быть в наборе с тем же размером
+    и числом аннотаций.
+    """
+    index = load_dataset_index(archive_dir)
+    problems = []
+    for sample, _, label in read_dataset_samples(archive_dir, index,
+                                                 problems):
+        found = sum(1 for line in label.splitlines()
+                    if len(line.split()) == 5)
+        if found != sample["annotations"]:
+            problems.append(f"{sample['name']}: аннотаций {found} "
+                            f"вместо {sample['annotations']}")
+
+    if image_dir is not None:
+        catalog = ImageCatalog(os.path.join(state_dir, CATALOG_FILE),
+                               image_dir, label_dir)
+        catalog.refresh()
+        entries = catalog.labeled()
+        catalog.close()
+        packed = {sample["name"]: sample for sample in index["samples"]}
+        for name, size, annotations in entries:
+            sample = packed.get(name)
+            if sample is None:
+                problems.append(f"{name}: нет в наборе")
+            elif (sample["image_size"] != size
+                  or sample["annotations"] != annotations):
+                problems.append(f"{name}: в наборе другая версия")
+    return problems
+
+
+def import_dataset(archive_dir, image_dir=IMAGE_DIR, label_dir=LABEL_DIR,
+                   state_dir=STATE_DIR, fsync=LABEL_FSYNC):
+    """Распаковка набора из шардов в папки изображений и разметки
+
+    Образцы проверяются по хэшам из индекса. Изображение, которое уже
+    есть в папке с тем же содержимым (под любым именем, по хэшам
+    каталога), не копируется повторно, а его разметка не перезаписывается,
+    если она есть. Если основа имени занята другим изображением или
+    файлом разметки (a.png и a.txt при импорте a.jpg), к имени
+    добавляется номер. Файлы пишутся атомарно с политикой fsync. После
+    распаковки каталог обновляется и сверяется с индексом. Возвращает
+    (распаковано, пропущено, проблемы).
+    """
+    index = load_dataset_index(archive_dir)
+    os.makedirs(image_dir, exist_ok=True)
+    os.makedirs(label_dir, exist_ok=True)
+    catalog = ImageCatalog(os.path.join(state_dir, CATALOG_FILE),
+                           image_dir, label_dir)
+    catalog.refresh()
+    known = catalog.content_hashes(
+        {sample["image_size"] for sample in index["samples"]}
+    )
+    taken_stems = {os.path.splitext(name)[0]
+                   for folder in (image_dir, label_dir)
+                   for name in os.listdir(folder)}
+    problems = []
+    imported = {}
+    skipped = 0
+    for sample, image, label in read_dataset_samples(archive_dir, index,
+                                                     problems):
+        name = known.get(sample["image_sha1"])
+        if name is not None:
+            if os.path.exists(label_path_for(label_dir, name)):
+                skipped += 1
+                continue
+        else:
+            name = unique_name(sample["name"], taken_stems)
+            write_text_atomic(os.path.join(image_dir, name), image,
+                              fsync != "never")
+            known[sample["image_sha1"]] = name
+        write_text_atomic(label_path_for(label_dir, name), label,
+                          fsync != "never")
+        imported[name] = sample["annotations"]
+    if fsync != "never":
+        fsync_dir(image_dir)
+        fsync_dir(label_dir)
+
+    catalog.refresh()
+    labeled = {name: annotations
+               for name, _, annotations in catalog.labeled()}
+    catalog.close()
+    for name, annotations in imported.items():
+        if labeled.get(name) != annotations:
+            problems.append(f"{name}: после распаковки не совпадает "
+                            f"с каталогом")
+    return len(imported), skipped, problems
+
+
+def clone_file(source, dest):
+    """Копия с общими блоками (ioctl FICLONE), False - не поддерживается"""
+    try:
+        import fcntl
+    except ImportError:
+        return False  # Windows
+    with open(source, "rb") as src, open(dest, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            return False
+    return True
+
+
+def transfer_file(source, dest, mode=IMPORT_MODE):
+    """Перенос файла в папку набора, возвращает способ: link, clone, copy
+
+    hardlink пробует жесткую ссылку, reflink - копию с общими блоками,
+    если не вышло (другая файловая система) - обычное копирование
+    shutil.copyfile, которое на Linux идет через os.sendfile и не читает
+    файл целиком в память. Копия появляется под именем dest только
+    полностью записанной.
+    """
+    if mode == "hardlink":
+        try:
+            os.link(source, dest)
+            return "link"
+        except OSError:
+            pass
+    tmp_path = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        if mode == "reflink" and clone_file(source, tmp_path):
+            method = "clone"
+        else:
+            shutil.copyfile(source, tmp_path)
+            method = "copy"
+        os.replace(tmp_path, dest)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return method
+
+
+def iter_import_files(paths, supported_formats=SUPPORTED_FORMATS):
+    """Изображения из списка файлов и папок (папки обходятся рекурсивно)"""
+    for path in paths:
+        if not os.path.isdir(path):
+            if path.lower().endswith(supported_formats):
+                yield path
+            continue
+        for folder, dirs, files in os.walk(path):
+            dirs.sort()
+            for filename in sorted(files):
+                if filename.lower().endswith(supported_formats):
+                    yield os.path.join(folder, filename)
+
+
+def import_images(paths, image_dir=IMAGE_DIR, label_dir=LABEL_DIR,
+                  state_dir=STATE_DIR, mode=IMPORT_MODE,
+                  workers=IMPORT_WORKERS, progress=None, stop_event=None):
+    """Массовое добавление изображений из файлов и папок
+
+    Дубликаты определяются по содержимому, а не по имени: SHA-1 считается
+    только у файлов, размер которых совпадает с размером уже имеющегося
+    или другого добавляемого изображения (хэши имеющихся хранит каталог).
+    Свободные имена выбираются по каталогу, без проверки файлов на диске.
+    Файлы переносятся transfer_file в пуле из workers потоков; progress
+    (ProgressReporter) получает общее число файлов и учитывает каждый
+    обработанный, stop_event отменяет еще не начатые переносы.
+    Возвращает (добавлено, дубликатов, ошибки).
+    """
+    os.makedirs(image_dir, exist_ok=True)
+    os.makedirs(label_dir, exist_ok=True)
+    sources = []
+    errors = []
+    for path in iter_import_files(paths):
+        try:
+            sources.append((path, os.path.getsize(path)))
+        except OSError as e:
+            errors.append(f"{path}: {e}")
+    if progress is not None:
+        progress.total = len(sources)
+
+    catalog = ImageCatalog(os.path.join(state_dir, CATALOG_FILE),
+                           image_dir, label_dir)
+    catalog.refresh()
+    existing_sizes = catalog.sizes()
+    source_sizes = {}
+    for _, size in sources:
+        source_sizes[size] = source_sizes.get(size, 0) + 1
+    suspect = {size for size, count in source_sizes.items()
+               if count > 1 or size in existing_sizes}
+    workers = max(1, workers)
+    known = catalog.content_hashes(suspect, workers)
+
+    def hash_source(path):
+        try:
+            return file_sha1(path)
+        except OSError as e:
+            return e
+
+    to_hash = [path for path, size in sources if size in suspect]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        hashes = dict(zip(to_hash, pool.map(hash_source, to_hash)))
+
+    taken_stems = {os.path.splitext(name)[0]
+                   for name, _, _ in catalog.rows()}
+    taken_stems.update(os.path.splitext(name)[0]
+                       for name in os.listdir(label_dir)
+                       if name.endswith(".txt"))
+    planned = []
+    duplicates = 0
+    for path, _ in sources:
+        sha1 = hashes.get(path)
+        if isinstance(sha1, OSError):
+            errors.append(f"{path}: {sha1}")
+            sha1 = None
+        elif sha1 is not None:
+            if sha1 in known:
+                duplicates += 1
+                if progress is not None:
+                    progress.update(1)
+                continue
+            known[sha1] = path
+        planned.append((path, unique_name(os.path.basename(path),
+                                          taken_stems), sha1))
+
+    imported = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(transfer_file, path, os.path.join(image_dir, name),
+                        mode): (path, name, sha1)
+            for path, name, sha1 in planned
+        }
+        for future in as_completed(futures):
+            path, name, sha1 = futures[future]
+            if future.cancelled():
+                continue
+            try:
+                future.result()
+                imported.append((sha1, name))
+            except OSError as e:
+                errors.append(f"{path}: {e}")
+            if progress is not None:
+                progress.update(1)
+            if stop_event is not None and stop_event.is_set():
+                for pending in futures:
+                    pending.cancel()
+
+    catalog.refresh()
+    catalog.set_hashes([(sha1, name) for sha1, name in imported
+                        if sha1 is not None])
+    catalog.close()
+    return len(imported), duplicates, errors
+
+
+class BoxTracker:
+    """Перенос рамок детекций с ключевого кадра на следующие кадры
+
+    Внутри каждой рамки выбираются точки, они отслеживаются
+    пирамидальным оптическим потоком Лукаса-Канаде вперед и обратно.
+    Рамка сдвигается на медианное смещение надежных точек и
+    масштабируется по медианному изменению их разброса. Уверенность
+    рамки - доля надежных точек; уверенность кадра - минимальная по
+    рамкам.
+    """
+
+    def __init__(self, max_points=TRACK_POINTS, fb_error=TRACK_FB_ERROR):
+        self.max_points = max_points
+        self.fb_error = fb_error
+        self.gray = None
+        self.detections = np.zeros((0, 6), dtype=np.float32)
+
+    def start(self, gray, detections):
+        """Новый ключевой кадр и его детекции"""
+        self.gray = gray
+        self.detections = detections
+
+    def box_points(self, box):
+        """Точки для отслеживания внутри рамки: углы изображения или
+        равномерная сетка, если углов не нашлось"""
+        height, width = self.gray.shape
+        x1, y1, x2, y2 = np.clip(box, 0, [width, height, width, height])
+        x1, y1 = int(x1), int(y1)
+        x2, y2 = int(np.ceil(x2)), int(np.ceil(y2))
+        if x2 - x1 < 2 or y2 - y1 < 2:
+            return np.zeros((0, 2), dtype=np.float32)
+        corners = cv2.goodFeaturesToTrack(self.gray[y1:y2, x1:x2],
+                                          self.max_points, 0.01, 3)
+        if corners is not None and len(corners) >= 4:
+            return corners.reshape(-1, 2) + np.float32([x1, y1])
+        side = int(np.sqrt(self.max_points))
+        grid_x, grid_y = np.meshgrid(np.linspace(x1, x2 - 1, side + 2)[1:-1],
+                                     np.linspace(y1, y2 - 1, side + 2)[1:-1])
+        return np.stack([grid_x.ravel(), grid_y.ravel()],
+                        axis=1).astype(np.float32)
+
+    def update(self, gray):
+        """Перенос рамок на кадр gray
+
+        Возвращает (детекции, уверенность); перенесенные рамки становятся
+        исходными для следующего кадра.
+        """
+        if not len(self.detections):
+            self.gray = gray
+            return self.detections, 1.0
+
+        points = [self.box_points(det[:4]) for det in self.detections]
+        owners = np.repeat(np.arange(len(points)),
+                           [len(p) for p in points])
+        start = np.concatenate(points).reshape(-1, 1, 2)
+        if not len(start):
+            return self.detections, 0.0
+
+        moved, forward_ok, _ = cv2.calcOpticalFlowPyrLK(self.gray, gray,
+                                                        start, None)
+        back, backward_ok, _ = cv2.calcOpticalFlowPyrLK(gray, self.gray,
+                                                        moved, None)
+        start = start.reshape(-1, 2)
+        moved = moved.reshape(-1, 2)
+        error = np.linalg.norm(back.reshape(-1, 2) - start, axis=1)
+        good = ((forward_ok.ravel() == 1) & (backward_ok.ravel() == 1)
+                & (error < self.fb_error))
+
+        height, width = gray.shape
+        limits = [width, height, width, height]
+        tracked = self.detections.copy()
+        confidence = 1.0
+        for i, det in enumerate(self.detections):
+            mask = good & (owners == i)
+            total = np.count_nonzero(owners == i)
+            confidence = min(confidence, mask.sum() / max(total, 1))
+            if mask.sum() < 2:
+                continue
+            before, after = start[mask], moved[mask]
+            shift = np.median(after - before, axis=0)
+            spread_before = np.median(
+                np.abs(before - np.median(before, axis=0)))
+            spread_after = np.median(np.abs(after - np.median(after, axis=0)))
+            scale = (spread_after / spread_before if spread_before > 0
+                     else 1.0)
+            center = (det[:2] + det[2:4]) / 2 + shift
+            half = (det[2:4] - det[:2]) / 2 * scale
+            box = np.clip(np.concatenate([center - half, center + half]),
+                          0, limits)
+            if box[2] - box[0] < 2 or box[3] - box[1] < 2:
+                confidence = 0.0  # Объект ушел из кадра
+            tracked[i, :4] = box
+
+        self.gray = gray
+        self.detections = tracked
+        return tracked, confidence
+
+
+def open_video_source(source):
+    """Открытие видеофайла или камеры (номер устройства, например "0")"""
+    capture = cv2.VideoCapture(int(source) if str(source).isdigit()
+                               else source)
+    if not capture.isOpened():
+        raise ValueError(f"Не удалось открыть видео {source}")
+    return capture
+
+
+def video_frame_prefix(source):
+    """Начало имени файлов кадров: имя видео или номер камеры"""
+    if str(source).isdigit():
+        return f"camera{source}"
+    return os.path.splitext(os.path.basename(source))[0]
+
+
+def frame_signature(pixels):
+    """Маленькая серая копия кадра для поиска почти одинаковых кадров"""
+    gray = cv2.cvtColor(pixels, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (VIDEO_SIGNATURE_SIZE, VIDEO_SIGNATURE_SIZE),
+                       interpolation=cv2.INTER_AREA)
+    return small.astype(np.float32) / 255
+
+
+def iter_video_frames(capture, stride=VIDEO_FRAME_STRIDE,
+                      min_change=VIDEO_MIN_CHANGE, progress=None,
+                      stop_event=None):
+    """Кадры видео с шагом stride без почти одинаковых подряд
+
+    Генератор: в памяти одновременно только текущий кадр. Пропущенные
+    по шагу кадры не декодируются (grab без retrieve). Кадр пропускается,
+    если он почти не отличается от предыдущего выданного (статичная
+    сцена, стоящая камера). Возвращает пары (номер кадра, DecodedFrame).
+    """
+    stride = max(1, stride)
+    last_signature = None
+    index = -1
+    while stop_event is None or not stop_event.is_set():
+        if not capture.grab():
+            break
+        index += 1
+        if progress:
+            progress.update(1)
+        if index % stride:
+            continue
+        ok, pixels = capture.retrieve()
+        if not ok:
+            break
+
+        signature = frame_signature(pixels)
+        if (last_signature is not None
+                and np.abs(signature - last_signature).mean() < min_change):
+            continue
+        last_signature = signature
+        yield index, DecodedFrame(pixels)
+
+
+def write_frame_image(path, pixels):
+    """Атомарная запись кадра в JPEG (и по путям с кириллицей)"""
+    ok, data = cv2.imencode(".jpg", pixels,
+                            [cv2.IMWRITE_JPEG_QUALITY, VIDEO_JPEG_QUALITY])
+    if not ok:
+        raise ValueError(f"Не удалось закодировать кадр {path}")
+    write_text_atomic(path, data.tobytes())
+
+
+def ingest_video(source, image_dir, label_dir, yolo_model,
+                 conf_threshold=CONF_THRESHOLD, batch_size=BATCH_SIZE,
+                 stride=VIDEO_FRAME_STRIDE, min_change=VIDEO_MIN_CHANGE,
+                 keyframe_interval=VIDEO_KEYFRAME_INTERVAL, progress=None,
+                 stop_event=None, detector=None):
+    """Разметка кадров видео или камеры
+
+    Кадры из iter_video_frames проходят тот же поиск пар, что
+    и изображения. При keyframe_interval <= 1 каждый кадр подается
+    в модель (пачками по batch_size); иначе модель запускается только
+    на ключевых кадрах, а между ними рамки переносит BoxTracker.
+    В image_dir и label_dir записываются только кадры с найденными
+    парами (кадр JPEG и его разметка), остальные отбрасываются. Имя
+    кадра - <видео>_<номер кадра>.jpg; если основа имени уже занята
+    (повторный прогон того же видео, другое видео с тем же именем,
+    новый сеанс камеры), к ней добавляется номер - существующие кадры
+    и разметка не перезаписываются. Возвращает число обработанных
+    кадров, число запусков модели на кадре и число записанных кадров.
+    """
+    os.makedirs(image_dir, exist_ok=True)
+    os.makedirs(label_dir, exist_ok=True)
+    prefix = video_frame_prefix(source)
+    taken_stems = {os.path.splitext(name)[0]
+                   for folder in (image_dir, label_dir)
+                   for name in os.listdir(folder)}
+    capture = open_video_source(source)
+    writer = LabelWriterThread()
+    writer.start()
+    sampled = 0
+    detected = 0
+    written = 0
+
+    def save_frame(index, frame, pairs):
+        nonlocal written
+        # Кадры без пар не сохраняем
+        if not pairs:
+            return
+        filename = unique_name(f"{prefix}_{index:06d}.jpg", taken_stems)
+        write_frame_image(os.path.join(image_dir, filename), frame.pixels)
+        writer.put(label_path_for(label_dir, filename),
+                   pairs, frame.width, frame.height)
+        written += 1
+
+    def flush_batch(indices, frames):
+        batch_pairs = detect_pairs_batch(yolo_model, frames, conf_threshold,
+                                         detector=detector)
+        for index, frame, pairs in zip(indices, frames, batch_pairs):
+            save_frame(index, frame, pairs)
+
+    frames_iter = iter_video_frames(capture, stride, min_change, progress,
+                                    stop_event)
+    try:
+        if keyframe_interval > 1:
+            tracker = BoxTracker()
+            since_keyframe = keyframe_interval
+            for index, frame in frames_iter:
+                sampled += 1
+                gray = cv2.cvtColor(frame.pixels, cv2.COLOR_BGR2GRAY)
+                detections = None
+                if since_keyframe < keyframe_interval:
+                    detections, confidence = tracker.update(gray)
+                    if confidence < TRACK_MIN_CONFIDENCE:
+                        detections = None
+                if detections is None:
+                    # Ключевой кадр: полный запуск детектора
+                    detections = detect_frames(yolo_model, [frame],
+                                               detector=detector)[0]
+                    detections = detections[detections[:, 4]
+                                            >= conf_threshold]
+                    tracker.start(gray, detections)
+                    detected += 1
+                    since_keyframe = 0
+                since_keyframe += 1
+                save_frame(index, frame,
+                           find_twowheeledhuman_pairs(detections,
+                                                      conf_threshold))
+        else:
+            indices = []
+            frames = []
+            for index, frame in frames_iter:
+                sampled += 1
+                indices.append(index)
+                frames.append(frame)
+                if len(frames) >= batch_size:
+                    flush_batch(indices, frames)
+                    indices = []
+                    frames = []
+            if frames:
+                flush_batch(indices, frames)
+            detected = sampled
+    finally:
+        capture.release()
+        writer.close()
+    return sampled, detected, written
+
+
+def run_video(source, image_dir=IMAGE_DIR, label_dir=LABEL_DIR,
+              model_path=YOLO_MODEL, conf_threshold=CONF_THRESHOLD,
+              batch_size=BATCH_SIZE, stride=VIDEO_FRAME_STRIDE,
+              min_change=VIDEO_MIN_CHANGE,
+              keyframe_interval=VIDEO_KEYFRAME_INTERVAL, detector=None,
+              backend=INFERENCE_BACKEND, state_dir=STATE_DIR):
+    """Консольная разметка кадров видео с выводом скорости (кадров/с)"""
+    yolo_model = load_yolo(model_path, backend,
+                           os.path.join(state_dir, EXPORT_DIR))
+    capture = open_video_source(source)
+    total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT)) or None
+    capture.release()
+
+    progress = ProgressReporter(total, unit="кадр.")
+    sampled, detected, written = ingest_video(
+        source, image_dir, label_dir, yolo_model, conf_threshold,
+        max(1, batch_size), stride, min_change, keyframe_interval, progress,
+        detector=detector
+    )
+    print(f"Готово: {progress.processed} кадров за "
+          f"{progress.elapsed():.1f} с ({progress.rate():.2f} кадр./с), "
+          f"обработано: {sampled}, из них моделью: {detected}, "
+          f"сохранено с парами: {written}")
+
+
+class VirtualListbox:
+    """Список для очень больших наборов: рисуются только видимые строки
+
+    Повторяет нужную часть интерфейса tk.Listbox (pack, bind, get,
+    curselection, selection_set, selection_clear, see, itemconfig, yview
+    и событие <<ListboxSelect>>), но хранит элементы в списке Python и
+    словаре имя -> строка. Поиск строки по имени занимает O(1), а
+    перерисовка зависит только от высоты окна, а не от числа элементов.
+    Виджет - рамка frame с холстом внутри (класс не наследует tk.Frame,
+    чтобы модуль загружался без Tk).
+    """
+
+    SELECT_BG = "#0078d7"
+    SELECT_FG = "white"
+
+    def __init__(self, master, width=30, **kwargs):
+        self.frame = tk.Frame(master, **kwargs)
+        self.font = tkfont.nametofont("TkDefaultFont")
+        self.row_height = self.font.metrics("linespace") + 2
+        self.canvas = tk.Canvas(self.frame,
+                                width=self.font.measure("0") * width,
+                                bg="white", highlightthickness=1,
+                                takefocus=1)
+        self.canvas.pack(expand=True, fill=tk.BOTH)
+
+        self.items = []
+        self.positions = {}  # имя -> номер строки
+        self.colors = {}  # номер строки -> цвет фона
+        self.selected = None
+        self.top = 0  # Первая видимая строка
+        self.yscrollcommand = None
+        self.row_items = []  # Переиспользуемые элементы холста строк
+
+        self.canvas.bind("<Configure>", lambda event: self.redraw())
+        self.canvas.bind("<Button-1>", self.on_click)
+        self.canvas.bind("<MouseWheel>", self.on_mouse_wheel)
+        self.canvas.bind("<Button-4>", lambda event: self.scroll(-3))
+        self.canvas.bind("<Button-5>", lambda event: self.scroll(3))
+        self.canvas.bind("<Up>", lambda event: self.move_selection(-1))
+        self.canvas.bind("<Down>", lambda event: self.move_selection(1))
+        self.canvas.bind("<Prior>", lambda event: self.move_selection(
+            -self.visible_rows()))
+        self.canvas.bind("<Next>", lambda event: self.move_selection(
+            self.visible_rows()))
+        self.canvas.bind("<Home>", lambda event: self.move_selection(
+            -len(self.items)))
+        self.canvas.bind("<End>", lambda event: self.move_selection(
+            len(self.items)))
+
+    def config(self, **kwargs):
+        """Как у tk.Listbox; yscrollcommand обрабатывается списком"""
+        if "yscrollcommand" in kwargs:
+            self.yscrollcommand = kwargs.pop("yscrollcommand")
+            self.redraw()
+        if kwargs:
+            self.frame.config(**kwargs)
+
+    configure = config
+
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+
+    def bind(self, sequence, func):
+        self.frame.bind(sequence, func)
+
+    def event_generate(self, sequence):
+        self.frame.event_generate(sequence)
+
+    def set_items(self, items, colors=None):
+        """Замена всех элементов списка (выделение сбрасывается)"""
+        self.items = list(items)
+        self.positions = {item: i for i, item in enumerate(self.items)}
+        self.colors = dict(colors or {})
+        self.selected = None
+        self.top = 0
+        self.redraw()
+
+    def size(self):
+        return len(self.items)
+
+    def get(self, index):
+        return self.items[index]
+
+    def index_of(self, item):
+        """Номер строки по имени (O(1))"""
+        return self.positions[item]
+
+    def curselection(self):
+        return () if self.selected is None else (self.selected,)
+
+    def selection_set(self, index):
+        self.selected = index
+        self.redraw()
+
+    def selection_clear(self, first=None, last=None):
+        self.selected = None
+        self.redraw()
+
+    def itemconfig(self, index, options):
+        """Смена цвета фона строки ({"bg": цвет})"""
+        self.colors[index] = options["bg"]
+        if self.top <= index < self.top + self.visible_rows() + 1:
+            self.redraw()
+
+    def visible_rows(self):
+        """Число полностью видимых строк"""
+        return max(1, self.canvas.winfo_height() // self.row_height)
+
+    def max_top(self):
+        return max(0, len(self.items) - self.visible_rows())
+
+    def see(self, index):
+        """Прокрутка так, чтобы строка index была видна"""
+        if index < self.top:
+            self.top = index
+        elif index >= self.top + self.visible_rows():
+            self.top = index - self.visible_rows() + 1
+        self.redraw()
+
+    def scroll(self, rows):
+        self.top = min(max(0, self.top + rows), self.max_top())
+        self.redraw()
+
+    def yview(self, *args):
+        """Протокол прокрутки tk (для Scrollbar)"""
+        if not args:
+            if not self.items:
+                return 0.0, 1.0
+            total = len(self.items)
+            return (self.top / total,
+                    min(1.0, (self.top + self.visible_rows()) / total))
+        if args[0] == "moveto":
+            self.top = int(float(args[1]) * len(self.items))
+        elif args[0] == "scroll":
+            step = self.visible_rows() if args[2] == "pages" else 1
+            self.top += int(args[1]) * step
+        self.top = min(max(0, self.top), self.max_top())
+        self.redraw()
+
+    def on_mouse_wheel(self, event):
+        self.scroll(-3 if event.delta > 0 else 3)
+
+    def on_click(self, event):
+        self.canvas.focus_set()
+        index = self.top + int(self.canvas.canvasy(event.y)
+                               // self.row_height)
+        if index < len(self.items):
+            self.select(index)
+
+    def move_selection(self, step):
+        if not self.items:
+            return
+        current = self.selected if self.selected is not None else -1
+        self.select(min(max(0, current + step), len(self.items) - 1))
+
+    def select(self, index):
+        """Выбор строки пользователем: с прокруткой и событием"""
+        self.selected = index
+        self.see(index)
+        self.event_generate("<<ListboxSelect>>")
+
+    def redraw(self):
+        """Перерисовка только видимых строк"""
+        width = self.canvas.winfo_width()
+        rows = self.visible_rows() + 1  # С учетом частично видимой
+        self.top = min(self.top, self.max_top())
+
+        while len(self.row_items) < rows:
+            rect = self.canvas.create_rectangle(0, 0, 0, 0, width=0)
+            text = self.canvas.create_text(0, 0, anchor=tk.NW,
+                                           font=self.font)
+            self.row_items.append((rect, text))
+
+        for slot, (rect, text) in enumerate(self.row_items):
+            index = self.top + slot
+            if slot >= rows or index >= len(self.items):
+                self.canvas.itemconfig(rect, state=tk.HIDDEN)
+                self.canvas.itemconfig(text, state=tk.HIDDEN)
+                continue
+
+            if index == self.selected:
+                bg, fg = self.SELECT_BG, self.SELECT_FG
+            else:
+                bg, fg = self.colors.get(index, "white"), "black"
+            y = slot * self.row_height
+            self.canvas.coords(rect, 0, y, width, y + self.row_height)
+            self.canvas.itemconfig(rect, fill=bg, state=tk.NORMAL)
+            self.canvas.coords(text, 3, y + 1)
+            self.canvas.itemconfig(text, text=self.items[index], fill=fg,
+                                   state=tk.NORMAL)
+
+        if self.yscrollcommand:
+            self.yscrollcommand(*self.yview())
 
 
 class YOLOTwoWheeledHumansAnnotationApp:
@@ -30,25 +3908,64 @@ class YOLOTwoWheeledHumansAnnotationApp:
         self.image_dir = IMAGE_DIR
         self.label_dir = LABEL_DIR
         self.supported_formats = SUPPORTED_FORMATS
-        self.yolo_model = YOLO(YOLO_MODEL)  # Загрузка модели YOLOv8
+        # Модель YOLOv8 загружается в фоне, интерфейс не ждет ее
+        self.model_loader = ModelLoader(YOLO_MODEL, INFERENCE_BACKEND)
+        self.model_loader.start()
+        # Журнал массовой разметки (какие изображения уже проверены)
+        self.manifest = JobManifest(os.path.join(STATE_DIR, MANIFEST_FILE))
+        # Кэш сырых детекций, чтобы не запускать модель повторно
+        self.detection_cache = DetectionCache(
+            os.path.join(STATE_DIR, DETECTION_CACHE_FILE)
+        )
+        # Уменьшенные копии и предзагрузка для быстрого переключения
+        self.display_cache = DisplayCache(
+            os.path.join(STATE_DIR, THUMBNAIL_DIR)
+        )
+        # Разметка массовой обработки пишется фоном пачками; в каталог
+        # и индекс рамок она попадает после записи (flush_labels)
+        self.label_writer = LabelWriterThread()
+        self.label_writer.start()
+        self.queued_labels = {}  # Имя изображения -> число аннотаций
 
         # Создаем папки, если они не существуют
         os.makedirs(self.image_dir, exist_ok=True)
         os.makedirs(self.label_dir, exist_ok=True)
 
+        # Индекс изображений и разметки вместо сканирования папок
+        self.catalog = ImageCatalog(os.path.join(STATE_DIR, CATALOG_FILE),
+                                    self.image_dir, self.label_dir,
+                                    self.supported_formats)
+        # Таблица всех рамок для статистики и фильтров списка
+        self.label_index = LabelIndex(
+            os.path.join(STATE_DIR, LABEL_INDEX_FILE), self.catalog
+        )
+
         # Переменные состояния
         self.image_files = []
         self.current_image = None
         self.current_image_path = None
         self.current_label_path = None
-        self.annotations = []
+        self.annotations = AnnotationStore()
         self.start_x = None
         self.start_y = None
         self.rect = None
         self.image_on_canvas = None
-        self.detected_pairs = []  # Для хранения обнаруженных пар
         self.auto_annotation_running = False  # Флаг для авто разметки
         self.current_auto_index = 0  # Текущий индекс при авто разметки
+        # Похожие изображения: с какого изображения перенести разметку
+        self.near_duplicate_followers = {}
+        # Разметка кадров видео в фоновом потоке и флаг ее остановки
+        self.video_thread = None
+        self.video_stop = threading.Event()
+        # Добавление изображений в фоновом потоке и флаг его отмены
+        self.import_thread = None
+        self.import_stop = threading.Event()
+        self.display_source = None  # Показанное изображение PIL
+        # Элементы холста: (описание, id элементов) по номеру аннотации
+        # и обнаруженной пары
+        self.annotation_items = []
+        self.pair_items = []
+        self.resize_job = None  # Отложенная перерисовка после resize
 
         # Настройка интерфейса
         self.setup_ui()
@@ -56,6 +3973,69 @@ class YOLOTwoWheeledHumansAnnotationApp:
         # Загрузка списка изображений
         self.load_image_list()
 
+        # Замер времени запуска, когда окно отрисовано
+        self.root.after_idle(self.report_startup_time)
+        self.root.after(100, self.check_model_loaded)
+
+    def report_startup_time(self):
+        """Вывод времени от запуска программы до появления окна"""
+        elapsed = time.perf_counter() - STARTUP_BEGIN
+        print(f"Интерфейс готов через {elapsed:.2f} с")
+
+    def check_model_loaded(self):
+        """Отображение состояния фоновой загрузки модели"""
+        loader = self.model_loader
+        if not loader.ready.is_set():
+            self.status_var.set(f"Модель {YOLO_MODEL} загружается...")
+            self.root.after(100, self.check_model_loaded)
+        elif loader.error is not None:
+            self.status_var.set(f"Не удалось загрузить модель {YOLO_MODEL}")
+        else:
+            print(f"Модель загружена за {loader.load_seconds:.2f} с")
+            self.status_var.set(
+                f"Модель {YOLO_MODEL} загружена "
+                f"за {loader.load_seconds:.1f} с"
+            )
+
+    def when_model_ready(self, callback):
+        """Вызов callback, как только модель загрузится
+
+        Пока модель загружается, интерфейс остается отзывчивым:
+        проверка повторяется через root.after.
+        """
+        loader = self.model_loader
+        if not loader.ready.is_set():
+            self.root.after(100, lambda: self.when_model_ready(callback))
+            return
+        if loader.error is not None:
+            messagebox.showerror(
+                "Ошибка",
+                f"Не удалось загрузить модель: {str(loader.error)}"
+            )
+            return
+        # Журнал и кэш открыты до загрузки модели - подпись по файлу
+        # весов (скачанному, если его не было) известна только теперь
+        self.manifest.model = loader.signature
+        self.detection_cache.model = loader.signature
+        callback()
+
+    def current_detector(self):
+        """Параметры детектора с учетом переключателя тайлов"""
+        return DetectorConfig(tile_size=TILE_SIZE if self.tiles_var.get()
+                              else 0)
+
+    def on_auto_annotate_click(self):
+        """Кнопка автоматической разметки: ждет загрузки модели"""
+        self.when_model_ready(self.auto_annotate_twowheeledhuman)
+
+    def on_auto_annotate_all_click(self):
+        """Кнопка массовой разметки: ждет загрузки модели
+
+        Список берется после загрузки: журнал сравнивает подпись модели
+        по файлу весов, а она известна только теперь.
+        """
+        self.when_model_ready(self.auto_annotate_all_unlabeled)
+
     def setup_ui(self):
         """Настройка пользовательского интерфейса"""
         # Основные фреймы
@@ -72,12 +4052,21 @@ class YOLOTwoWheeledHumansAnnotationApp:
                          padx=5,
                          pady=5)
 
+        # Фильтр списка изображений по разметке
+        self.list_filter_var = tk.StringVar(value=LIST_FILTERS[0][0])
+        filter_menu = tk.OptionMenu(
+            left_frame, self.list_filter_var,
+            *[title for title, _ in LIST_FILTERS],
+            command=lambda _: self.load_image_list(),
+        )
+        filter_menu.pack(fill=tk.X)
+
         # Фрейм списка изображений со скроллбаром
         list_frame = tk.Frame(left_frame)
         list_frame.pack(fill=tk.BOTH, expand=True)
 
-        # Список изображений
-        self.image_listbox = tk.Listbox(list_frame, width=30)
+        # Список изображений (рисуются только видимые строки)
+        self.image_listbox = VirtualListbox(list_frame, width=30)
         self.image_listbox.pack(side=tk.LEFT, expand=True, fill=tk.BOTH)
         self.image_listbox.bind("<<ListboxSelect>>", self.on_image_select)
 
@@ -97,6 +4086,15 @@ class YOLOTwoWheeledHumansAnnotationApp:
         )
         add_btn.pack(fill=tk.X, pady=2)
 
+        add_folder_btn = tk.Button(
+            button_frame, text="Добавить папку", command=self.add_folder
+        )
+        add_folder_btn.pack(fill=tk.X, pady=2)
+
+        # Полоса прогресса добавления (видна только во время добавления)
+        self.import_progress = ttk.Progressbar(button_frame,
+                                               mode="determinate")
+
         delete_btn = tk.Button(
             button_frame, text="Удалить изображение", command=self.delete_image
         )
@@ -106,11 +4104,17 @@ class YOLOTwoWheeledHumansAnnotationApp:
         auto_all_btn = tk.Button(
             button_frame,
             text="Разметить все неразмеченные",
-            command=self.auto_annotate_all_unlabeled,
+            command=self.on_auto_annotate_all_click,
             bg="lightgreen",
         )
         auto_all_btn.pack(fill=tk.X, pady=2)
 
+        # Кнопка разметки кадров видео
+        video_btn = tk.Button(
+            button_frame, text="Кадры из видео", command=self.annotate_video
+        )
+        video_btn.pack(fill=tk.X, pady=2)
+
         # Холст для отображения изображения
         self.canvas = tk.Canvas(right_frame, bg="gray", cursor="cross")
         self.canvas.pack(expand=True, fill=tk.BOTH)
@@ -161,11 +4165,29 @@ class YOLOTwoWheeledHumansAnnotationApp:
         auto_btn = tk.Button(
             right_frame,
             text="Автоматическая разметка",
-            command=self.auto_annotate_twowheeledhuman,
+            command=self.on_auto_annotate_click,
             bg="lightblue",
         )
         auto_btn.pack(fill=tk.X, pady=5)
 
+        # Переключатель разметки больших изображений по тайлам
+        self.tiles_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(
+            right_frame,
+            text="Тайлы для больших изображений",
+            variable=self.tiles_var,
+            anchor=tk.W,
+        ).pack(fill=tk.X)
+
+        # Перенос разметки на похожие изображения без запуска модели
+        self.near_duplicates_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(
+            right_frame,
+            text="Переносить разметку на похожие",
+            variable=self.near_duplicates_var,
+            anchor=tk.W,
+        ).pack(fill=tk.X)
+
         # Кнопка сохранения
         save_btn = tk.Button(
             right_frame,
@@ -174,6 +4196,11 @@ class YOLOTwoWheeledHumansAnnotationApp:
         )
         save_btn.pack(fill=tk.X, pady=5)
 
+        # Строка состояния (загрузка модели)
+        self.status_var = tk.StringVar()
+        tk.Label(right_frame, textvariable=self.status_var,
+                 anchor=tk.W).pack(fill=tk.X)
+
         # Добавляем обработчик изменения размера
         self.canvas.bind("<Configure>", self.on_canvas_resize)
 
@@ -183,6 +4210,10 @@ class YOLOTwoWheeledHumansAnnotationApp:
 
     def stop_auto_annotation(self, event=None):
         """Остановка автоматической разметки по нажатию SPACE"""
+        if self.video_thread is not None:
+            self.video_stop.set()
+        if self.import_thread is not None:
+            self.import_stop.set()
         if self.auto_annotation_running:
             self.auto_annotation_running = False
             messagebox.showinfo("Информация",
@@ -190,44 +4221,170 @@ class YOLOTwoWheeledHumansAnnotationApp:
 
     def auto_annotate_all_unlabeled(self):
         """Автоматическая разметка всех неразмеченных изображений"""
-        # Получаем список всех изображений из списка
-        all_images = self.image_listbox.get(0, tk.END)
-
-        # Фильтруем неразмеченные изображения (без файлов .txt в labels)
-        unlabeled_images = []
-        for file in all_images:
-            label_file = os.path.splitext(file)[0] + ".txt"
-            label_path = os.path.join(self.label_dir, label_file)
-            if not os.path.exists(label_path):
-                unlabeled_images.append(file)
+        if self.video_running() or self.auto_annotation_running:
+            return
+        # Берем неразмеченные изображения (без файлов .txt в labels)
+        # из каталога, пропуская уже проверенные этой моделью без пар
+        self.manifest.detector = self.current_detector().signature()
+        # Неразмеченные изображения должны быть в списке
+        if self.list_filter_var.get() != LIST_FILTERS[0][0]:
+            self.list_filter_var.set(LIST_FILTERS[0][0])
+            self.load_image_list()
+        self.catalog.refresh()
+        unlabeled_images = [
+            file for file in self.catalog.unlabeled()
+            if self.manifest.needs_processing(self.image_dir,
+                                              self.label_dir, file)
+        ]
 
         if not unlabeled_images:
-            messagebox.showinfo("Информация", "Все изображения уже размечены")
+            messagebox.showinfo("Информация",
+                                "Все изображения уже размечены или проверены")
             return
 
+        # Похожие на уже размеченные или друг на друга модель не
+        # обрабатывает (если включен перенос), разметка переносится
+        # на них в конце
+        total = len(unlabeled_images)
+        followers = {}
+        if self.near_duplicates_var.get():
+            unlabeled_images, followers = split_near_duplicates(
+                self.catalog, unlabeled_images
+            )
+
         # Подтверждение начала автоматической разметки
         confirm = messagebox.askyesno(
             "Подтверждение",
-            f"Найдено {len(unlabeled_images)} неразмеченных изображений."
+            f"Найдено {total} неразмеченных изображений, из них похожих "
+            f"на другие: {len(followers)}. "
             f"Начать автоматическую разметку?",
         )
 
         if not confirm:
             return
+        self.near_duplicate_followers = followers
 
-        # Запускаем автоматическую разметку
+        # Модель уже загружена (on_auto_annotate_all_click)
         self.auto_annotation_running = True
         self.current_auto_index = 0
         self.process_next_unlabeled(unlabeled_images)
 
+    def annotate_video(self):
+        """Разметка кадров видео: в папку попадают только кадры с парами
+
+        Видео читается в фоновом потоке, интерфейс показывает скорость
+        обработки; SPACE останавливает разметку.
+        """
+        if self.video_thread is not None:
+            messagebox.showinfo("Информация", "Видео уже обрабатывается")
+            return
+        if self.bulk_running():
+            return
+
+        path = filedialog.askopenfilename(
+            title="Выберите видео",
+            filetypes=(("Видео", " ".join("*" + ext
+                                          for ext in VIDEO_FORMATS)),
+                       ("Все файлы", "*.*")),
+        )
+        if not path:
+            return
+
+        def start():
+            # Пока ждали модель, могли начать другую разметку
+            if self.video_running() or self.bulk_running():
+                return
+            progress = ProgressReporter(None, unit="кадр.")
+            detector = self.current_detector()
+            result = {}
+
+            def work():
+                try:
+                    result["counts"] = ingest_video(
+                        path, self.image_dir, self.label_dir,
+                        self.model_loader.model, progress=progress,
+                        stop_event=self.video_stop,
+                        detector=detector,
+                    )
+                except Exception as e:
+                    result["error"] = e
+
+            self.video_stop.clear()
+            self.video_thread = threading.Thread(target=work, daemon=True)
+            self.video_thread.start()
+            self.check_video_progress(progress, result)
+
+        self.when_model_ready(start)
+
+    def video_running(self):
+        """Модель занята разметкой видео в фоновом потоке
+
+        Предиктор ultralytics не потокобезопасен, поэтому, пока идет
+        видео, модель в главном потоке не запускается.
+        """
+        if self.video_thread is None:
+            return False
+        messagebox.showinfo(
+            "Информация",
+            "Модель занята разметкой видео. Дождитесь окончания "
+            "или остановите ее клавишей SPACE",
+        )
+        return True
+
+    def bulk_running(self):
+        """Модель занята массовой разметкой (видео запускать нельзя)"""
+        if not self.auto_annotation_running:
+            return False
+        messagebox.showinfo(
+            "Информация",
+            "Идет массовая разметка. Дождитесь окончания "
+            "или остановите ее клавишей SPACE",
+        )
+        return True
+
+    def check_video_progress(self, progress, result):
+        """Отображение скорости разметки видео до ее завершения"""
+        if self.video_thread.is_alive():
+            self.status_var.set(f"Видео: {progress.processed} кадров, "
+                                f"{progress.rate():.1f} кадр./с")
+            self.root.after(500, self.check_video_progress, progress, result)
+            return
+
+        self.video_thread = None
+        self.status_var.set("")
+        self.load_image_list()
+        if "error" in result:
+            messagebox.showerror(
+                "Ошибка", f"Ошибка разметки видео: {str(result['error'])}"
+            )
+            return
+        sampled, detected, written = result["counts"]
+        messagebox.showinfo(
+            "Информация",
+            f"Прочитано {progress.processed} кадров "
+            f"({progress.rate():.1f} кадр./с), обработано {sampled}, "
+            f"из них моделью {detected}, сохранено с парами: {written}",
+        )
+
     def process_next_unlabeled(self, unlabeled_images):
         """Обработка следующего неразмеченного изображения"""
         if not self.auto_annotation_running or self.current_auto_index >= len(
             unlabeled_images
         ):
             self.auto_annotation_running = False
-            messagebox.showinfo("Информация",
-                                "Автоматическая разметка завершена")
+            self.flush_labels()
+            reused = reuse_near_duplicate_labels(
+                self.image_dir, self.label_dir, self.near_duplicate_followers,
+                self.manifest, LabelWriterThread()
+            )
+            self.near_duplicate_followers = {}
+            if reused:
+                self.load_image_list()
+            messagebox.showinfo(
+                "Информация",
+                f"Автоматическая разметка завершена, разметка перенесена "
+                f"на похожие изображения: {reused}"
+            )
             return
 
         # Получаем текущее изображение
@@ -237,13 +4394,12 @@ class YOLOTwoWheeledHumansAnnotationApp:
         # Очищаем все аннотации и временные элементы
         # перед обработкой новой картинки
         self.clear_canvas()
-        self.annotations = []
-        self.detected_pairs = []
+        self.annotations = AnnotationStore()
         self.update_annotation_list()
 
         # Обновляем список файлов и выделяем текущее изображение
-        index = self.image_listbox.get(0, tk.END).index(filename)
-        self.image_listbox.selection_clear(0, tk.END)
+        index = self.image_listbox.index_of(filename)
+        self.image_listbox.selection_clear()
         self.image_listbox.selection_set(index)
         self.image_listbox.see(index)
 
@@ -260,18 +4416,23 @@ class YOLOTwoWheeledHumansAnnotationApp:
         self.current_label_path = os.path.join(self.label_dir, label_file)
 
         # Выполняем автоматическую разметку
-        self.auto_annotate_twowheeledhuman()
+        success = self.auto_annotate_twowheeledhuman()
 
         self.root.update()
 
         # Определяем цвет результата
-        index = self.image_listbox.get(0, tk.END).index(filename)
-        if self.annotations:  # Если найдены двух колесные люди
+        index = self.image_listbox.index_of(filename)
+        if not success:
+            self.manifest.record(self.image_dir, filename, "error")
+        elif self.annotations:  # Если найдены двух колесные люди
             self.image_listbox.itemconfig(index, {"bg": "light green"})
             self.save_annotations()  # Автоматически сохраняем разметку
+            self.manifest.record(self.image_dir, filename, "positive",
+                                 len(self.annotations))
         else:  # Если не найдены двух колесные люди
             self.image_listbox.itemconfig(index, {"bg": "light blue"})
             # НЕ создаем пустой файл разметки, если аннотаций нет
+            self.manifest.record(self.image_dir, filename, "negative")
 
         # Переходим к следующему изображению
         self.current_auto_index += 1
@@ -279,14 +4440,75 @@ class YOLOTwoWheeledHumansAnnotationApp:
                         lambda: self.process_next_unlabeled(unlabeled_images))
 
     def on_canvas_resize(self, event):
-        """Обработчик изменения размера холста"""
+        """Обработчик изменения размера холста
+
+        Пока окно тянут, изображение быстро масштабируется из уже
+        загруженной в память копии, а элементы холста сдвигаются.
+        Качественная перерисовка выполняется один раз, когда изменение
+        размера прекратилось.
+        """
         self.canvas_width = event.width
         self.canvas_height = event.height
-        self.update_image_position()
+        if self.image_on_canvas is None or self.display_source is None:
+            return
+
+        self.rescale_image(Image.NEAREST)
+        if self.resize_job is not None:
+            self.root.after_cancel(self.resize_job)
+        self.resize_job = self.root.after(RESIZE_DEBOUNCE_MS,
+                                          self.finish_resize)
+
+    def finish_resize(self):
+        """Качественная перерисовка после окончания изменения размера"""
+        self.resize_job = None
+        if self.image_on_canvas is None or self.display_source is None:
+            return
+        self.rescale_image(Image.LANCZOS)
         self.draw_annotations()
-        # Если есть текущее изображение, перерисовываем его с новыми размерами
-        if self.current_image_path:
-            self.display_image()
+
+    def rescale_image(self, resample):
+        """Масштабирование показанного изображения под размер холста
+
+        Изображение берется из копии в памяти, файл не читается. Только
+        если для качественной перерисовки копии не хватает разрешения,
+        используется кэш отображения. Элемент изображения и аннотации
+        на холсте не пересоздаются, а сдвигаются.
+        """
+        frame = self.current_image
+        new_width, new_height = fit_size(frame.width, frame.height,
+                                         self.canvas_width,
+                                         self.canvas_height)
+        if new_width < 1 or new_height < 1:
+            return
+
+        source = self.display_source
+        if resample == Image.NEAREST or new_width <= source.width:
+            self.tk_image = ImageTk.PhotoImage(
+                source.resize((new_width, new_height), resample)
+            )
+        else:
+            self.tk_image, self.display_source = self.display_cache.photo(
+                frame, new_width, new_height
+            )
+
+        old_scale = self.scale_x
+        old_offset_x = self.image_offset_x
+        old_offset_y = self.image_offset_y
+        self.scale_x = new_width / frame.width
+        self.scale_y = new_height / frame.height
+        self.update_image_position()
+
+        self.canvas.coords(self.image_on_canvas,
+                           self.canvas_width // 2, self.canvas_height // 2)
+        self.canvas.itemconfig(self.image_on_canvas, image=self.tk_image)
+
+        # Сдвигаем аннотации вслед за изображением
+        factor = self.scale_x / old_scale
+        for tag in ("annotation", "temp_annotation", "rect"):
+            self.canvas.scale(tag, old_offset_x, old_offset_y, factor, factor)
+            self.canvas.move(tag, self.image_offset_x - old_offset_x,
+                             self.image_offset_y - old_offset_y)
+        self.invalidate_canvas_items()
 
     def update_image_position(self):
         """Обновляет позицию изображения на холсте"""
@@ -302,177 +4524,56 @@ class YOLOTwoWheeledHumansAnnotationApp:
 
     def calculate_area(self, box):
         """Вычисляет площадь прямоугольника"""
-        x1, y1, x2, y2 = box
-        return (x2 - x1) * (y2 - y1)
+        return calculate_area(box)
 
     def auto_annotate_twowheeledhuman(self):
-        """Автоматическая разметка пар человек-велосипед и человек-мотоцикл"""
+        """Автоматическая разметка пар человек-велосипед и человек-мотоцикл
+
+        Возвращает False, если разметку выполнить не удалось.
+        """
         if not self.current_image_path:
             messagebox.showwarning("Предупреждение",
                                    "Сначала выберите изображение")
-            return
+            return False
+        if self.video_running():
+            return False
 
         try:
-            # Загружаем изображение для YOLOv8
-            img = cv2.imread(self.current_image_path)
-            if img is None:
-                raise ValueError("Не удалось загрузить изображение")
-
-            # Получаем предсказания от YOLOv8
-            results = self.yolo_model(img)
-
-            # Очищаем предыдущие обнаруженные пары
-            self.detected_pairs = []
-
-            # Классы, которые мы ищем (COCO dataset classes)
-            # 0 - person, 1 - bicycle, 3 - motorcycle
-            person_boxes = []
-            bicycle_boxes = []
-            motorcycle_boxes = []
-
-            for result in results:
-                for box in result.boxes:
-                    cls = int(box.cls[0])
-                    coords = box.xyxy[0].tolist()
-                    conf = float(box.conf[0])
-
-                    # Фильтр по уверенности (только уверенные предсказания)
-                    if conf < 0.5:
-                        continue
-
-                    if cls == 0:  # person
-                        person_boxes.append(coords)
-                    elif cls == 1:  # bicycle
-                        bicycle_boxes.append(coords)
-                    elif cls == 3:  # motorcycle
-                        motorcycle_boxes.append(coords)
-
-            # Ищем пересекающиеся пары
-            twowheeledhuman_pairs = []
-
-            # Проверяем пары человек-велосипед
-            for p_box in person_boxes:
-                for b_box in bicycle_boxes:
-                    if self.boxes_intersect(p_box, b_box):
-                        combined = self.combine_boxes(p_box, b_box)
-                        twowheeledhuman_pairs.append(
-                            {
-                                "type": "twowheeledhuman",
-                                "person_box": p_box,
-                                "vehicle_box": b_box,
-                                "combined_box": combined,
-                                "area": self.calculate_area(combined),
-                            }
-                        )
-
-            # Проверяем пары человек-мотоцикл
-            for p_box in person_boxes:
-                for m_box in motorcycle_boxes:
-                    if self.boxes_intersect(p_box, m_box):
-                        combined = self.combine_boxes(p_box, m_box)
-                        twowheeledhuman_pairs.append(
-                            {
-                                "type": "twowheeledhuman",
-                                "person_box": p_box,
-                                "vehicle_box": m_box,
-                                "combined_box": combined,
-                                "area": self.calculate_area(combined),
-                            }
-                        )
-
-            # Фильтруем дубликаты (пересекающиеся прямоугольники)
-            filtered_pairs = []
-            used_indices = set()
-
-            for i in range(len(twowheeledhuman_pairs)):
-                if i in used_indices:
-                    continue
-
-                current_pair = twowheeledhuman_pairs[i]
-                max_area_pair = current_pair
-                max_area = current_pair["area"]
-
-                for j in range(i + 1, len(twowheeledhuman_pairs)):
-                    if j in used_indices:
-                        continue
-
-                    other_pair = twowheeledhuman_pairs[j]
-                    if self.boxes_intersect(
-                        current_pair["combined_box"],
-                        other_pair["combined_box"]
-                    ):
-                        if other_pair["area"] > max_area:
-                            max_area = other_pair["area"]
-                            max_area_pair = other_pair
-                        used_indices.add(j)
-
-                filtered_pairs.append(max_area_pair)
-                used_indices.add(i)
-
-            # Сохраняем обнаруженные пары
-            self.detected_pairs = filtered_pairs
-
-            # Очищаем текущие аннотации и добавляем только отфильтрованные пары
-            self.annotations = []
-
-            for pair in filtered_pairs:
-                x1, y1, x2, y2 = pair["combined_box"]
-
-                # Конвертируем в YOLO формат (относительные координаты)
-                img_width = self.current_image.width
-                img_height = self.current_image.height
-
-                x_center = ((x1 + x2) / 2) / img_width
-                y_center = ((y1 + y2) / 2) / img_height
-                width = (x2 - x1) / img_width
-                height = (y2 - y1) / img_height
-
-                # Все пары сохраняем с классом 0
-                self.annotations.append(
-                    {
-                        "class": "0",  # Класс 0 для всех двух колесных
-                        "x_center": x_center,
-                        "y_center": y_center,
-                        "width": width,
-                        "height": height,
-                        "type": pair["type"],
-                        "person_box": pair["person_box"],
-                        "vehicle_box": pair["vehicle_box"],
-                    }
-                )
+            # Используем уже декодированное изображение без повторного чтения
+            frame = self.load_current_frame()
+
+            # Получаем предсказания от YOLOv8 (или из кэша детекций)
+            detections = detect_frames(self.model_loader.model, [frame],
+                                       self.detection_cache,
+                                       self.current_detector())[0]
+
+            # Ищем пары человек-транспорт среди уверенных предсказаний
+            # (COCO: 0 - person, 1 - bicycle, 3 - motorcycle)
+            pairs = find_twowheeledhuman_pairs(detections)
+
+            # Заменяем текущие аннотации отфильтрованными парами
+            # (исходные рамки пар сохраняются для временных рамок)
+            self.annotations = AnnotationStore.from_pairs(
+                pairs, self.current_image.width, self.current_image.height
+            )
 
             # Обновляем интерфейс
             self.update_annotation_list()
             self.draw_annotations()
+            return True
 
         except Exception as e:
             messagebox.showerror("Ошибка",
                                  f"Ошибка автоматической разметки: {str(e)}")
+            return False
 
     def boxes_intersect(self, box1, box2):
         """Проверяет, пересекаются ли два прямоугольника"""
-        x1_min, y1_min, x1_max, y1_max = box1
-        x2_min, y2_min, x2_max, y2_max = box2
-
-        # Проверяем пересечение по оси X
-        x_intersect = (x1_min <= x2_max) and (x1_max >= x2_min)
-
-        # Проверяем пересечение по оси Y
-        y_intersect = (y1_min <= y2_max) and (y1_max >= y2_min)
-
-        return x_intersect and y_intersect
+        return boxes_intersect(box1, box2)
 
     def combine_boxes(self, box1, box2):
         """Объединяет два прямоугольника в один, который их покрывает"""
-        x1_min, y1_min, x1_max, y1_max = box1
-        x2_min, y2_min, x2_max, y2_max = box2
-
-        new_x_min = min(x1_min, x2_min)
-        new_y_min = min(y1_min, y2_min)
-        new_x_max = max(x1_max, x2_max)
-        new_y_max = max(y1_max, y2_max)
-
-        return (new_x_min, new_y_min, new_x_max, new_y_max)
+        return combine_boxes(box1, box2)
 
     def on_image_select(self, event):
         """Обработчик выбора изображения из списка"""
@@ -480,9 +4581,6 @@ class YOLOTwoWheeledHumansAnnotationApp:
         if not selection:
             return
 
-        # Полностью очищаем все аннотации
-        self.annotations = []
-        self.detected_pairs = []
         self.clear_canvas()
 
         index = selection[0]
@@ -493,21 +4591,10 @@ class YOLOTwoWheeledHumansAnnotationApp:
         label_file = os.path.splitext(filename)[0] + ".txt"
         self.current_label_path = os.path.join(self.label_dir, label_file)
 
-        # Загружаем все аннотации из файла
-        if os.path.exists(self.current_label_path):
-            with open(self.current_label_path, "r") as f:
-                for line in f:
-                    parts = line.strip().split()
-                    if len(parts) == 5:
-                        self.annotations.append(
-                            {
-                                "class": parts[0],
-                                "x_center": float(parts[1]),
-                                "y_center": float(parts[2]),
-                                "width": float(parts[3]),
-                                "height": float(parts[4]),
-                            }
-                        )
+        # Загружаем все аннотации из файла (заменяя предыдущие), дождавшись
+        # записи разметки из фоновой очереди
+        self.flush_labels()
+        self.annotations = AnnotationStore.load(self.current_label_path)
 
         # Отображаем изображение и аннотации
         self.display_image()
@@ -520,168 +4607,233 @@ class YOLOTwoWheeledHumansAnnotationApp:
         self.rect = None
         self.start_x = None
         self.start_y = None
-
-    def draw_annotations(self):
-        """Отрисовка всех аннотаций на холсте с учетом смещения"""
-        self.canvas.delete("annotation")
-
-        if not self.current_image:
-            return
-
-        # Рисуем все аннотации
-        for ann in self.annotations:
-            # Получаем координаты в формате YOLO
-            x_center = ann["x_center"]
-            y_center = ann["y_center"]
-            width = ann["width"]
-            height = ann["height"]
-
-            # Вычисляем координаты углов
-            x1 = x_center - width / 2
-            y1 = y_center - height / 2
-            x2 = x_center + width / 2
-            y2 = y_center + height / 2
-
-            # Конвертируем в координаты холста с учетом смещения
-            canvas_x1, canvas_y1 = self.convert_to_canvas_coords(x1, y1)
-            canvas_x2, canvas_y2 = self.convert_to_canvas_coords(x2, y2)
-
+        # Элементы аннотаций удалены вместе со всем холстом
+        self.annotation_items = []
+        self.pair_items = []
+
+    def canvas_boxes(self, xyxy):
+        """Пересчет рамок из пикселей изображения в координаты холста"""
+        scale = np.array([self.scale_x, self.scale_y] * 2)
+        offset = np.array([self.image_offset_x, self.image_offset_y] * 2)
+        return xyxy * scale + offset
+
+    def annotation_specs(self):
+        """Описания элементов холста для всех аннотаций: рамка и подпись"""
+        boxes = self.canvas_boxes(self.annotations.to_pixel_xyxy(
+            self.current_image.width, self.current_image.height
+        ))
+        specs = []
+        for class_id, (x1, y1, x2, y2) in zip(self.annotations.classes,
+                                              boxes.tolist()):
             # Определяем цвет и метку
-            if ann["class"] == "0":
+            if class_id == AnnotationStore.TWOWHEELEDHUMAN_CLASS:
                 color = "red"
                 label = "twowheeledhuman"
             else:
                 color = "green"
-                label = ann["class"]
-
-            # Рисуем прямоугольник
-            self.canvas.create_rectangle(
-                canvas_x1,
-                canvas_y1,
-                canvas_x2,
-                canvas_y2,
-                outline=color,
-                width=2,
-                tags="annotation",
-            )
+                label = str(class_id)
+            specs.append((
+                ("rectangle", (x1, y1, x2, y2),
+                 {"outline": color, "width": 2}),
+                ("text", (x1 + 5, y1 + 5), {"text": label, "fill": color}),
+            ))
+        return specs
+
+    def pair_specs(self):
+        """Описания временных рамок обнаруженных пар: человек,
+        транспорт и объединенная область"""
+        store = self.annotations
+        mask = store.has_source_boxes()
+        columns = (
+            (self.canvas_boxes(store.person_boxes[mask]), "yellow"),
+            (self.canvas_boxes(store.vehicle_boxes[mask]), "blue"),
+            (self.canvas_boxes(store.to_pixel_xyxy(
+                self.current_image.width, self.current_image.height
+            )[mask]), "red"),
+        )
+        specs = []
+        for row in range(int(mask.sum())):
+            specs.append(tuple(
+                ("rectangle", tuple(boxes[row].tolist()),
+                 {"outline": color, "width": 1})
+                for boxes, color in columns
+            ))
+        return specs
+
+    def sync_canvas_items(self, retained, specs, tag):
+        """Приведение элементов холста к списку описаний specs
+
+        retained - список (описание, id элементов) по номеру объекта.
+        Элементы с неизменным описанием не трогаются, измененные
+        двигаются через coords и itemconfig, новые создаются, а лишние
+        удаляются.
+        """
+        for index, spec in enumerate(specs):
+            if index < len(retained):
+                old_spec, item_ids = retained[index]
+                if old_spec == spec:
+                    continue
+                for item_id, (_, coords, options) in zip(item_ids, spec):
+                    self.canvas.coords(item_id, *coords)
+                    self.canvas.itemconfig(item_id, **options)
+                retained[index] = (spec, item_ids)
+                continue
+
+            item_ids = []
+            for kind, coords, options in spec:
+                if kind == "text":
+                    item_id = self.canvas.create_text(
+                        *coords, anchor=tk.NW, tags=tag, **options
+                    )
+                else:
+                    item_id = self.canvas.create_rectangle(
+                        *coords, tags=tag, **options
+                    )
+                item_ids.append(item_id)
+            retained.append((spec, item_ids))
 
-            # Подписываем класс
-            self.canvas.create_text(
-                canvas_x1 + 5,
-                canvas_y1 + 5,
-                text=label,
-                fill=color,
-                anchor=tk.NW,
-                tags="annotation",
-            )
+        for _, item_ids in retained[len(specs):]:
+            for item_id in item_ids:
+                self.canvas.delete(item_id)
+        del retained[len(specs):]
 
-        # Рисуем временные прямоугольники обнаруженных пар
-        for pair in self.detected_pairs:
-            # Конвертируем координаты с учетом смещения
-            p_x1, p_y1 = self.convert_to_canvas_coords(
-                pair["person_box"][0] / self.current_image.width,
-                pair["person_box"][1] / self.current_image.height,
-            )
-            p_x2, p_y2 = self.convert_to_canvas_coords(
-                pair["person_box"][2] / self.current_image.width,
-                pair["person_box"][3] / self.current_image.height,
-            )
+    def invalidate_canvas_items(self):
+        """Элементы сдвинуты напрямую - при следующей отрисовке
+        обновить координаты всех"""
+        for retained in (self.annotation_items, self.pair_items):
+            for index, (_, item_ids) in enumerate(retained):
+                retained[index] = (None, item_ids)
 
-            v_x1, v_y1 = self.convert_to_canvas_coords(
-                pair["vehicle_box"][0] / self.current_image.width,
-                pair["vehicle_box"][1] / self.current_image.height,
-            )
-            v_x2, v_y2 = self.convert_to_canvas_coords(
-                pair["vehicle_box"][2] / self.current_image.width,
-                pair["vehicle_box"][3] / self.current_image.height,
-            )
+    def draw_annotations(self):
+        """Отрисовка всех аннотаций на холсте с учетом смещения
 
-            c_x1, c_y1 = self.convert_to_canvas_coords(
-                pair["combined_box"][0] / self.current_image.width,
-                pair["combined_box"][1] / self.current_image.height,
-            )
-            c_x2, c_y2 = self.convert_to_canvas_coords(
-                pair["combined_box"][2] / self.current_image.width,
-                pair["combined_box"][3] / self.current_image.height,
-            )
+        Элементы холста хранятся по номеру аннотации и обнаруженной пары
+        и обновляются только при изменении; временные рамки пар
+        удаляются, когда пар больше нет.
+        """
+        if not self.current_image:
+            specs = []
+            pair_specs = []
+        else:
+            specs = self.annotation_specs()
+            pair_specs = self.pair_specs()
 
-            # Рисуем прямоугольники
-            self.canvas.create_rectangle(
-                p_x1,
-                p_y1,
-                p_x2,
-                p_y2,
-                outline="yellow",
-                width=1,
-                tags="temp_annotation",
-            )
-            self.canvas.create_rectangle(
-                v_x1, v_y1, v_x2, v_y2, outline="blue",
-                width=1,
-                tags="temp_annotation"
-            )
-            self.canvas.create_rectangle(
-                c_x1, c_y1, c_x2, c_y2, outline="red",
-                width=1,
-                tags="temp_annotation"
-            )
+        self.sync_canvas_items(self.annotation_items, specs, "annotation")
+        self.sync_canvas_items(self.pair_items, pair_specs,
+                               "temp_annotation")
 
     def load_image_list(self):
-        """Загрузка списка изображений из папки"""
-        self.image_listbox.delete(0, tk.END)
-        self.image_files = []
-
-        # Получаем все файлы изображений из папки
-        for file in os.listdir(self.image_dir):
-            if file.lower().endswith(self.supported_formats):
-                self.image_files.append(file)
-
-        self.image_files.sort()  # Сортируем по имени
+        """Загрузка списка изображений из каталога"""
+        # Каталог сам пересканирует папки, только если они изменились,
+        # индекс рамок перечитывает только измененную разметку
+        self.catalog.refresh()
+        self.label_index.sync()
+        rows = self.catalog.rows()
+        filters = dict(LIST_FILTERS)[self.list_filter_var.get()]
+        if filters == "near_duplicates":
+            # Группы похожих подряд, группа за группой
+            groups = near_duplicate_groups(
+                self.catalog.perceptual_hashes(DECODE_WORKERS)
+            )
+            order = {name: position for position, name in enumerate(
+                name for group in groups for name in group
+            )}
+            self.status_var.set(f"Групп похожих: {len(groups)}, "
+                                f"изображений: {len(order)}")
+            rows = sorted((row for row in rows if row[0] in order),
+                          key=lambda row: order[row[0]])
+        elif filters is not None:
+            matching = set(self.label_index.query(**filters))
+            self.status_var.set(f"Фильтр: {len(matching)} из {len(rows)} "
+                                f"изображений")
+            rows = [row for row in rows if row[0] in matching]
+        self.image_files = [name for name, _, _ in rows]
 
         # Добавляем в список, помечаем зеленым размеченные
-        for file in self.image_files:
-            label_file = os.path.splitext(file)[0] + ".txt"
-            label_path = os.path.join(self.label_dir, label_file)
-
-            if os.path.exists(label_path):
-                self.image_listbox.insert(tk.END, file)
-                self.image_listbox.itemconfig(tk.END, {"bg": "light green"})
-            else:
-                self.image_listbox.insert(tk.END, file)
+        colors = {
+            index: "light green"
+            for index, (_, labeled, _) in enumerate(rows) if labeled
+        }
+        self.image_listbox.set_items(self.image_files, colors)
 
     def add_images(self):
-        """Добавление новых изображений в папку"""
+        """Добавление выбранных изображений в папку"""
         files = filedialog.askopenfilenames(
             title="Выберите изображения",
             filetypes=(("Изображения", "*.jpg *.jpeg *.png"),
                        ("Все файлы", "*.*")),
         )
-
         if files:
-            for file in files:
-                filename = os.path.basename(file)
-                dest = os.path.join(self.image_dir, filename)
-
-                # Обработка дубликатов имен
-                counter = 1
-                while os.path.exists(dest):
-                    name, ext = os.path.splitext(filename)
-                    dest = os.path.join(self.image_dir,
-                                        f"{name}_{counter}{ext}")
-                    counter += 1
+            self.start_import(files)
+
+    def add_folder(self):
+        """Добавление всех изображений папки (вместе с вложенными)"""
+        folder = filedialog.askdirectory(title="Выберите папку")
+        if folder:
+            self.start_import([folder])
+
+    def start_import(self, paths):
+        """Добавление изображений в фоновом потоке с полосой прогресса
+
+        Дубликаты по содержимому пропускаются (см. import_images),
+        SPACE отменяет еще не скопированные файлы.
+        """
+        if self.import_thread is not None:
+            messagebox.showinfo("Информация", "Изображения уже добавляются")
+            return
 
-                try:
-                    # Копируем файл
-                    with open(file, "rb") as f_src, open(dest, "wb") as f_dst:
-                        f_dst.write(f_src.read())
-                except Exception as e:
-                    messagebox.showerror(
-                        "Ошибка",
-                        f"Не удалось скопировать {filename}: {str(e)}"
-                    )
+        progress = ProgressReporter(None)
+        result = {}
 
-            # Обновляем список изображений
-            self.load_image_list()
+        def work():
+            try:
+                result["counts"] = import_images(
+                    paths, self.image_dir, self.label_dir, STATE_DIR,
+                    IMPORT_MODE, IMPORT_WORKERS, progress, self.import_stop
+                )
+            except Exception as e:
+                result["error"] = e
+
+        self.import_stop.clear()
+        self.import_progress["value"] = 0
+        self.import_progress.pack(fill=tk.X, pady=2)
+        self.import_thread = threading.Thread(target=work, daemon=True)
+        self.import_thread.start()
+        self.check_import_progress(progress, result)
+
+    def check_import_progress(self, progress, result):
+        """Обновление полосы прогресса до завершения добавления"""
+        if self.import_thread.is_alive():
+            if progress.total:
+                self.import_progress["maximum"] = progress.total
+                self.import_progress["value"] = progress.processed
+                self.status_var.set(f"Добавление: {progress.processed} из "
+                                    f"{progress.total}")
+            self.root.after(200, self.check_import_progress, progress,
+                            result)
+            return
+
+        self.import_thread = None
+        self.import_progress.pack_forget()
+        self.status_var.set("")
+        self.load_image_list()
+        if "error" in result:
+            messagebox.showerror(
+                "Ошибка",
+                f"Не удалось добавить изображения: {str(result['error'])}"
+            )
+            return
+        imported, duplicates, errors = result["counts"]
+        message = (f"Добавлено изображений: {imported}, "
+                   f"пропущено дубликатов: {duplicates}")
+        if errors:
+            messagebox.showerror(
+                "Ошибка",
+                message + f"\nНе удалось скопировать {len(errors)}:\n"
+                + "\n".join(errors[:10])
+            )
+        else:
+            messagebox.showinfo("Информация", message)
 
     def delete_image(self):
         """Удаление выбранного изображения и его разметки"""
@@ -702,6 +4854,7 @@ class YOLOTwoWheeledHumansAnnotationApp:
             # Удаляем файл изображения
             image_path = os.path.join(self.image_dir, filename)
             if os.path.exists(image_path):
+                self.display_cache.discard(image_path)
                 os.remove(image_path)
 
             # Удаляем файл разметки
@@ -709,18 +4862,27 @@ class YOLOTwoWheeledHumansAnnotationApp:
             label_path = os.path.join(self.label_dir, label_file)
             if os.path.exists(label_path):
                 os.remove(label_path)
+            self.catalog.remove(filename)
 
             # Обновляем интерфейс
             self.load_image_list()
             self.clear_canvas()
 
+    def load_current_frame(self):
+        """Текущее изображение (декодируется при первом обращении к
+        пикселям, один раз для отображения и детектора)"""
+        if (self.current_image is None
+                or self.current_image.path != self.current_image_path):
+            self.current_image = None
+            self.current_image = DecodedFrame.lazy(self.current_image_path)
+        return self.current_image
+
     def display_image(self):
         """Отображение изображения на холсте с учетом изменения размеров"""
         self.clear_canvas()
 
         try:
-            self.current_image = Image.open(self.current_image_path)
-            img_width, img_height = self.current_image.size
+            img_width, img_height = self.load_current_frame().size
 
             # Получаем текущие размеры холста
             self.canvas_width = self.canvas.winfo_width()
@@ -731,10 +4893,9 @@ class YOLOTwoWheeledHumansAnnotationApp:
                 self.canvas_height = 600
 
             # Вычисляем коэффициенты масштабирования
-            ratio = min(self.canvas_width / img_width,
-                        self.canvas_height / img_height)
-            new_width = int(img_width * ratio)
-            new_height = int(img_height * ratio)
+            new_width, new_height = fit_size(img_width, img_height,
+                                             self.canvas_width,
+                                             self.canvas_height)
 
             # Сохраняем коэффициенты масштабирования
             self.scale_x = new_width / img_width
@@ -743,11 +4904,10 @@ class YOLOTwoWheeledHumansAnnotationApp:
             # Обновляем позицию изображения
             self.update_image_position()
 
-            # Масштабируем изображение
-            resized_img = self.current_image.resize(
-                (new_width, new_height), Image.LANCZOS
+            # Масштабируем изображение (из кэша, если оно уже готово)
+            self.tk_image, self.display_source = self.display_cache.photo(
+                self.current_image, new_width, new_height
             )
-            self.tk_image = ImageTk.PhotoImage(resized_img)
 
             # Отображаем изображение на холсте с учетом смещения
             self.image_on_canvas = self.canvas.create_image(
@@ -760,17 +4920,30 @@ class YOLOTwoWheeledHumansAnnotationApp:
             # Рисуем аннотации
             self.draw_annotations()
 
+            # Готовим соседние изображения списка заранее
+            if not self.auto_annotation_running:
+                self.prefetch_neighbours()
+
         except Exception as e:
             messagebox.showerror(
                 "Ошибка", f"Не удалось загрузить изображение: {str(e)}"
             )
 
-    def convert_to_canvas_coords(self, x, y):
-        """Конвертирует координаты изображения в
-        координаты холста с учетом смещения"""
-        img_x = x * self.current_image.width * self.scale_x
-        img_y = y * self.current_image.height * self.scale_y
-        return (self.image_offset_x + img_x, self.image_offset_y + img_y)
+    def prefetch_neighbours(self):
+        """Фоновая подготовка соседних изображений для показа"""
+        selection = self.image_listbox.curselection()
+        if not selection:
+            return
+        index = selection[0]
+        paths = []
+        for offset in range(1, DISPLAY_PREFETCH + 1):
+            for neighbour in (index + offset, index - offset):
+                if 0 <= neighbour < self.image_listbox.size():
+                    paths.append(os.path.join(
+                        self.image_dir, self.image_listbox.get(neighbour)
+                    ))
+        self.display_cache.prefetch(paths, self.canvas_width,
+                                    self.canvas_height)
 
     def on_mouse_press(self, event):
         """Обработчик нажатия кнопки мыши на холсте"""
@@ -873,20 +5046,22 @@ class YOLOTwoWheeledHumansAnnotationApp:
         height = abs(end_y - self.start_y) / self.current_image.height
 
         # Получаем класс из поля ввода
-        class_id = self.class_entry.get().strip()
-        if not class_id:
-            class_id = "0"
+        class_id = self.class_entry.get().strip() or "0"
+        try:
+            class_id = parse_class_id(class_id)
+        except ValueError:
+            messagebox.showerror("Ошибка",
+                                 f"Класс должен быть целым неотрицательным "
+                                 f"числом: {class_id}")
+            self.canvas.delete(self.rect)
+            self.rect = None
+            self.start_x = None
+            self.start_y = None
+            return
 
         # Добавляем новую аннотацию
-        self.annotations.append(
-            {
-                "class": class_id,
-                "x_center": x_center,
-                "y_center": y_center,
-                "width": width,
-                "height": height,
-            }
-        )
+        self.annotations.append(class_id,
+                                (x_center, y_center, width, height))
 
         # Обновляем интерфейс
         self.update_annotation_list()
@@ -905,12 +5080,14 @@ class YOLOTwoWheeledHumansAnnotationApp:
         """Обновление списка аннотаций"""
         self.annotation_listbox.delete(0, tk.END)
 
-        for i, ann in enumerate(self.annotations):
+        store = self.annotations
+        for i, (x_center, y_center, width, height) in enumerate(
+                store.boxes.tolist()):
             self.annotation_listbox.insert(
                 tk.END,
-                f"{i}: класс={ann['class']} "
-                f"x={ann['x_center']:.4f} y={ann['y_center']:.4f} "
-                f"w={ann['width']:.4f} h={ann['height']:.4f}",
+                f"{i}: класс={store.classes[i]} "
+                f"x={x_center:.4f} y={y_center:.4f} "
+                f"w={width:.4f} h={height:.4f}",
             )
 
     def on_annotation_select(self, event):
@@ -933,12 +5110,10 @@ class YOLOTwoWheeledHumansAnnotationApp:
         if index >= len(self.annotations):
             return
 
-        ann = self.annotations[index]
-        yolo_str = f"{ann['class']} {ann['x_center']:.6f} {ann['y_center']:.6f} {ann['width']:.6f} {ann['height']:.6f}"
         self.yolo_entry.delete(0, tk.END)
-        self.yolo_entry.insert(0, yolo_str)
+        self.yolo_entry.insert(0, self.annotations.format_row(index))
         self.class_entry.delete(0, tk.END)
-        self.class_entry.insert(0, ann["class"])
+        self.class_entry.insert(0, str(self.annotations.classes[index]))
 
     def update_annotation_from_entry(self, event=None):
         """Обновление аннотации из поля YOLO формата"""
@@ -964,7 +5139,7 @@ class YOLOTwoWheeledHumansAnnotationApp:
 
         try:
             # Валидация и обновление аннотации
-            class_id = parts[0]
+            class_id = parse_class_id(parts[0])
             x_center = float(parts[1])
             y_center = float(parts[2])
             width = float(parts[3])
@@ -978,13 +5153,8 @@ class YOLOTwoWheeledHumansAnnotationApp:
             ):
                 raise ValueError("Координаты должны быть в диапазоне [0, 1]")
 
-            self.annotations[index] = {
-                "class": class_id,
-                "x_center": x_center,
-                "y_center": y_center,
-                "width": width,
-                "height": height,
-            }
+            self.annotations.replace(index, class_id,
+                                     (x_center, y_center, width, height))
 
             # Обновляем интерфейс
             self.update_annotation_list()
@@ -1013,7 +5183,7 @@ class YOLOTwoWheeledHumansAnnotationApp:
 
         try:
             # Валидация и добавление аннотации
-            class_id = parts[0]
+            class_id = parse_class_id(parts[0])
             x_center = float(parts[1])
             y_center = float(parts[2])
             width = float(parts[3])
@@ -1027,15 +5197,8 @@ class YOLOTwoWheeledHumansAnnotationApp:
             ):
                 raise ValueError("Координаты должны быть в диапазоне [0, 1]")
 
-            self.annotations.append(
-                {
-                    "class": class_id,
-                    "x_center": x_center,
-                    "y_center": y_center,
-                    "width": width,
-                    "height": height,
-                }
-            )
+            self.annotations.append(class_id,
+                                    (x_center, y_center, width, height))
 
             # Обновляем интерфейс
             self.update_annotation_list()
@@ -1057,23 +5220,9 @@ class YOLOTwoWheeledHumansAnnotationApp:
             return
 
         # Удаляем аннотацию из списка
-        del self.annotations[index]
-
-        # Полностью перерисовываем холст
-        self.canvas.delete("all")
-
-        # Восстанавливаем изображение
-        if self.image_on_canvas:
-            canvas_width = self.canvas.winfo_width()
-            canvas_height = self.canvas.winfo_height()
-            self.image_on_canvas = self.canvas.create_image(
-                canvas_width // 2,
-                canvas_height // 2,
-                anchor=tk.CENTER,
-                image=self.tk_image,
-            )
+        self.annotations.delete(index)
 
-        # Рисуем оставшиеся аннотации
+        # Перерисовываем оставшиеся аннотации (лишние элементы удалятся)
         self.draw_annotations()
 
         # Очищаем поле ввода
@@ -1087,6 +5236,11 @@ class YOLOTwoWheeledHumansAnnotationApp:
         if not self.current_image_path or not self.current_label_path:
             return
 
+        # Сначала дописываем разметку массовой обработки, чтобы она
+        # не перезаписала сохраняемую вручную
+        if not self.auto_annotation_running:
+            self.flush_labels()
+
         # Если аннотаций нет - удаляем файл разметки
         if len(self.annotations) == 0:
             try:
@@ -1097,8 +5251,15 @@ class YOLOTwoWheeledHumansAnnotationApp:
 
                     # Обновляем цвет в списке файлов
                     filename = os.path.basename(self.current_image_path)
-                    index = self.image_listbox.get(0, tk.END).index(filename)
+                    index = self.image_listbox.index_of(filename)
                     self.image_listbox.itemconfig(index, {"bg": "white"})
+                self.catalog.set_label(
+                    os.path.basename(self.current_image_path), 0
+                )
+                self.label_index.sync(
+                    [os.path.basename(self.current_image_path)]
+                )
+                self.record_manual_save()
                 return
             except Exception as e:
                 messagebox.showerror(
@@ -1106,18 +5267,25 @@ class YOLOTwoWheeledHumansAnnotationApp:
                 )
                 return
 
-        # Сохраняем аннотации в файл
+        # Сохраняем аннотации в файл (атомарно): при массовой разметке -
+        # через фоновую запись пачками, вручную - сразу
         try:
-            with open(self.current_label_path, "w") as f:
-                for ann in self.annotations:
-                    f.write(
-                        f"{ann['class']} {ann['x_center']:.6f} {ann['y_center']:.6f} {ann['width']:.6f} {ann['height']:.6f}\n"
-                    )
+            filename = os.path.basename(self.current_image_path)
+            if self.auto_annotation_running:
+                self.label_writer.put_text(self.current_label_path,
+                                           self.annotations.to_text())
+                # Файла еще нет на диске - учтем его после записи
+                self.queued_labels[filename] = len(self.annotations)
+            else:
+                self.annotations.save(self.current_label_path,
+                                      LABEL_FSYNC != "never")
+                self.catalog.set_label(filename, len(self.annotations))
+                self.label_index.sync([filename])
 
             # Обновляем цвет в списке файлов
-            filename = os.path.basename(self.current_image_path)
-            index = self.image_listbox.get(0, tk.END).index(filename)
+            index = self.image_listbox.index_of(filename)
             self.image_listbox.itemconfig(index, {"bg": "light green"})
+            self.record_manual_save()
 
             self.root.update()  # Обновляем интерфейс
 
@@ -1125,9 +5293,229 @@ class YOLOTwoWheeledHumansAnnotationApp:
             messagebox.showerror("Ошибка",
                                  f"Не удалось сохранить разметку: {str(e)}")
 
+    def on_close(self):
+        """Закрытие окна: дописать разметку из очереди и выйти"""
+        self.auto_annotation_running = False
+        self.video_stop.set()
+        self.label_writer.close()
+        self.apply_queued_labels()
+        self.label_index.close()
+        self.detection_cache.close()
+        self.root.destroy()
+
+    def flush_labels(self):
+        """Дождаться фоновой записи разметки и учесть ее в каталоге"""
+        self.label_writer.flush()
+        self.apply_queued_labels()
+
+    def apply_queued_labels(self):
+        """Учет в каталоге и индексе рамок разметки, записанной фоном
+
+        Вызывать после записи очереди: set_label берет время изменения
+        файла разметки, а файлы, которые записать не удалось, остаются
+        неразмеченными.
+        """
+        if not self.queued_labels:
+            return
+        queued, self.queued_labels = self.queued_labels, {}
+        for filename, annotations in queued.items():
+            self.catalog.set_label(filename, annotations)
+        self.label_index.sync(list(queued))
+
+    def record_manual_save(self):
+        """Отмечает в журнале изображение, разметку которого проверил человек
+
+        Такие изображения массовая разметка больше не трогает, даже если
+        файл разметки удален из-за отсутствия аннотаций.
+        """
+        if self.auto_annotation_running:
+            return  # Результат авто разметки записывает process_next_unlabeled
+        self.manifest.record(self.image_dir,
+                             os.path.basename(self.current_image_path),
+                             "done", len(self.annotations))
+
+
+def parse_args(argv=None):
+    """Разбор аргументов командной строки"""
+    parser = argparse.ArgumentParser(
+        description="Разметка двухколесных людей для YOLO"
+    )
+    parser.add_argument("--headless", action="store_true",
+                        help="разметить все неразмеченные изображения "
+                             "без графического интерфейса")
+    parser.add_argument("--images", default=IMAGE_DIR,
+                        help="папка с изображениями")
+    parser.add_argument("--labels", default=LABEL_DIR,
+                        help="папка для файлов разметки")
+    parser.add_argument("--model", default=YOLO_MODEL,
+                        help="веса модели YOLO")
+    parser.add_argument("--conf", type=float, default=CONF_THRESHOLD,
+                        help="минимальная уверенность предсказания")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="сколько изображений подавать в модель "
+                             "за один вызов")
+    parser.add_argument("--prefetch", type=int, default=PREFETCH_IMAGES,
+                        help="сколько изображений декодировать заранее")
+    parser.add_argument("--decode-workers", type=int, default=DECODE_WORKERS,
+                        help="число потоков декодирования изображений")
+    parser.add_argument("--state-dir", default=STATE_DIR,
+                        help="папка служебных файлов (журнал заданий)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="не использовать кэш детекций")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="число процессов разметки, у каждого своя "
+                             "модель (0 - по числу ядер)")
+    parser.add_argument("--backend", choices=INFERENCE_BACKENDS,
+                        default=INFERENCE_BACKEND,
+                        help="движок инференса (модель для onnx/openvino "
+                             "экспортируется один раз и кэшируется)")
+    parser.add_argument("--parity-check", action="store_true",
+                        help="сравнить результаты движка --backend с torch "
+                             "на изображениях из --images и выйти")
+    parser.add_argument("--classes", type=int, nargs="+",
+                        default=list(RELEVANT_CLASSES),
+                        help="классы COCO, которые ищет детектор")
+    parser.add_argument("--det-conf", type=float, default=DETECTOR_CONF,
+                        help="порог уверенности NMS детектора (не выше "
+                             "--conf)")
+    parser.add_argument("--iou", type=float, default=DETECTOR_IOU,
+                        help="порог IoU NMS детектора")
+    parser.add_argument("--imgsz", type=int, default=DETECTOR_IMGSZ,
+                        help="размер входа модели")
+    parser.add_argument("--fsync", choices=LABEL_FSYNC_POLICIES,
+                        default=LABEL_FSYNC,
+                        help="когда сбрасывать файлы разметки на диск "
+                             "(never, batch - раз на пачку, always)")
+    parser.add_argument("--packed-labels", action="store_true",
+                        help=f"писать разметку в один файл "
+                             f"{LABEL_PACK_FILE} вместо отдельных .txt")
+    parser.add_argument("--unpack-labels", action="store_true",
+                        help="распаковать упакованную разметку в файлы "
+                             ".txt и выйти")
+    parser.add_argument("--near-duplicates", action="store_true",
+                        help="не запускать модель на изображениях, похожих "
+                             "на уже размеченные (с тем же соотношением "
+                             "сторон), а переносить на них разметку")
+    parser.add_argument("--near-distance", type=int,
+                        default=NEAR_DUPLICATE_DISTANCE,
+                        help="наибольшее число различающихся битов "
+                             "перцептивного хэша у похожих изображений")
+    parser.add_argument("--tiles", action="store_true",
+                        help=f"размечать большие изображения по тайлам "
+                             f"{TILE_SIZE}x{TILE_SIZE}")
+    parser.add_argument("--video",
+                        help="разметить кадры видеофайла или камеры "
+                             "(номер устройства) без интерфейса")
+    parser.add_argument("--stride", type=int, default=VIDEO_FRAME_STRIDE,
+                        help="брать каждый N-й кадр видео")
+    parser.add_argument("--min-change", type=float, default=VIDEO_MIN_CHANGE,
+                        help="минимальное отличие кадра от предыдущего "
+                             "(0..1, 0 - не пропускать похожие кадры)")
+    parser.add_argument("--keyframe-interval", type=int,
+                        default=VIDEO_KEYFRAME_INTERVAL,
+                        help="запускать модель на каждом N-м кадре видео, "
+                             "между ними отслеживать рамки (1 - модель "
+                             "на каждом кадре)")
+    parser.add_argument("--export-dataset", metavar="DIR",
+                        help="упаковать размеченные изображения в шарды "
+                             "tar с индексом и выйти")
+    parser.add_argument("--import-dataset", metavar="DIR",
+                        help="распаковать набор из шардов в --images "
+                             "и --labels и выйти")
+    parser.add_argument("--verify-dataset", metavar="DIR",
+                        help="проверить упакованный набор по хэшам и "
+                             "каталогу --images и выйти")
+    parser.add_argument("--add-images", nargs="+", metavar="PATH",
+                        help="добавить изображения из файлов и папок "
+                             "в --images (дубликаты по содержимому "
+                             "пропускаются) и выйти")
+    parser.add_argument("--import-mode", choices=IMPORT_MODES,
+                        default=IMPORT_MODE,
+                        help="как переносить добавляемые файлы: copy, "
+                             "reflink (копия с общими блоками, если ФС "
+                             "умеет) или hardlink (жесткая ссылка)")
+    parser.add_argument("--label-stats", action="store_true",
+                        help="вывести сводку по разметке (классы, число "
+                             "и размеры рамок) и выйти")
+    parser.add_argument("--shard-mb", type=int, default=DATASET_SHARD_MB,
+                        help="наибольший размер шарда в мегабайтах")
+    args = parser.parse_args(argv)
+    # Рамки ниже --det-conf отбрасывает NMS, до порога пар они не дойдут
+    if args.det_conf > args.conf:
+        parser.error(f"--det-conf ({args.det_conf}) не может быть выше "
+                     f"--conf ({args.conf})")
+    return args
+
 
 if __name__ == "__main__":
-    root = tk.Tk()
-    app = YOLOTwoWheeledHumansAnnotationApp(root)
-    root.geometry("1000x700")
-    root.mainloop()
+    args = parse_args()
+    detector = DetectorConfig(args.classes, args.det_conf, args.iou,
+                              args.imgsz, TILE_SIZE if args.tiles else 0)
+    if args.export_dataset:
+        count, problems = export_dataset(args.export_dataset, args.images,
+                                         args.labels, args.state_dir,
+                                         args.shard_mb)
+        print(f"Упаковано образцов: {count}")
+        for problem in problems:
+            print(problem)
+        sys.exit(1 if problems else 0)
+    elif args.import_dataset:
+        count, skipped, problems = import_dataset(
+            args.import_dataset, args.images, args.labels, args.state_dir,
+            args.fsync
+        )
+        print(f"Распаковано образцов: {count}, уже были: {skipped}")
+        for problem in problems:
+            print(problem)
+        sys.exit(1 if problems else 0)
+    elif args.verify_dataset:
+        problems = verify_dataset(args.verify_dataset, args.images,
+                                  args.labels, args.state_dir)
+        print("\n".join(problems) or "Набор цел и совпадает с каталогом")
+        sys.exit(1 if problems else 0)
+    elif args.add_images:
+        imported, duplicates, errors = import_images(
+            args.add_images, args.images, args.labels, args.state_dir,
+            args.import_mode, IMPORT_WORKERS, ProgressReporter(None)
+        )
+        print(f"Добавлено изображений: {imported}, пропущено дубликатов: "
+              f"{duplicates}")
+        for error in errors:
+            print(error)
+        sys.exit(1 if errors else 0)
+    elif args.label_stats:
+        print_label_statistics(args.images, args.labels, args.state_dir)
+    elif args.unpack_labels:
+        print(f"Распаковано файлов разметки: "
+              f"{unpack_labels(args.labels, args.fsync)}")
+    elif args.parity_check:
+        sys.exit(0 if check_backend_parity(args.images, args.model,
+                                           args.backend, args.conf,
+                                           args.state_dir, PARITY_SAMPLES,
+                                           detector) else 1)
+    elif args.video is not None:
+        run_video(args.video, args.images, args.labels, args.model,
+                  args.conf, args.batch_size, args.stride, args.min_change,
+                  args.keyframe_interval, detector, args.backend,
+                  args.state_dir)
+    elif args.headless:
+        workers = args.workers or os.cpu_count() or 1
+        try:
+            run_headless(args.images, args.labels, args.model, args.conf,
+                         args.batch_size, args.prefetch, args.decode_workers,
+                         workers, args.state_dir, not args.no_cache,
+                         detector, args.backend, args.fsync,
+                         args.packed_labels,
+                         args.near_distance if args.near_duplicates
+                         else None)
+        except WorkerInitError as e:
+            print(f"Не удалось загрузить модель в процессах разметки: {e}",
+                  file=sys.stderr)
+            sys.exit(1)
+    else:
+        import_gui()
+        root = tk.Tk()
+        app = YOLOTwoWheeledHumansAnnotationApp(root)
+        root.protocol("WM_DELETE_WINDOW", app.on_close)
+        root.geometry("1000x700")
+        root.mainloop()